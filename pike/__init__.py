@@ -4,7 +4,8 @@ from .nodes import (Node, Edge, PlaceholderNode, NoopNode, SourceNode,
                     GlobNode, CoffeeNode, LessNode, MergeNode, UrlNode,
                     SplitExtNode, WriteNode, ConcatNode, FilterNode, MapNode,
                     XargsNode, ChangeListenerNode, CacheNode, UglifyNode,
-                    CleanCssNode, RewriteCssNode)
+                    CleanCssNode, RewriteCssNode, CompilerNode, CssNode,
+                    CompressNode, FingerprintNode)
 from .env import (Environment, watch_graph, RenderException,
                   ShowException)
 from .exceptions import ValidationError, StopProcessing
@@ -27,8 +28,10 @@ noop = NoopNode
 glob = GlobNode
 merge = MergeNode
 url = UrlNode
+fingerprint = FingerprintNode
 splitext = SplitExtNode
 write = WriteNode
+compress = CompressNode
 concat = ConcatNode
 filter = FilterNode
 map = MapNode
@@ -42,3 +45,4 @@ less = LessNode
 uglify = UglifyNode
 cleancss = CleanCssNode
 rewritecss = RewriteCssNode
+css = CssNode
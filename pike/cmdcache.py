@@ -0,0 +1,238 @@
+""" Persistent caches for the outputs of external commands. """
+import os
+
+import json
+import logging
+import six
+import subprocess
+import threading
+from hashlib import md5  # pylint: disable=E0611
+
+from .util import atomic_open
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CommandCache(object):
+
+    """
+    Disk cache of the outputs of compiler commands.
+
+    Outputs are stored as files inside ``directory`` and keyed on the
+    command, the version of the tool, the working directory, the digest of the
+    input, and any extra context (such as the digests of imported files). When
+    the total size of the cached outputs exceeds ``max_size``, the least
+    recently used outputs are removed.
+
+    Absolute paths inside the project root are made relative to it before
+    they are hashed, so the outputs can be shared between checkouts of the
+    same project in different directories (such as CI workspaces).
+
+    While the cache is active (used as a context manager), compiler nodes such
+    as :class:`~pike.nodes.preprocess.LessNode` will use it.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to store the outputs in
+    max_size : int, optional
+        The maximum number of bytes to store (default 100MB)
+    root : str, optional
+        The root directory of the project (defaults to the current directory)
+
+    Examples
+    --------
+    ::
+
+        with CommandCache('/tmp/pike_commands'):
+            graph.run()
+
+    """
+    cache_context = threading.local()
+    _versions = {}
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024, root=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.root = os.path.abspath(root or os.curdir)
+        self.size = None
+        self._lock = threading.RLock()
+        self._old_instance = None
+
+    @classmethod
+    def current(cls):
+        """ Get the active CommandCache for this thread, if any """
+        return getattr(cls.cache_context, 'instance', None)
+
+    def __enter__(self):
+        self._old_instance = self.current()
+        CommandCache.cache_context.instance = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        CommandCache.cache_context.instance = self._old_instance
+
+    @classmethod
+    def tool_version(cls, tool):
+        """
+        Get the version string of a tool.
+
+        The version is found by running ``tool --version`` once per process.
+        If that fails the version will be an empty string.
+
+        """
+        version = cls._versions.get(tool)
+        if version is None:
+            try:
+                proc = subprocess.Popen([tool, '--version'],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+                version = output.decode('utf-8', 'replace').strip()
+            except (OSError, ValueError):
+                version = ''
+            cls._versions[tool] = version
+        return version
+
+    def key(self, cmd, cwd, digest, context=()):
+        """
+        Generate the cache key for running a command.
+
+        Parameters
+        ----------
+        cmd : list
+            The command
+        cwd : str or None
+            The directory the command is run from
+        digest : str
+            The digest of the input data
+        context : list, optional
+            Any other values that the output depends on
+
+        Returns
+        -------
+        key : str
+
+        """
+        cmd = list(cmd)
+        parts = [cmd[0], self.tool_version(cmd[0]), self._relative(cmd),
+                 self._relative(cwd), digest, self._relative(context)]
+        return md5(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def _relative(self, value):
+        """ Make the absolute paths under the root in a value relative """
+        if isinstance(value, (list, tuple)):
+            return [self._relative(item) for item in value]
+        if not isinstance(value, six.string_types) or \
+                not os.path.isabs(value):
+            return value
+        path = os.path.normpath(value)
+        if path == self.root:
+            return os.curdir
+        prefix = os.path.join(self.root, '')
+        if path.startswith(prefix):
+            return path[len(prefix):].replace(os.sep, '/')
+        return value
+
+    def _path(self, key):
+        """ Get the path of the file for a key """
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Get a cached output.
+
+        Parameters
+        ----------
+        key : str
+            Key from :meth:`~.key`
+
+        Returns
+        -------
+        output : str or None
+            None if the output is not in the cache
+
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as ifile:
+                data = ifile.read()
+        except IOError:
+            return None
+        # Update the modification time for the LRU
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """
+        Store an output in the cache.
+
+        Parameters
+        ----------
+        key : str
+            Key from :meth:`~.key`
+        data : str
+
+        """
+        path = self._path(key)
+        with atomic_open(path, 'wb') as ofile:
+            ofile.write(data)
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._entries())
+            else:
+                self.size += len(data)
+            if self.size > self.max_size:
+                self.prune()
+
+    def _entries(self):
+        """ Generate (path, size, mtime) for every cached output """
+        if not os.path.isdir(self.directory):
+            return
+        for dirname in os.listdir(self.directory):
+            dirpath = os.path.join(self.directory, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def prune(self):
+        """ Remove the least recently used outputs until under max_size """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            self.size = sum(size for _, size, _ in entries)
+            removed = 0
+            for path, size, _ in entries:
+                if self.size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.size -= size
+                removed += 1
+            LOG.debug("Removed %d outputs from %s", removed, self.directory)
+
+    def clear(self):
+        """ Remove all cached outputs """
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.size = 0
+
+    def __repr__(self):
+        return 'CommandCache(%r)' % self.directory
@@ -0,0 +1,202 @@
+"""
+Long-lived compiler processes.
+
+Workers speak a line-based JSON protocol over stdin/stdout. Each request is a
+JSON object on a single line, and the worker replies with a single line that
+contains either the result or an ``error`` key.
+
+"""
+import os
+
+import atexit
+import json
+import logging
+import subprocess
+import threading
+from six.moves.queue import Queue  # pylint: disable=F0401
+
+
+LOG = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.join(os.path.dirname(__file__), 'js')
+
+
+def worker_script(name):
+    """ Get the path to one of the javascript worker scripts """
+    return os.path.join(SCRIPT_DIR, name)
+
+
+class Worker(object):
+
+    """
+    A single long-lived worker process.
+
+    The process is started when the first request is made, and will be
+    restarted if it exits.
+
+    Parameters
+    ----------
+    cmd : list
+        The command that starts the worker
+    cwd : str, optional
+        Directory to run the worker in
+
+    """
+
+    def __init__(self, cmd, cwd=None):
+        self.cmd = list(cmd)
+        self.cwd = cwd
+        self.proc = None
+
+    @property
+    def alive(self):
+        """ True if the worker process is running """
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """ Start the worker process """
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, cwd=self.cwd)
+
+    def request(self, message):
+        """
+        Send a request to the worker and wait for the response.
+
+        If the worker has died, it will be restarted and the request will be
+        retried once.
+
+        Parameters
+        ----------
+        message : dict
+
+        Returns
+        -------
+        response : dict
+
+        Raises
+        ------
+        exc : :class:`~subprocess.CalledProcessError`
+            If the worker returns an error or keeps crashing
+
+        """
+        line = json.dumps(message).encode('utf-8') + b'\n'
+        response = None
+        for _ in range(2):
+            if not self.alive:
+                if self.proc is not None:
+                    LOG.warning("Restarting worker %s (exit code %s)",
+                                self.cmd, self.proc.returncode)
+                    self.close()
+                self.start()
+            try:
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+                response = self.proc.stdout.readline()
+            except (IOError, OSError):
+                response = None
+            if response:
+                break
+            # The worker died in the middle of the request
+            self.proc.wait()
+        if not response:
+            raise subprocess.CalledProcessError(self.proc.returncode,
+                                                self.cmd, 'Worker crashed')
+        result = json.loads(response.decode('utf-8'))
+        if 'error' in result:
+            raise subprocess.CalledProcessError(1, self.cmd, result['error'])
+        return result
+
+    def close(self):
+        """ Stop the worker process """
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        for stream in (proc.stdin, proc.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+
+
+class WorkerPool(object):
+
+    """
+    A fixed-size pool of :class:`~.Worker` processes.
+
+    Parameters
+    ----------
+    cmd : list
+        The command that starts a worker
+    size : int, optional
+        Maximum number of worker processes (default 1)
+
+    """
+
+    def __init__(self, cmd, size=1):
+        self.cmd = list(cmd)
+        self.workers = [Worker(cmd) for _ in range(size)]
+        self._idle = Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def request(self, message):
+        """
+        Send a request to the next free worker.
+
+        See :meth:`~.Worker.request`
+
+        """
+        worker = self._idle.get()
+        try:
+            return worker.request(message)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        """ Stop all worker processes """
+        for worker in self.workers:
+            worker.close()
+
+
+_POOLS = {}
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool(cmd, size=1):
+    """
+    Get the shared worker pool for a command.
+
+    Pools are kept alive until the interpreter exits so that they can be
+    reused across nodes and graph runs.
+
+    Parameters
+    ----------
+    cmd : list
+        The command that starts a worker
+    size : int, optional
+        Number of workers in the pool. Only used when the pool is created.
+        (default 1)
+
+    Returns
+    -------
+    pool : :class:`~.WorkerPool`
+
+    """
+    key = tuple(cmd)
+    with _POOL_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = WorkerPool(cmd, size)
+        return pool
+
+
+@atexit.register
+def close_pools():
+    """ Stop all shared worker pools """
+    with _POOL_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
@@ -3,6 +3,7 @@ import os
 import time
 from datetime import datetime
 
+import contextlib
 import copy
 import logging
 import six
@@ -10,8 +11,9 @@ import tempfile
 import threading
 from six.moves import cPickle as pickle  # pylint: disable=F0401
 
+from .cmdcache import CommandCache
 from .exceptions import StopProcessing
-from .items import FileMeta
+from .items import FileMeta, PackedResults, BlobStore
 from .nodes import (ChangeListenerNode, ChangeEnforcerNode, CacheNode, Edge,
                     NoopNode)
 from .sqlitedict import SqliteDict
@@ -39,7 +41,8 @@ def watch_graph(graph, partial=False, cache=None, fingerprint='md5'):
     partial : bool, optional
         If True, the :class:`~pike.ChangeListenerNode` will only propagate
         changed files and the graph will rely on a :class:`~pike.CacheNode` to
-        produce the total output.
+        produce the total output. Files that were combined with a changed file
+        into the same output are also propagated. (default False)
     cache : str, optional
         If present, cache the file fingerprints and other data in this file.
     fingerprint : str or callable, optional
@@ -55,7 +58,14 @@ def watch_graph(graph, partial=False, cache=None, fingerprint='md5'):
         if partial:
             sink = CacheNode(cache, new_graph.name + '_cache')
             new_graph.sink.connect(sink, '*', '*')
-        enforcer = ChangeEnforcerNode()
+            # The cache knows which sources were combined into each output,
+            # so the enforcer can re-run all the inputs of a changed output
+            enforcer = ChangeEnforcerNode(provenance=sink)
+            # Removed files bypass the processing and are evicted from the
+            # cache
+            enforcer.connect(sink, 'removed', '_removed')
+        else:
+            enforcer = ChangeEnforcerNode()
         for i, node in enumerate(new_graph.source_nodes()):
             # Find the outbound edge of the source
             if node.eout:
@@ -75,9 +85,10 @@ def watch_graph(graph, partial=False, cache=None, fingerprint='md5'):
             # a ChangeEnforcer. That way processing will continue even if only
             # one of the sources has changed files.
             listener.connect(enforcer, input_name=str(i))
-            if not partial:
-                listener.connect(enforcer, output_name='all', input_name=str(i)
-                                 + '_all')
+            listener.connect(enforcer, output_name='removed',
+                             input_name=str(i) + '_removed')
+            listener.connect(enforcer, output_name='all', input_name=str(i) +
+                             '_all')
 
             if edge.input_name == '*':
                 edge.input_name = None
@@ -220,6 +231,19 @@ class Environment(object):
         When running a graph throws an exception, this handler will do
         something useful, like rendering a graph that visually shows you where
         the error happened.
+    max_memory : int, optional
+        If provided, limit the memory used by in-memory file data while running
+        graphs to about this many bytes. Data over the limit will be spilled to
+        temporary files. See :class:`~pike.items.BlobStore`.
+    command_cache : str or bool, optional
+        Directory to store the outputs of compiler commands in, so unchanged
+        files will not be recompiled (see
+        :class:`~pike.cmdcache.CommandCache`). By default this is the
+        'pike_commands' directory next to the ``cache`` file, or disabled if
+        there is no ``cache`` file. Pass False to disable.
+    max_command_cache : int, optional
+        The maximum number of bytes to store in the ``command_cache``
+        (default 100MB)
 
     Notes
     -----
@@ -231,6 +255,9 @@ class Environment(object):
                  cache=None,
                  fingerprint='md5',
                  exception_handler=None,
+                 max_memory=None,
+                 command_cache=None,
+                 max_command_cache=100 * 1024 * 1024,
                  ):
         self._fingerprint = fingerprint
         self._graphs = {}
@@ -240,12 +267,29 @@ class Environment(object):
                                      synchronous=0)
             self._gen_files = SqliteDict(cache, 'file_paths', autocommit=False,
                                          synchronous=0)
+            self._manifest = SqliteDict(cache, 'manifest', autocommit=False,
+                                        synchronous=0)
         else:
             self._cache = {}
             self._gen_files = {}
+            self._manifest = {}
+        # Unpacked results by graph name, so get() doesn't unpack every time
+        self._unpacked = {}
         self.default_output = None
         self.watch = watch
         self._exc_handler = exception_handler
+        if max_memory is not None:
+            self._blob_store = BlobStore(max_memory)
+        else:
+            self._blob_store = None
+        if command_cache is None and cache is not None:
+            command_cache = os.path.join(os.path.dirname(
+                os.path.abspath(cache)), 'pike_commands')
+        if command_cache:
+            self._command_cache = CommandCache(command_cache,
+                                               max_command_cache)
+        else:
+            self._command_cache = None
 
     def add(self, graph, ignore_default_output=False, partial=False):
         """
@@ -259,7 +303,8 @@ class Environment(object):
             If True, will *not* run the ``default_output`` graph on the output
             of this graph (default False)
         partial : bool, optional
-            This argument will be passed to :meth:`~.watch_graph`
+            This argument will be passed to :meth:`~.watch_graph` (default
+            False)
 
         """
         name = graph.name
@@ -295,8 +340,20 @@ class Environment(object):
         self.default_output = graph
 
     def get(self, name):
-        """ Get the cached results of a graph. """
-        return self._cache.get(name)
+        """
+        Get the cached results of a graph.
+
+        The results are unpacked once and shared between calls until the graph
+        is run again, so they should not be modified.
+
+        """
+        results = self._unpacked.get(name)
+        if results is not None:
+            return results
+        results = self._cache.get(name)
+        if isinstance(results, PackedResults):
+            results = self._unpacked[name] = results.unpack()
+        return results
 
     def save(self, filename):
         """ Saved the cached asset metadata to a file """
@@ -308,6 +365,7 @@ class Environment(object):
         """ Load cached asset metadata from a file """
         with open(filename, 'rb') as ifile:
             self._cache = pickle.load(ifile)
+        self._unpacked.clear()
 
     def run(self, name, bust=False):
         """
@@ -332,18 +390,25 @@ class Environment(object):
             LOG.debug("Running %s", name)
             try:
                 start = time.time() * 1000
-                results = self._graphs[name].run()
+                with self._run_context():
+                    results = self._graphs[name].run()
                 elapsed = int(time.time() * 1000 - start)
                 LOG.info("Ran %s in %d ms", name, elapsed)
                 for items in six.itervalues(results):
                     for item in items:
                         if isinstance(item, FileMeta):
-                            # Remove data to save memory
-                            if hasattr(item, 'data'):
-                                del item.data
                             self._gen_files[item.filename] = item.fullpath
+                            logical = getattr(item, 'logical_filename', None)
+                            if logical is not None:
+                                self._manifest[logical] = item.filename
                 commit(self._gen_files)
-                self._cache[name] = results
+                commit(self._manifest)
+                # Packing removes the file data and shares the path strings.
+                # The provenance of each file is only needed by the
+                # CacheNode, which stores its own copy.
+                self._cache[name] = PackedResults(results,
+                                                  exclude=('sources',))
+                self._unpacked.pop(name, None)
                 commit(self._cache)
             except StopProcessing:
                 LOG.debug("No changes for %s", name)
@@ -361,7 +426,21 @@ class Environment(object):
                         raise e
                 else:
                     raise
-        return self._cache.get(name)
+        return self.get(name)
+
+    @contextlib.contextmanager
+    def _run_context(self):
+        """ Activate the blob store and command cache while running a graph """
+        contexts = [context for context in (self._blob_store,
+                                            self._command_cache)
+                    if context is not None]
+        for context in contexts:
+            context.__enter__()
+        try:
+            yield
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
 
     def run_all(self, bust=False):
         """ Run all graphs. """
@@ -461,8 +540,15 @@ class Environment(object):
             Absolute path of the generated asset (if it exists). If the path is
             known to be invalid, this value will be None.
 
+        Notes
+        -----
+        The original name of a file renamed by
+        :class:`~pike.nodes.simple.FingerprintNode` will resolve to the
+        renamed file.
+
         """
         if path not in self._gen_files:
-            return None
-        fullpath = self._gen_files[path]
-        return fullpath
+            path = self._manifest.get(path)
+            if path is None:
+                return None
+        return self._gen_files.get(path)
@@ -8,7 +8,13 @@ import six
 import subprocess
 import threading
 
+try:
+    from collections.abc import Iterator
+except ImportError:  # pragma: no cover
+    from collections import Iterator  # pylint: disable=E0611
+
 from .exceptions import ValidationError
+from .items import share_items, record_sources
 from .nodes import NoopNode, run_node, LinkNode, asnode, Edge
 from .util import tempd
 
@@ -309,6 +315,12 @@ class Graph(object):
         If the source node of the graph accepts inputs, you may pass in those
         inputs here.
 
+        Every :class:`~pike.items.FileMeta` that passes through the graph is
+        given a ``sources`` attribute with the full paths of the source files
+        it was made from (see :meth:`~pike.items.record_sources`). Streams
+        that nodes return as iterators are converted to lists so they can be
+        read more than once.
+
         """
         if not self._finalized:
             raise ValueError("Must call finalize() before running %s" % self)
@@ -316,6 +328,10 @@ class Graph(object):
         if (args or kwargs) and self.source is None:
             raise TypeError("This graph takes no inputs")
         else:
+            args = [list(arg) if isinstance(arg, Iterator) else arg
+                    for arg in args]
+            kwargs = dict((key, list(val) if isinstance(val, Iterator) else
+                           val) for key, val in six.iteritems(kwargs))
             inputs[self.source] = (args, kwargs)
 
         sink_ret = None
@@ -331,25 +347,39 @@ class Graph(object):
             else:
                 args = args_by_edge
             ret = run_node(node, args, kwargs)
+            # Streams may be read by several consumers and by the provenance
+            # tracking, so one-shot iterators (generators, filter(), etc.)
+            # are converted to lists
+            for name, stream in six.iteritems(ret):
+                if isinstance(stream, Iterator):
+                    ret[name] = list(stream)
+            record_sources(list(args) + list(six.itervalues(kwargs)), ret)
             if node == self.sink:
                 sink_ret = ret
+            # If the outputs fan out to multiple edges, give each edge
+            # copy-on-write views so that they can't corrupt each other
+            if len(node.eout) > 1:
+                share = share_items
+            else:
+                share = lambda items: items
             for edge in node.eout:
                 args_by_edge, kwargs = inputs.setdefault(edge.n2, ({}, {}))
                 if edge.output_name == '*':
                     if edge.input_name == '*':
                         a, k = ret_to_args(ret)
                         if a is not None:
-                            args_by_edge[edge] = a
-                        kwargs.update(k)
+                            args_by_edge[edge] = share(a)
+                        for key, val in six.iteritems(k):
+                            kwargs[key] = share(val)
                     else:
                         raise BAD_EDGE
                 elif edge.input_name is None:
                     if edge.output_name in ret:
-                        args_by_edge[edge] = ret[edge.output_name]
+                        args_by_edge[edge] = share(ret[edge.output_name])
                 elif edge.input_name == '*':
                     raise BAD_EDGE
                 else:
-                    kwargs[edge.input_name] = ret[edge.output_name]
+                    kwargs[edge.input_name] = share(ret[edge.output_name])
         return sink_ret
 
     def connect(self, *args, **kwargs):
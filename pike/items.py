@@ -1,11 +1,33 @@
 """ Classes for wrapping items and file data """
 import os
 
+import atexit
 import contextlib
+import functools
+import mmap
 import shutil
+import six
+import tempfile
+import threading
+import weakref
+from hashlib import md5  # pylint: disable=E0611
 from six import BytesIO
+from six.moves import intern  # pylint: disable=F0401,W0622
+from uuid import uuid1
 
-from .util import atomic_open
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict  # pylint: disable=F0401
+
+from .util import (atomic_open, copy_file, md5chunks, to_bytes,
+                   DEFAULT_COPY_METHODS)
+
+
+# Default size of the chunks yielded by :meth:`~.IFileData.iter_chunks`
+CHUNK_SIZE = 64 * 1024
+# Spooled data larger than this will be moved from memory to a temporary file
+SPOOL_SIZE = 1024 * 1024
 
 
 class IFileData(object):
@@ -17,6 +39,7 @@ class IFileData(object):
     source.
 
     """
+    _digest = None
 
     def open(self):
         """
@@ -42,6 +65,29 @@ class IFileData(object):
         """
         raise NotImplementedError
 
+    def iter_chunks(self, size=CHUNK_SIZE):
+        """
+        Iterate over the file data in chunks.
+
+        Parameters
+        ----------
+        size : int, optional
+            The maximum size of each chunk (default 64KB)
+
+        Returns
+        -------
+        chunks : generator
+            Generator that yields strings or buffers no longer than ``size``
+
+        Notes
+        -----
+        The default implementation reads the stream from :meth:`~.open`.
+
+        """
+        with self.open() as stream:
+            for chunk in iter(lambda: stream.read(size), b''):
+                yield chunk
+
     def as_file(self, filename):
         """
         Put the file data into a file on disk.
@@ -54,6 +100,34 @@ class IFileData(object):
         """
         raise NotImplementedError
 
+    def size(self):
+        """
+        Get the length of the data in bytes.
+
+        Returns
+        -------
+        size : int
+
+        """
+        return sum(len(chunk) for chunk in self.iter_chunks())
+
+    def digest(self):
+        """
+        Get the md5 checksum of the data.
+
+        The checksum is only calculated once, and is shared by everything that
+        needs to fingerprint this data.
+
+        Returns
+        -------
+        digest : str
+            The hex digest
+
+        """
+        if self._digest is None:
+            self._digest = md5chunks(self.iter_chunks())
+        return self._digest
+
 
 class FileDataStream(IFileData):
 
@@ -64,6 +138,17 @@ class FileDataStream(IFileData):
     def __init__(self, stream):
         self.stream = stream
 
+    @property
+    def stream(self):
+        """ The wrapped stream """
+        return self._stream
+
+    @stream.setter
+    def stream(self, stream):
+        """ Replace the stream and reset the digest """
+        self._stream = stream
+        self._digest = None
+
     @contextlib.contextmanager
     def open(self):
         try:
@@ -79,19 +164,49 @@ class FileDataStream(IFileData):
 
     def as_file(self, filename):
         with atomic_open(filename, 'wb') as ofile:
-            for chunk in iter(lambda: self.stream.read(16 * 1024), ''):
+            for chunk in self.iter_chunks():
                 ofile.write(chunk)
-        self.stream.seek(0)
+
+    def __getstate__(self):
+        # Streams (particularly temporary files) can't be pickled
+        return {'data': self.read()}
+
+    def __setstate__(self, state):
+        self.stream = BytesIO(state['data'])
 
 
 class FileDataFile(IFileData):
 
-    """ Common data interface for a file on disk """
+    """
+    Common data interface for a file on disk
+
+    The :meth:`~.digest` is cached for the life of the process and keyed by
+    the stat() of the file, so it is only recalculated when the file changes.
+
+    """
     native = 'file'
+    # Mapping of absolute file paths to (stat key, digest)
+    _digests = {}
 
     def __init__(self, filename):
         self.filename = filename
 
+    def size(self):
+        return os.path.getsize(self.filename)
+
+    def digest(self):
+        filename = os.path.abspath(self.filename)
+        stat = os.stat(filename)
+        key = (stat.st_ino, stat.st_size,
+               getattr(stat, 'st_mtime_ns', stat.st_mtime),
+               getattr(stat, 'st_ctime_ns', stat.st_ctime))
+        cached = self._digests.get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = md5chunks(self.iter_chunks())
+        self._digests[filename] = (key, digest)
+        return digest
+
     def open(self):
         return open(self.filename, 'rb')
 
@@ -99,24 +214,151 @@ class FileDataFile(IFileData):
         with self.open() as ifile:
             return ifile.read()
 
-    def as_file(self, filename):
-        dirname = os.path.dirname(filename)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        shutil.copy(self.filename, filename)
+    def as_file(self, filename, methods=DEFAULT_COPY_METHODS):
+        """
+        Copy the file to another location on disk.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the file to write
+        methods : list, optional
+            The copy methods to try. See :meth:`~pike.util.copy_file`.
+
+        """
+        copy_file(self.filename, filename, methods)
+
+
+class FileDataMmap(FileDataFile):
+
+    """
+    Common data interface for a large file on disk.
+
+    :meth:`~.iter_chunks` and :meth:`~.buffer` memory-map the file so they can
+    return zero-copy views of the data instead of copying it into new strings.
+    The file is only mapped while it is being read, so large graphs don't
+    hold on to a file descriptor for every file. :meth:`~.read` still returns
+    a string.
+
+    """
+    native = 'mmap'
+
+    @contextlib.contextmanager
+    def buffer(self):
+        """
+        Memory-map the file for the duration of a ``with`` block.
+
+        Returns
+        -------
+        buffer : context manager
+            Yields a read-only, zero-copy view of the file data (a
+            ``memoryview`` on Python 3, a ``buffer`` on Python 2). The view is
+            not valid after the block exits.
+
+        """
+        with open(self.filename, 'rb') as ifile:
+            if os.fstat(ifile.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                yield b''
+                return
+            mapped = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = memoryview(mapped)
+        except (NameError, TypeError):  # pragma: no cover
+            # Python 2 mmaps only support the old buffer protocol
+            buf = buffer(mapped)  # pylint: disable=E0602
+        try:
+            yield buf
+        finally:
+            if hasattr(buf, 'release'):
+                buf.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # Still referenced by a view that is held by the caller. The
+                # map will be released when that view is garbage collected.
+                pass
+
+    def iter_chunks(self, size=CHUNK_SIZE):
+        with self.buffer() as buf:
+            for i in range(0, len(buf), size):
+                yield buf[i:i + size]
 
 
 class FileDataBlob(IFileData):
 
-    """ Common data interface for a file in memory """
+    """
+    Common data interface for a file in memory
+
+    If a :class:`~.BlobStore` is active when the data is set, the store may
+    move the data to a temporary file to limit memory usage. It will be read
+    back from disk whenever it is accessed.
+
+    """
     native = 'blob'
+    _spill_path = None
 
     def __init__(self, data):
         self.data = data
 
+    @property
+    def data(self):
+        """ The wrapped string """
+        data = self._data
+        if data is None and self._spill_path is not None:
+            with open(self._spill_path, 'rb') as ifile:
+                return ifile.read()
+        return data
+
+    @data.setter
+    def data(self, data):
+        """ Replace the data and reset the digest """
+        if self._spill_path is not None:
+            os.remove(self._spill_path)
+            self._spill_path = None
+        self._data = data
+        self._digest = None
+        store = BlobStore.current()
+        if store is not None and isinstance(data, six.binary_type):
+            store.add(self)
+
+    def spill(self, filename):
+        """
+        Move the data out of memory into a file.
+
+        Parameters
+        ----------
+        filename : str
+            The file to write the data into. It will be removed when the data
+            is replaced.
+
+        """
+        data = self._data
+        if data is None:
+            return
+        with atomic_open(filename, 'wb') as ofile:
+            ofile.write(data)
+        self._spill_path = filename
+        self._data = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_data'] = self.data
+        state.pop('_spill_path', None)
+        return state
+
+    def __setstate__(self, state):
+        if 'data' in state:
+            # Pickled before 'data' was a property
+            state['_data'] = state.pop('data')
+        self.__dict__.update(state)
+
     @contextlib.contextmanager
     def open(self):
-        stream = BytesIO(self.data)
+        if self._data is None and self._spill_path is not None:
+            stream = open(self._spill_path, 'rb')
+        else:
+            stream = BytesIO(self.data)
         try:
             yield stream
         finally:
@@ -125,11 +367,330 @@ class FileDataBlob(IFileData):
     def read(self):
         return self.data
 
+    def iter_chunks(self, size=CHUNK_SIZE):
+        if self._data is None and self._spill_path is not None:
+            with self.open() as stream:
+                for chunk in iter(lambda: stream.read(size), b''):
+                    yield chunk
+            return
+        data = self.data
+        if isinstance(data, six.binary_type):
+            try:
+                data = memoryview(data)
+            except NameError:  # pragma: no cover
+                # Python 2.6 doesn't have memoryview, so slices will be copies
+                pass
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
+
+    def size(self):
+        if self._data is None and self._spill_path is not None:
+            return os.path.getsize(self._spill_path)
+        return len(self._data)
+
     def as_file(self, filename):
+        if self._data is None and self._spill_path is not None:
+            copy_file(self._spill_path, filename)
+            return
         with atomic_open(filename, 'wb') as ofile:
             ofile.write(self.data)
 
 
+class FileDataLazy(IFileData):
+
+    """
+    Common data interface for data that is generated when first accessed.
+
+    This allows nodes to produce outputs that cost nothing if no other node
+    ever reads them.
+
+    Parameters
+    ----------
+    thunk : callable
+        Function that takes no arguments and returns the data as a string. It
+        will be called at most once.
+
+    """
+    native = 'lazy'
+
+    def __init__(self, thunk):
+        self.thunk = thunk
+        self._blob = None
+
+    @property
+    def loaded(self):
+        """ True if the data has been generated """
+        return self._blob is not None
+
+    @property
+    def blob(self):
+        """ The generated data as a :class:`~.FileDataBlob` """
+        if self._blob is None:
+            self._blob = FileDataBlob(self.thunk())
+            self.thunk = None
+        return self._blob
+
+    def open(self):
+        return self.blob.open()
+
+    def read(self):
+        return self.blob.read()
+
+    def iter_chunks(self, size=CHUNK_SIZE):
+        return self.blob.iter_chunks(size)
+
+    def as_file(self, filename):
+        self.blob.as_file(filename)
+
+    def size(self):
+        return self.blob.size()
+
+    def digest(self):
+        return self.blob.digest()
+
+    def __getstate__(self):
+        # The thunk is usually a closure, which cannot be pickled
+        return {'thunk': None, '_blob': self.blob}
+
+
+class ChunkReader(object):
+
+    """
+    Read-only stream that reads from an iterable of chunks.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Iterable of strings or buffers
+
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        """ Read up to ``size`` bytes, or all remaining bytes if negative """
+        pieces = [self._buffer]
+        total = len(self._buffer)
+        while size < 0 or total < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            chunk = to_bytes(chunk)
+            pieces.append(chunk)
+            total += len(chunk)
+        data = b''.join(pieces)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        """ Stop reading """
+        self._chunks = iter(())
+        self._buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class FileDataConcat(IFileData):
+
+    """
+    Common data interface for the concatenation of other data.
+
+    None of the parts are read until the data is accessed, and they are only
+    ever read one chunk at a time, so the full concatenation never needs to be
+    held in memory.
+
+    Parameters
+    ----------
+    parts : list
+        List of :class:`~.IFileData` objects
+    joinstr : str, optional
+        Inserted in between each part (default '')
+
+    """
+    native = 'concat'
+
+    def __init__(self, parts, joinstr=b''):
+        self.parts = list(parts)
+        if isinstance(joinstr, six.text_type):
+            joinstr = joinstr.encode('utf-8')
+        self.joinstr = joinstr
+
+    def open(self):
+        return ChunkReader(self.iter_chunks())
+
+    def read(self):
+        with self.open() as stream:
+            return stream.read()
+
+    def iter_chunks(self, size=CHUNK_SIZE):
+        for i, part in enumerate(self.parts):
+            if i > 0 and self.joinstr:
+                yield self.joinstr
+            for chunk in part.iter_chunks(size):
+                yield chunk
+
+    def size(self):
+        joins = len(self.joinstr) * max(0, len(self.parts) - 1)
+        return joins + sum(part.size() for part in self.parts)
+
+    def as_file(self, filename):
+        # Calculate the digest while writing, since we have to read all the
+        # data anyway
+        digest = md5()
+        with atomic_open(filename, 'wb') as ofile:
+            for chunk in self.iter_chunks():
+                digest.update(chunk)
+                ofile.write(chunk)
+        self._digest = digest.hexdigest()
+
+    def __getstate__(self):
+        # Cached copies should not change if the parts change
+        return {'parts': [FileDataBlob(self.read())], 'joinstr': b''}
+
+
+class BlobStore(object):
+
+    """
+    Limit the total memory used by :class:`~.FileDataBlob` objects.
+
+    While the store is active (used as a context manager), every blob that is
+    created will be tracked, including blobs created by other threads (such
+    as the workers of a :class:`~pike.util.CommandPool`). When the total size
+    of the tracked blobs exceeds ``max_memory``, the oldest blobs will be
+    spilled to files in a temporary directory.
+
+    Parameters
+    ----------
+    max_memory : int
+        The maximum number of bytes of blob data to keep in memory
+    directory : str, optional
+        Create the temporary directory inside this directory (defaults to the
+        system temporary directory)
+
+    Examples
+    --------
+    ::
+
+        with BlobStore(512 * 1024 * 1024):
+            graph.run()
+
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_memory, directory=None):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.size = 0
+        self._tempdir = None
+        self._blobs = OrderedDict()
+        self._spilled = {}
+        self._lock = threading.RLock()
+        self._old_instance = None
+
+    @classmethod
+    def current(cls):
+        """ Get the active BlobStore, if any """
+        return BlobStore._instance
+
+    def __enter__(self):
+        with BlobStore._instance_lock:
+            self._old_instance = BlobStore._instance
+            BlobStore._instance = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with BlobStore._instance_lock:
+            BlobStore._instance = self._old_instance
+
+    def add(self, blob):
+        """ Start tracking the memory used by a blob """
+        # pylint: disable=W0212
+        key = id(blob)
+        size = len(blob._data)
+        with self._lock:
+            old = self._blobs.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            ref = weakref.ref(blob, functools.partial(self._discard, key))
+            self._blobs[key] = (ref, size)
+            self.size += size
+            while self.size > self.max_memory and self._blobs:
+                key, (ref, size) = self._blobs.popitem(False)
+                self.size -= size
+                blob = ref()
+                if blob is not None and blob._data is not None:
+                    filename = os.path.join(self._get_tempdir(),
+                                            uuid1().hex)
+                    blob.spill(filename)
+                    self._spilled[key] = (ref, filename)
+
+    def _get_tempdir(self):
+        """ Lazily create the directory for spilled blobs """
+        if self._tempdir is None:
+            self._tempdir = tempfile.mkdtemp(prefix='pike-blobs-',
+                                             dir=self.directory)
+            atexit.register(self.close)
+        return self._tempdir
+
+    def _discard(self, key, ref):
+        """ Weakref callback for when a blob is garbage collected """
+        with self._lock:
+            entry = self._blobs.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._blobs[key]
+                self.size -= entry[1]
+            entry = self._spilled.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._spilled[key]
+                try:
+                    os.remove(entry[1])
+                except os.error:
+                    pass
+
+    def close(self):
+        """ Delete all spilled data """
+        if self._tempdir is not None:
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+            self._tempdir = None
+
+
+def spool_chunks(chunks, max_size=SPOOL_SIZE):
+    """
+    Copy chunks of data into a spooled temporary file.
+
+    The data is kept in memory until it grows larger than ``max_size``, at
+    which point it will be moved to a temporary file on disk.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Iterable of strings or buffers
+    max_size : int, optional
+        Maximum number of bytes to hold in memory (default 1MB)
+
+    Returns
+    -------
+    data : :class:`~.FileDataStream`
+
+    """
+    stream = tempfile.SpooledTemporaryFile(max_size)
+    for chunk in chunks:
+        stream.write(chunk)
+    stream.seek(0)
+    return FileDataStream(stream)
+
+
 class FileMeta(object):
 
     """
@@ -147,14 +708,86 @@ class FileMeta(object):
     Attributes
     ----------
     data : :class:`~.IFileData`
+    url : str
+        Only present after the file has been through a :class:`~pike.UrlNode`
+    sources : frozenset
+        Full paths of the source files this file was made from. Set by
+        :meth:`~pike.Graph.run` (see :meth:`~.record_sources`).
+
+    Notes
+    -----
+    The common attributes are stored in slots to keep the memory footprint
+    small for large graphs. Any other attributes are stored in a
+    ``__dict__`` that is only allocated when one is set.
+
+    A FileMeta may also be a copy-on-write view of another FileMeta (see
+    :meth:`~.view`).
 
     """
+    __slots__ = ('filename', 'path', 'data', 'url', 'sources', '_base',
+                 '__dict__')
 
     def __init__(self, filename, path, data=None, **kwargs):
         self.filename = filename
         self.path = path
         self.data = data or FileDataFile(os.path.join(path, filename))
-        self.__dict__.update(kwargs)
+        for key, value in six.iteritems(kwargs):
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        # This is only called if the attribute was not found on this object,
+        # so fall back to the base item of a view
+        if name.startswith('__') or name == '_base':
+            raise AttributeError(name)
+        try:
+            base = object.__getattribute__(self, '_base')
+        except AttributeError:
+            raise AttributeError(name)
+        return getattr(base, name)
+
+    def view(self):
+        """
+        Create a copy-on-write view of this item.
+
+        The view reads all attributes from this item until they are set on the
+        view. Setting an attribute on the view will not change this item, so
+        multiple consumers can share one item without copying it.
+
+        Note that attributes inherited from the base item cannot be deleted
+        from the view, and mutable attribute values (such as the
+        :class:`~.IFileData`) are still shared until they are replaced.
+
+        Returns
+        -------
+        view : :class:`~.FileMeta`
+
+        """
+        view = FileMeta.__new__(FileMeta)
+        view._base = self  # pylint: disable=W0212
+        return view
+
+    def __getstate__(self):
+        try:
+            state = object.__getattribute__(self, '_base').__getstate__()
+        except AttributeError:
+            state = {}
+        state.update(getattr(self, '__dict__', {}))
+        for key in ('filename', 'path', 'data', 'url', 'sources'):
+            try:
+                state[key] = getattr(self, key)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        # Also handles pickles from before FileMeta used __slots__, which
+        # will be a plain dict of attributes
+        if isinstance(state, tuple):
+            dict_state, slot_state = state
+            state = dict(dict_state or {})
+            state.update(slot_state or {})
+        for key, value in six.iteritems(state):
+            setattr(self, key, value)
 
     @property
     def fullpath(self):
@@ -178,3 +811,182 @@ class FileMeta(object):
 
     def __hash__(self):
         return hash(self.filename) + hash(self.path)
+
+
+def share_items(items):
+    """
+    Wrap a stream of items so it can be shared by multiple consumers.
+
+    Parameters
+    ----------
+    items : object
+        Usually a list of :class:`~.FileMeta` objects
+
+    Returns
+    -------
+    items : object
+        If ``items`` is a list or tuple, a list with every
+        :class:`~.FileMeta` replaced by a copy-on-write view of it (see
+        :meth:`~.FileMeta.view`). Otherwise, ``items`` is returned unchanged.
+
+    """
+    if not isinstance(items, (list, tuple)):
+        return items
+    return [item.view() if isinstance(item, FileMeta) else item for item in
+            items]
+
+
+def record_sources(inputs, ret):
+    """
+    Record which source files each output item of a node was made from.
+
+    Items that already have a ``sources`` attribute (including views of items
+    that have one) are left alone, so provenance flows through nodes that
+    pass their items along. New items are given the union of the sources of
+    all the inputs. If there are no inputs, the item is its own source.
+
+    Parameters
+    ----------
+    inputs : list
+        The streams that were passed in to the node
+    ret : dict
+        The outputs of the node
+
+    """
+    sources = None
+    for items in six.itervalues(ret):
+        if not isinstance(items, (list, tuple)):
+            continue
+        for item in items:
+            if not isinstance(item, FileMeta) or \
+                    getattr(item, 'sources', None) is not None:
+                continue
+            if sources is None:
+                sources = set()
+                for stream in inputs:
+                    if not isinstance(stream, (list, tuple)):
+                        continue
+                    for input_item in stream:
+                        sources.update(getattr(input_item, 'sources', None)
+                                       or ())
+                sources = frozenset(sources)
+            item.sources = sources or frozenset([item.fullpath])
+
+
+class PackedResults(object):
+
+    """
+    Compact, picklable encoding of the results of a graph.
+
+    All of the :class:`~.FileMeta` objects are stored as tuples of indexes
+    into a shared table of path components, which are mostly the same for
+    every file. The file data is not stored. When unpacked, the shared paths
+    are only created once and are interned.
+
+    Parameters
+    ----------
+    results : dict
+        The results of running a graph. Values that are not lists or tuples,
+        and list elements that are not :class:`~.FileMeta` objects, will be
+        stored as-is.
+    exclude : tuple, optional
+        Names of :class:`~.FileMeta` attributes that should not be stored,
+        in addition to the file data
+
+    Notes
+    -----
+    Each :class:`~.FileMeta` is packed as a tuple of (path, filename, url,
+    extra attributes). All other list elements are packed as a 1-tuple.
+
+    """
+    __slots__ = ('strings', 'results')
+
+    def __init__(self, results, exclude=()):
+        self.strings = []
+        self.results = {}
+        indexes = {}
+
+        def pack_str(string):
+            """ Convert a string to a tuple of component indexes """
+            packed = []
+            for component in string.split('/'):
+                index = indexes.get(component)
+                if index is None:
+                    index = indexes[component] = len(self.strings)
+                    self.strings.append(component)
+                packed.append(index)
+            return tuple(packed)
+
+        for key, items in six.iteritems(results):
+            if not isinstance(items, (list, tuple)):
+                self.results[key] = items
+                continue
+            packed = []
+            for item in items:
+                if isinstance(item, FileMeta):
+                    state = item.__getstate__()
+                    state.pop('data', None)
+                    for name in exclude:
+                        state.pop(name, None)
+                    url = state.pop('url', None)
+                    packed.append((
+                        pack_str(state.pop('path')),
+                        pack_str(state.pop('filename')),
+                        None if url is None else pack_str(url),
+                        state or None,
+                    ))
+                else:
+                    packed.append((item,))
+            self.results[key] = (type(items), packed)
+
+    def unpack(self):
+        """
+        Convert the packed data back into graph results.
+
+        Returns
+        -------
+        results : dict
+
+        """
+        strings = self.strings
+        cache = {}
+
+        def unpack_str(packed):
+            """ Convert a tuple of component indexes to a string """
+            string = cache.get(packed)
+            if string is None:
+                string = '/'.join([strings[i] for i in packed])
+                if isinstance(string, str):
+                    string = intern(string)
+                cache[packed] = string
+            return string
+
+        results = {}
+        for key, value in six.iteritems(self.results):
+            if not isinstance(value, tuple):
+                results[key] = value
+                continue
+            container, packed = value
+            items = []
+            for entry in packed:
+                if len(entry) == 4:
+                    path, filename, url, extra = entry
+                    item = FileMeta.__new__(FileMeta)
+                    item.path = unpack_str(path)
+                    item.filename = unpack_str(filename)
+                    if url is not None:
+                        item.url = unpack_str(url)
+                    if extra:
+                        item.__setstate__(extra)
+                    items.append(item)
+                else:
+                    items.append(entry[0])
+            results[key] = container(items)
+        return results
+
+    def __getstate__(self):
+        return {'strings': self.strings, 'results': self.results}
+
+    def __setstate__(self, state):
+        self.strings = state['strings']
+        self.results = state['results']
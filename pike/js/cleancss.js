@@ -0,0 +1,11 @@
+/* clean-css worker for CleanCssNode(daemon=True) */
+var worker = require('./worker');
+var CleanCSS = worker.requireGlobal('clean-css');
+
+worker.serve(function (request) {
+  var result = new CleanCSS({rebaseTo: request.cwd}).minify(request.source);
+  if (result.errors && result.errors.length) {
+    throw new Error(result.errors.join('\n'));
+  }
+  return {output: result.styles};
+});
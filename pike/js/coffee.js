@@ -0,0 +1,39 @@
+/* Coffeescript compiler worker for CoffeeNode(daemon=True) */
+var worker = require('./worker');
+var coffee;
+try {
+  coffee = worker.requireGlobal('coffeescript');
+} catch (e) {
+  coffee = worker.requireGlobal('coffee-script');
+}
+
+/* Strip the directory and extension the same way `coffee -c` does */
+function baseName(filename) {
+  var parts = filename.split(/[\\\/]/).pop().split('.');
+  if (parts.length > 1) {
+    parts.pop();
+    if (parts.length > 1 && parts[parts.length - 1] === 'coffee') {
+      parts.pop();
+    }
+  }
+  return parts.join('.');
+}
+
+worker.serve(function (request) {
+  if (!request.map) {
+    return {output: coffee.compile(request.source)};
+  }
+  // Use the same options as `coffee -c -m` so the output is identical to
+  // compiling the file on disk
+  var base = baseName(request.filename);
+  var result = coffee.compile(request.source, {
+    filename: request.filename,
+    header: true,
+    sourceMap: true,
+    generatedFile: base + '.js',
+    sourceFiles: [request.filename.split(/[\\\/]/).pop()],
+    sourceRoot: ''
+  });
+  var output = result.js + '\n//# sourceMappingURL=' + base + '.map\n';
+  return {output: output, map: result.v3SourceMap};
+});
@@ -0,0 +1,13 @@
+/* LESS compiler worker for LessNode(daemon=True) */
+var worker = require('./worker');
+var less = worker.requireGlobal('less');
+
+worker.serve(function (request) {
+  var options = {filename: request.filename};
+  if (request.cwd) {
+    options.paths = [request.cwd];
+  }
+  return less.render(request.source, options).then(function (output) {
+    return {output: output.css};
+  });
+});
@@ -0,0 +1,11 @@
+/* uglify-js worker for UglifyNode(daemon=True) */
+var worker = require('./worker');
+var uglify = worker.requireGlobal('uglify-js');
+
+worker.serve(function (request) {
+  var result = uglify.minify(request.source);
+  if (result.error) {
+    throw result.error;
+  }
+  return {output: result.code};
+});
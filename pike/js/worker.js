@@ -0,0 +1,38 @@
+/*
+ * Line-based JSON protocol shared by the pike compiler workers.
+ *
+ * Each line on stdin is a JSON request. Requests are handled in order and
+ * each one gets a single line of JSON on stdout, either the result of the
+ * compile function or {"error": "..."}.
+ */
+var childProcess = require('child_process');
+var path = require('path');
+var readline = require('readline');
+
+var globalRoot = null;
+
+/* Require a module, falling back to the global npm modules */
+exports.requireGlobal = function (name) {
+  try {
+    return require(name);
+  } catch (e) {
+    if (globalRoot === null) {
+      globalRoot = childProcess.execSync('npm root -g').toString().trim();
+    }
+    return require(path.join(globalRoot, name));
+  }
+};
+
+exports.serve = function (compile) {
+  var input = readline.createInterface({input: process.stdin, terminal: false});
+  var queue = Promise.resolve();
+  input.on('line', function (line) {
+    queue = queue.then(function () {
+      return compile(JSON.parse(line));
+    }).catch(function (err) {
+      return {error: String((err && err.stack) || err)};
+    }).then(function (response) {
+      process.stdout.write(JSON.stringify(response) + '\n');
+    });
+  });
+};
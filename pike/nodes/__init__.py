@@ -1,9 +1,10 @@
 """ All provided nodes """
 from .base import (Node, NoopNode, PlaceholderNode, LinkNode, run_node, Edge,
                    XargsNode, asnode)
-from .preprocess import (CoffeeNode, LessNode, UglifyNode, CleanCssNode,
-                         RewriteCssNode)
-from .simple import (MergeNode, ConcatNode, UrlNode, SplitExtNode,
-                     WriteNode, FilterNode, MapNode)
+from .preprocess import (CompilerNode, CoffeeNode, LessNode, UglifyNode,
+                         CleanCssNode, RewriteCssNode, CssNode)
+from .simple import (MergeNode, ConcatNode, UrlNode, FingerprintNode,
+                     SplitExtNode, WriteNode, CompressNode, FilterNode,
+                     MapNode)
 from .source import SourceNode, GlobNode
 from .watch import (ChangeListenerNode, ChangeEnforcerNode, CacheNode)
@@ -3,12 +3,388 @@ import posixpath
 import re
 import os
 
+import six
+
 from .base import Node
-from pike.items import FileMeta, FileDataBlob
-from pike.util import run_cmd, tempd
+from .watch import ChangeListenerNode
+from pike.cmdcache import CommandCache
+from pike.daemon import get_pool, worker_script
+from pike.items import FileMeta, FileDataBlob, FileDataFile, FileDataLazy
+from pike.util import CommandPool, run_cmd, tempd, to_bytes, to_text
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict  # pylint: disable=F0401
+
+
+# Maximum number of files to compile with a single coffee command
+COFFEE_BATCH_SIZE = 100
+# Matches @import "file", @import 'file', @import url(file), and LESS import
+# options such as @import (reference) "file"
+IMPORT_RE = re.compile(r"""@import\s*(?:\([^)]*\)\s*)?(?:url\(\s*)?"""
+                       r"""['"]?([^'")\s;]+)['"]?""")
+
+
+class CompilerNode(Node):
+
+    """
+    Base class for nodes that run each file through a command.
+
+    Subclasses must implement :meth:`~.get_command`.
+
+    Parameters
+    ----------
+    lazy : bool, optional
+        If True, don't run the command until the output data is first read.
+        Outputs that are never read (for example, a branch of the graph that
+        only generates urls) will never be compiled. Note that errors from the
+        command will then be raised by whatever reads the data. (default
+        False)
+    daemon : bool, optional
+        If True, compile files by sending them to long-lived worker processes
+        instead of starting a new process for every file. The workers are
+        shared by all nodes with the same worker command, kept alive between
+        runs, and restarted if they crash. Requires the subclass to implement
+        :meth:`~.get_worker_command`. (default False)
+    workers : int, optional
+        The number of worker processes to start when ``daemon`` is True
+        (default 1)
+
+    Attributes
+    ----------
+    ext : str
+        If not None, change the extension of each file to this after
+        compiling it.
+    worker : str
+        Name of the worker script in ``pike/js`` used by the default
+        :meth:`~.get_worker_command`
+
+    """
+    ext = None
+    worker = None
+
+    def __init__(self, lazy=False, daemon=False, workers=1):
+        super(CompilerNode, self).__init__()
+        self.lazy = lazy
+        self.daemon = daemon
+        self.workers = workers
+
+    def get_command(self, item):
+        """
+        Get the command to run on a file.
+
+        The file data will be passed to the command via stdin.
+
+        Parameters
+        ----------
+        item : :class:`~pike.items.FileMeta`
+
+        Returns
+        -------
+        cmd : list
+            The command to run
+        cwd : str or None
+            The directory to run the command from
+
+        """
+        raise NotImplementedError
+
+    def get_worker_command(self):
+        """
+        Get the command that starts a worker process.
+
+        The worker must implement the protocol in :mod:`pike.daemon`. It will
+        be sent requests with 'source', 'filename', and 'cwd' keys and must
+        respond with the compiled file in the 'output' key.
+
+        Returns
+        -------
+        cmd : list
+
+        """
+        if self.worker is None:
+            raise NotImplementedError("%s has no worker" % self)
+        return ['node', worker_script(self.worker)]
+
+    def get_pool(self):
+        """ Get the :class:`~pike.daemon.WorkerPool` for this node """
+        return get_pool(self.get_worker_command(), self.workers)
+
+    def get_dependencies(self, item):
+        """
+        Get the other files that the command will read for a file.
+
+        The digests of these files are part of the key used by the
+        :class:`~pike.cmdcache.CommandCache`, and any upstream
+        :class:`~pike.nodes.watch.ChangeListenerNode` will treat the file as
+        changed when one of them changes.
+
+        Parameters
+        ----------
+        item : :class:`~pike.items.FileMeta`
+
+        Returns
+        -------
+        dependencies : list
+            List of absolute file paths
+
+        """
+        return []
+
+    def get_cache_context(self, item):
+        """
+        Get any values other than the file data that the output depends on.
+
+        These are added to the key used by the
+        :class:`~pike.cmdcache.CommandCache`. By default this is the digest
+        of each file from :meth:`~.get_dependencies`.
+
+        Parameters
+        ----------
+        item : :class:`~pike.items.FileMeta`
+
+        Returns
+        -------
+        context : list
+            List of JSON-serializable values
+
+        """
+        return [(path, FileDataFile(path).digest()) for path in
+                self.get_dependencies(item)]
+
+    def _listeners(self):
+        """ Find all ChangeListenerNodes upstream of this node """
+        listeners = []
+        seen = set()
+        stack = [edge.n1 for edge in self.ein]
+        while stack:
+            node = stack.pop()
+            if node is None or id(node) in seen:
+                continue
+            seen.add(id(node))
+            if isinstance(node, ChangeListenerNode):
+                listeners.append(node)
+            else:
+                stack.extend(edge.n1 for edge in node.ein)
+        return listeners
+
+    def record_dependencies(self, items):
+        """
+        Report the dependencies of files to upstream change listeners.
+
+        Parameters
+        ----------
+        items : list
+            List of :class:`~pike.items.FileMeta` that have not been compiled
+            yet
+
+        """
+        listeners = self._listeners()
+        if not listeners:
+            return
+        dependencies = dict((item.fullpath, self.get_dependencies(item))
+                            for item in items)
+        for listener in listeners:
+            listener.set_dependencies(dependencies)
+
+    def process(self, stream):
+        items = list(stream)
+        self.record_dependencies(items)
+        compilers = [self._compiler(item) for item in items]
+        if self.lazy:
+            outputs = [FileDataLazy(compile_data) for compile_data in
+                       compilers]
+        else:
+            outputs = [FileDataBlob(output) for output in
+                       CommandPool().map(lambda fxn: fxn(), compilers)]
+        for item, data in zip(items, outputs):
+            self._set_output(item, data)
+        return items
+
+    def process_one(self, item):
+        compile_data = self._compiler(item)
+        if self.lazy:
+            data = FileDataLazy(compile_data)
+        else:
+            data = FileDataBlob(compile_data())
+        self._set_output(item, data)
+        return item
 
+    def _set_output(self, item, data):
+        """ Replace the data of an item with the compiled output """
+        item.data = data
+        if self.ext is not None:
+            item.setext(self.ext)
+
+    def _compiler(self, item):
+        """ Create a function that compiles the item and returns the output """
+        cmd, cwd = self.get_command(item)
+        data = item.data
+        cache = CommandCache.current()
+        if self.daemon:
+            pool = self.get_pool()
+            request = {'filename': item.fullpath, 'cwd': cwd}
+
+            def compile_data():
+                """ Send the file data to a worker """
+                request['source'] = to_text(data.read())
+                return pool.request(request)['output'].encode('utf-8')
+        else:
+            def compile_data():
+                """ Run the command on the file data """
+                return run_cmd(cmd, data.read(), cwd=cwd)
+        if cache is not None:
+            compile_data = self._cached(cache, compile_data, cmd, cwd, item)
+        return compile_data
+
+    def _cached(self, cache, compile_data, cmd, cwd, item):
+        """ Wrap a compile function so it uses a CommandCache """
+        # Copy the item in case it is changed before it is compiled
+        item = FileMeta(item.filename, item.path, item.data)
+
+        def cached_compile():
+            """ Look up the output in the cache before compiling """
+            key = cache.key(cmd, cwd, item.data.digest(),
+                            self.get_cache_context(item))
+            output = cache.get(key)
+            if output is None:
+                output = compile_data()
+                cache.put(key, output)
+            return output
+        return cached_compile
+
+
+def find_imports(filename, data, ext, include_paths=()):
+    """
+    Find all files that are imported by a CSS or LESS file.
+
+    This follows ``@import`` statements recursively. Imports that cannot be
+    found on disk are ignored.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file
+    data : str
+        Contents of the file
+    ext : str
+        Extension to add to imports that have none. In LESS files ('.less'),
+        imports of '.css' files are not followed.
+    include_paths : list, optional
+        Other directories to search for imports
+
+    Returns
+    -------
+    imports : list
+        Absolute paths of all the imported files
+
+    """
+    filename = os.path.abspath(filename)
+    found = OrderedDict()
+    stack = [(filename, data)]
+    while stack:
+        current, text = stack.pop()
+        if not isinstance(text, six.text_type):
+            text = to_bytes(text).decode('utf-8', 'replace')
+        for match in IMPORT_RE.finditer(text):
+            name = match.group(1)
+            if '://' in name or name.startswith('//'):
+                continue
+            if not os.path.splitext(name)[1]:
+                name += ext
+            elif ext != '.css' and name.endswith('.css'):
+                continue
+            dirs = [os.path.dirname(current)] + list(include_paths)
+            for dirname in dirs:
+                path = os.path.abspath(os.path.join(dirname, name))
+                if os.path.isfile(path):
+                    break
+            else:
+                continue
+            if path == filename or path in found:
+                continue
+            found[path] = True
+            with open(path, 'rb') as ifile:
+                stack.append((path, ifile.read()))
+    return list(found)
+
+
+def coffee_with_map(item, tmp):
+    """
+    Compile a coffeescript file into javascript and a source map.
+
+    Parameters
+    ----------
+    item : :class:`~pike.items.FileMeta`
+        The coffeescript file
+    tmp : str
+        Temporary directory to compile the file in
+
+    Returns
+    -------
+    js : str
+    map : str
+
+    """
+    return coffee_with_maps([item], tmp)[0]
 
-class CoffeeNode(Node):
+
+def coffee_with_maps(items, tmp, batch_size=COFFEE_BATCH_SIZE):
+    """
+    Compile many coffeescript files into javascript and source maps.
+
+    The files are written into a temporary directory tree and each directory
+    is compiled with as few ``coffee`` commands as possible.
+
+    Parameters
+    ----------
+    items : list
+        List of :class:`~pike.items.FileMeta` coffeescript files
+    tmp : str
+        Temporary directory to compile the files in
+    batch_size : int, optional
+        Maximum number of files to pass to a single ``coffee`` command
+        (default 100)
+
+    Returns
+    -------
+    compiled : list
+        List of (js, map) tuples in the same order as ``items``
+
+    """
+    bases = []
+    batches = OrderedDict()
+    used = set()
+    for i, item in enumerate(items):
+        fullpath = os.path.join(tmp, item.filename)
+        if fullpath in used:
+            # Files from different sources may have the same name
+            fullpath = os.path.join(tmp, '_%d' % i, item.filename)
+        used.add(fullpath)
+        item.data.as_file(fullpath)
+        root, filename = os.path.split(fullpath)
+        batches.setdefault(root, []).append(filename)
+        bases.append(os.path.splitext(fullpath)[0])
+
+    commands = []
+    for root, filenames in six.iteritems(batches):
+        for i in range(0, len(filenames), batch_size):
+            commands.append((['coffee', '-c', '-m'] +
+                             filenames[i:i + batch_size], root))
+    CommandPool().map(lambda args: run_cmd(args[0], cwd=args[1]), commands)
+
+    compiled = []
+    for base in bases:
+        with open(base + '.js', 'rb') as ifile:
+            js = ifile.read()
+        with open(base + '.map', 'rb') as ifile:
+            sourcemap = ifile.read()
+        compiled.append((js, sourcemap))
+    return compiled
+
+
+class CoffeeNode(CompilerNode):
 
     """
     Run the Coffeescript compiler.
@@ -21,70 +397,104 @@ class CoffeeNode(Node):
         If True, will produce two named outputs in addition to the compiled
         javascript: 'map' which will contain the map files, and 'coffee' which
         will contain the original coffeescript files. (default True)
+    lazy : bool, optional
+        See :class:`~.CompilerNode`. With ``maps=True``, each file is compiled
+        once when either its javascript or its map is first read.
+    daemon : bool, optional
+        See :class:`~.CompilerNode`
+    workers : int, optional
+        See :class:`~.CompilerNode`
 
     """
     name = 'coffee'
+    ext = '.js'
+    worker = 'coffee.js'
 
-    def __init__(self, maps=True):
-        super(CoffeeNode, self).__init__()
+    def __init__(self, maps=True, lazy=False, daemon=False, workers=1):
+        super(CoffeeNode, self).__init__(lazy, daemon, workers)
         self.maps = maps
         if maps:
             self.outputs = ('default', 'map', 'coffee')
 
+    def get_command(self, item):
+        return ['coffee', '-p', '-s'], None
+
     def process(self, stream):
-        if self.maps:
-            maps = []
-            js_files = []
-            coffee = []
-            with tempd() as tmp:
-                for item in stream:
-                    fullpath = os.path.join(tmp, item.filename)
-                    root, filename = os.path.split(fullpath)
-
-                    cmd = ['coffee', '-c', '-m', filename]
-                    item.data.as_file(fullpath)
-                    run_cmd(cmd, cwd=root)
-
-                    coffee.append(item)
-
-                    js_item = FileMeta(item.filename, item.path)
-                    js_item.setext('.js')
-                    with open(os.path.join(tmp, js_item.filename), 'r') as ifile:
-                        js_item.data = FileDataBlob(ifile.read())
-                    js_files.append(js_item)
-
-                    mapfile = FileMeta(item.filename, item.path)
-                    mapfile.setext('.map')
-                    with open(os.path.join(tmp, mapfile.filename), 'r') as ifile:
-                        mapfile.data = FileDataBlob(ifile.read())
-                    maps.append(mapfile)
-            return {
-                'default': js_files,
-                'map': maps,
-                'coffee': coffee,
-            }
-        else:
-            ret = []
-            cmd = ['coffee', '-p', '-s']
+        if not self.maps:
+            return super(CoffeeNode, self).process(stream)
+        maps = []
+        js_files = []
+        coffee = []
+        if self.lazy:
             for item in stream:
-                item.data = FileDataBlob(run_cmd(cmd, item.data.read()))
-                item.setext('.js')
-                ret.append(item)
-            return ret
-
-    def process_one(self, item):
-        if self.maps:
-            item.data.as_file(item.filename)
-            cmd = ['coffee', '-m', item.filename]
-
+                compiled = self._lazy_compile(item)
+                coffee.append(item)
+                js_files.append(self._output(item, '.js', compiled, 0))
+                maps.append(self._output(item, '.map', compiled, 1))
         else:
-            cmd = ['coffee', '-p', '-s']
-            item.data = FileDataBlob(run_cmd(cmd, item.data.read()))
-        item.setext('.js')
-        return item
-
-
-class LessNode(Node):
+            coffee = list(stream)
+            with tempd() as tmp:
+                if self.daemon:
+                    compiled = CommandPool(self.workers).map(
+                        lambda item: self._compile_with_map(item, tmp),
+                        coffee)
+                else:
+                    compiled = coffee_with_maps(coffee, tmp)
+            for item, (js, sourcemap) in zip(coffee, compiled):
+                js_item = FileMeta(item.filename, item.path,
+                                   sources=getattr(item, 'sources', None))
+                js_item.setext('.js')
+                js_item.data = FileDataBlob(js)
+                js_files.append(js_item)
+
+                mapfile = FileMeta(item.filename, item.path,
+                                   sources=getattr(item, 'sources', None))
+                mapfile.setext('.map')
+                mapfile.data = FileDataBlob(sourcemap)
+                maps.append(mapfile)
+        return {
+            'default': js_files,
+            'map': maps,
+            'coffee': coffee,
+        }
+
+    def _compile_with_map(self, item, tmp):
+        """ Compile a file into javascript and a source map """
+        if not self.daemon:
+            return coffee_with_map(item, tmp)
+        response = self.get_pool().request({
+            'source': to_text(item.data.read()),
+            'filename': item.filename,
+            'map': True,
+        })
+        return (response['output'].encode('utf-8'),
+                response['map'].encode('utf-8'))
+
+    def _lazy_compile(self, item):
+        """ Create a function that compiles the item at most once """
+        # Copy the item in case it is changed before it is compiled
+        item = FileMeta(item.filename, item.path, item.data)
+        result = []
+
+        def compile_item():
+            """ Compile the coffeescript and memoize the result """
+            if not result:
+                with tempd() as tmp:
+                    result.extend(self._compile_with_map(item, tmp))
+            return result
+        return compile_item
+
+    @staticmethod
+    def _output(item, ext, compiled, index):
+        """ Create an output item with lazy data from a compiled result """
+        output = FileMeta(item.filename, item.path,
+                          sources=getattr(item, 'sources', None))
+        output.setext(ext)
+        output.data = FileDataLazy(lambda: compiled()[index])
+        return output
+
+
+class LessNode(CompilerNode):
 
     """
     Run the LESS CSS compiler.
@@ -93,16 +503,18 @@ class LessNode(Node):
 
     """
     name = 'less'
+    ext = '.css'
+    worker = 'less.js'
 
-    def process_one(self, item):
-        cmd = ['lessc', '-']
-        path = os.path.dirname(item.fullpath)
-        item.data = FileDataBlob(run_cmd(cmd, item.data.read(), cwd=path))
-        item.setext('.css')
-        return item
+    def get_command(self, item):
+        return ['lessc', '-'], os.path.dirname(item.fullpath)
 
+    def get_dependencies(self, item):
+        cwd = os.path.dirname(item.fullpath)
+        return find_imports(item.fullpath, item.data.read(), '.less', [cwd])
 
-class UglifyNode(Node):
+
+class UglifyNode(CompilerNode):
 
     """
     Run Uglifyjs
@@ -111,27 +523,27 @@ class UglifyNode(Node):
 
     """
     name = 'uglifyjs'
+    worker = 'uglifyjs.js'
 
-    def process_one(self, item):
-        cmd = ['uglifyjs', '-']
-        path = os.path.dirname(item.fullpath)
-        item.data = FileDataBlob(run_cmd(cmd, item.data.read(), cwd=path))
-        return item
+    def get_command(self, item):
+        return ['uglifyjs', '-'], os.path.dirname(item.fullpath)
 
 
-class CleanCssNode(Node):
+class CleanCssNode(CompilerNode):
     """
     Run cleancss
 
     Requires clean-css to be installed (npm install -g clean-css)
 
     """
+    worker = 'cleancss.js'
 
-    def process_one(self, item):
+    def get_command(self, item):
         path = os.path.dirname(item.fullpath)
-        cmd = ['cleancss', '--root', path]
-        item.data = FileDataBlob(run_cmd(cmd, item.data.read(), cwd=path))
-        return item
+        return ['cleancss', '--root', path], path
+
+    def get_dependencies(self, item):
+        return find_imports(item.fullpath, item.data.read(), '.css')
 
 
 class RewriteCssNode(Node):
@@ -167,3 +579,97 @@ class RewriteCssNode(Node):
             text = re.sub(pattern, replace, item.data.read(), re.M | re.S)
         item.data = FileDataBlob(text)
         return item
+
+
+# Tokens for CssNode. Strings and url() are matched whole so their contents
+# are never minified.
+CSS_TOKEN_RE = re.compile(r"""
+    (?P<comment>/\*.*?(?:\*/|$))
+  | (?P<url>url\(\s*(?P<url_value>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'
+                                  |[^)\s]*)\s*\))
+  | (?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')
+  | (?P<space>\s+)
+  | (?P<other>[^\s/"'uU]+|.)
+""", re.X | re.S | re.I)
+# Whitespace is not needed after these characters
+CSS_NO_SPACE_AFTER = set('{};,>(:')
+# Whitespace is not needed before these characters
+CSS_NO_SPACE_BEFORE = set('{};,>)!')
+
+
+class CssNode(Node):
+
+    """
+    Rewrite urls and minify CSS in a single pass, without a subprocess.
+
+    Relative ``url()`` references are rewritten like
+    :class:`~.RewriteCssNode`. Minifying removes comments (except those that
+    begin with ``/*!``) and unnecessary whitespace, which is less thorough
+    than :class:`~.CleanCssNode`.
+
+    Parameters
+    ----------
+    prefix : str, optional
+        If ``absolute`` is False, replace the directory of each url with this
+        prefix (default '')
+    absolute : bool, optional
+        If True, rewrite each url to be relative to the root of the assets
+        instead of the css file. If False, use ``prefix``. (default True)
+    minify : bool, optional
+        If True, strip comments and whitespace (default True)
+
+    """
+    name = 'css'
+
+    def __init__(self, prefix='', absolute=True, minify=True):
+        super(CssNode, self).__init__()
+        self.prefix = prefix.strip('/')
+        if self.prefix:
+            self.prefix += '/'
+        self.absolute = absolute
+        self.minify = minify
+
+    def rewrite_url(self, item, url):
+        """ Get the rewritten url for a reference inside a css file """
+        if (not url or url.startswith(('/', '#', 'data:')) or
+                '://' in url):
+            return url
+        if self.absolute:
+            filepath = posixpath.dirname(item.filename)
+            return posixpath.normpath(posixpath.join(filepath, url))
+        return self.prefix + posixpath.basename(url)
+
+    def process_one(self, item):
+        text = to_text(item.data.read())
+        output = []
+        pending_space = False
+        for match in CSS_TOKEN_RE.finditer(text):
+            kind = match.lastgroup
+            token = match.group(kind)
+            if kind == 'comment':
+                if self.minify and not token.startswith('/*!'):
+                    continue
+            elif kind == 'space':
+                if self.minify:
+                    pending_space = True
+                    continue
+            elif kind == 'url':
+                value = match.group('url_value')
+                if value[:1] in ('"', "'"):
+                    value = value[1:-1]
+                token = "url('%s')" % self.rewrite_url(item, value)
+            elif kind == 'other' and self.minify:
+                # The last semicolon in a block is not needed
+                token = token.replace(';}', '}')
+                if token[0] == '}' and output and output[-1][-1] == ';':
+                    output[-1] = output[-1][:-1]
+                    if not output[-1]:
+                        output.pop()
+            if pending_space:
+                pending_space = False
+                if (output and output[-1][-1] not in CSS_NO_SPACE_AFTER and
+                        token[0] not in CSS_NO_SPACE_BEFORE):
+                    output.append(' ')
+            output.append(token)
+        item.data = FileDataBlob(''.join(output).encode('utf-8'))
+        return item
@@ -1,13 +1,39 @@
 """ Simple standard nodes. """
 import itertools
+import json
 import os
 import posixpath
 
+import atexit
+
+import bz2
+import gzip
+import logging
 import six
+from multiprocessing.pool import ThreadPool
+import tempfile
+from six import BytesIO
 
 from .base import Node
-from pike.items import FileMeta, FileDataBlob
-from pike.util import resource_spec, md5stream
+from pike import sourcemap
+from pike.items import (FileMeta, FileDataFile, FileDataBlob, FileDataConcat,
+                        CHUNK_SIZE, spool_chunks)
+from pike.sqlitedict import SqliteDict
+from pike.util import (resource_spec, makedirs, fsync_dir, atomic_open,
+                       to_text, DEFAULT_COPY_METHODS)
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict  # pylint: disable=F0401
+
+try:
+    import lzma  # pylint: disable=F0401
+except ImportError:
+    lzma = None
+
+
+LOG = logging.getLogger(__name__)
 
 
 class MergeNode(Node):
@@ -28,7 +54,8 @@ class MergeNode(Node):
     name = 'merge'
 
     def process(self, *args):
-        return itertools.chain(*args)
+        # Return a list so the stream can be shared and read more than once
+        return list(itertools.chain(*args))
 
 
 class ConcatNode(Node):
@@ -42,22 +69,229 @@ class ConcatNode(Node):
         The name of the file to generate
     joinstr : str, optional
         The character to use for joining the files together (default '\\n')
+    incremental : bool, optional
+        If True, write the output to a file and keep an index of the offset
+        and digest of every part inside it. Parts that have not changed are
+        copied from the previous output instead of being read again.
+        (default False)
+    partial : bool, optional
+        Same as ``incremental``. A partial :meth:`~pike.env.watch_graph`
+        passes in every file of the output when any one of them changes, so
+        the output always contains exactly the files in the stream.
+        (default False)
+    maps : bool, optional
+        If True, accept a 'maps' input with the source maps of the files and
+        produce a 'map' output with a single combined source map. Each
+        file's map is matched by name (``foo.js`` uses ``foo.map``) and its
+        mappings are shifted to the file's position in the output. The
+        ``sourceMappingURL`` comment of each file is removed, and a single
+        one that points to the combined map is added to the end of the
+        output. (default False)
+    cache : str, optional
+        Name of the file to store the index in. The incremental output will be
+        stored next to it. By default will store the index in memory and the
+        output in a temporary file.
+    key : str, optional
+        Table name to use inside the ``cache`` file. Must be present if
+        ``cache`` is non-None.
+
+    Attributes
+    ----------
+    reused : int
+        The number of parts copied from the previous output during the last
+        run
 
     """
     name = 'concat'
 
-    def __init__(self, filename, joinstr='\n'):
+    def __init__(self, filename, joinstr='\n', incremental=False,
+                 partial=False, maps=False, cache=None, key=None):
         super(ConcatNode, self).__init__()
         self.filename = filename
         self.joinstr = joinstr
-
-    def process(self, stream):
-        datas = []
+        self.incremental = incremental or partial
+        self.maps = maps
+        if maps:
+            self.outputs = ('default', 'map')
+        if cache is not None and key is None:
+            raise ValueError("If cache is provided, must provide a key")
+        self.cache = cache
+        self.key = key
+        self._index = None
+        self._output = None
+        self.reused = 0
+
+    @property
+    def index(self):
+        """
+        Mapping that stores the location of each part in the previous output.
+
+        'parts' is a list of (fullpath, digest, offset, length). This is
+        opened lazily so the node can be copied before it is run.
+
+        """
+        if self._index is None:
+            if self.cache is None:
+                self._index = {}
+            else:
+                self._index = SqliteDict(self.cache, self.key,
+                                         autocommit=False, synchronous=0)
+        return self._index
+
+    @property
+    def output(self):
+        """ Path of the file that holds the previous incremental output """
+        if self._output is None:
+            if self.cache is None:
+                fd, self._output = tempfile.mkstemp(prefix='pike-concat-')
+                os.close(fd)
+                atexit.register(_remove_file, self._output)
+            else:
+                self._output = '%s.%s' % (self.cache, self.key)
+        return self._output
+
+    def process(self, stream, maps=None):
+        stream = list(stream)
         ball = FileMeta(self.filename, os.curdir)
-        for item in stream:
-            datas.append(item.data.read())
-        ball.data = FileDataBlob(self.joinstr.join(datas))
-        return [ball]
+        if self.incremental:
+            ball.data = self._splice(stream)
+        elif self.maps:
+            ball.data = spool_chunks(self._iter_output(stream))
+        else:
+            ball.data = FileDataConcat([item.data for item in stream],
+                                       self.joinstr)
+        if not self.maps:
+            return [ball]
+        mapfile = FileMeta(self.filename, os.curdir)
+        mapfile.setext('.map')
+        combined = self._concat_maps(stream, maps or [])
+        mapfile.data = FileDataBlob(json.dumps(combined).encode('utf-8'))
+        return {
+            'default': [ball],
+            'map': [mapfile],
+        }
+
+    @property
+    def footer(self):
+        """ Comment at the end of the output that links to the combined map """
+        if not self.maps:
+            return b''
+        url = os.path.splitext(os.path.basename(self.filename))[0] + '.map'
+        return b'\n' + sourcemap.url_comment(self.filename, url) + b'\n'
+
+    def _chunks(self, item):
+        """ Iterate over the data of one file in the output """
+        chunks = item.data.iter_chunks()
+        if self.maps:
+            # The combined source map replaces the map of each file
+            chunks = sourcemap.strip_url(chunks)
+        return chunks
+
+    def _iter_output(self, stream):
+        """ Iterate over the concatenated data of all files in the stream """
+        joinstr = self.joinstr
+        if isinstance(joinstr, six.text_type):
+            joinstr = joinstr.encode('utf-8')
+        for i, item in enumerate(stream):
+            if i > 0:
+                yield joinstr
+            for chunk in self._chunks(item):
+                yield chunk
+        yield self.footer
+
+    def _concat_maps(self, stream, maps):
+        """ Combine the source maps of all files in the stream """
+        by_name = dict((os.path.splitext(mapfile.fullpath)[0], mapfile)
+                       for mapfile in maps)
+        sections = []
+        line = column = 0
+        for i, item in enumerate(stream):
+            if i > 0:
+                line, column = sourcemap.advance(line, column, self.joinstr)
+            mapfile = by_name.get(os.path.splitext(item.fullpath)[0])
+            if mapfile is not None:
+                data = to_text(mapfile.data.read())
+                sections.append((line, column, json.loads(data)))
+            for chunk in self._chunks(item):
+                line, column = sourcemap.advance(line, column, chunk)
+        return sourcemap.concat_maps(sections,
+                                     posixpath.basename(self.filename))
+
+    def _previous_parts(self):
+        """ Get the parts of the previous output, if it is still intact """
+        parts = self.index.get('parts')
+        footer = self.footer
+        if not parts or self.index.get('footer', b'') != footer:
+            return {}
+        try:
+            size = os.path.getsize(self.output)
+        except os.error:
+            return {}
+        if size != parts[-1][2] + parts[-1][3] + len(footer):
+            return {}
+        return dict((part[0], part) for part in parts)
+
+    def _splice(self, stream):
+        """ Write the output by splicing changed parts into the last one """
+        joinstr = self.joinstr
+        if isinstance(joinstr, six.text_type):
+            joinstr = joinstr.encode('utf-8')
+        previous = self._previous_parts()
+        parts = []
+        offset = 0
+        self.reused = 0
+        old_file = open(self.output, 'rb') if previous else None
+        try:
+            with atomic_open(self.output, 'wb') as ofile:
+                for i, item in enumerate(stream):
+                    if i > 0:
+                        ofile.write(joinstr)
+                        offset += len(joinstr)
+                    digest = item.data.digest()
+                    old = previous.get(item.fullpath)
+                    if old is not None and old[1] == digest:
+                        old_file.seek(old[2])
+                        _copy_range(old_file, ofile, old[3])
+                        length = old[3]
+                        self.reused += 1
+                    else:
+                        length = 0
+                        for chunk in self._chunks(item):
+                            ofile.write(chunk)
+                            length += len(chunk)
+                    parts.append((item.fullpath, digest, offset, length))
+                    offset += length
+                ofile.write(self.footer)
+        finally:
+            if old_file is not None:
+                old_file.close()
+
+        self.index['parts'] = parts
+        self.index['footer'] = self.footer
+        if isinstance(self.index, SqliteDict):
+            self.index.commit()
+        LOG.debug("%s reused %d of %d parts", self, self.reused, len(parts))
+        # The output file is replaced on the next run, so the results need
+        # their own copy
+        return spool_chunks(FileDataFile(self.output).iter_chunks())
+
+
+def _remove_file(path):
+    """ Remove a file if it exists """
+    try:
+        os.remove(path)
+    except os.error:
+        pass
+
+
+def _copy_range(ifile, ofile, length):
+    """ Copy ``length`` bytes from the current position of one file """
+    while length > 0:
+        chunk = ifile.read(min(length, CHUNK_SIZE))
+        if not chunk:
+            break
+        ofile.write(chunk)
+        length -= len(chunk)
 
 
 class UrlNode(Node):
@@ -75,7 +309,8 @@ class UrlNode(Node):
     Notes
     -----
     Using a cache-busting query string may cause your browser to be unable to
-    use source maps.
+    use source maps. :class:`~.FingerprintNode` puts the digest in the
+    filename instead.
 
     """
     name = 'url'
@@ -90,11 +325,61 @@ class UrlNode(Node):
     def process_one(self, item):
         item.url = posixpath.join(self.prefix, item.filename)
         if self.bust:
-            with item.data.open() as stream:
-                item.url += '?' + md5stream(stream)[:8]
+            item.url += '?' + item.data.digest()[:8]
         return item
 
 
+class FingerprintNode(Node):
+
+    """
+    Add the digest of each file to its filename.
+
+    ``app.js`` will be renamed to ``app.3fa9c2d1.js``. Because the name
+    changes whenever the contents do, the files can be served with far-future
+    cache headers. Each renamed file keeps its original name in the
+    ``logical_filename`` attribute, which :class:`~pike.Environment` uses to
+    resolve the original name in :meth:`~pike.Environment.lookup`.
+
+    This node has two outputs: the default, which contains the renamed files,
+    and 'manifest', which contains a single JSON file that maps the original
+    names to the renamed ones.
+
+    Parameters
+    ----------
+    length : int, optional
+        Number of characters of the digest to use (default 8)
+    manifest : str, optional
+        The name of the manifest file (default 'manifest.json')
+
+    """
+    name = 'fingerprint'
+    outputs = ('default', 'manifest')
+
+    def __init__(self, length=8, manifest='manifest.json'):
+        super(FingerprintNode, self).__init__()
+        self.length = length
+        self.manifest = manifest
+
+    def process(self, stream):
+        items = list(stream)
+        mapping = OrderedDict()
+        for item in items:
+            logical = getattr(item, 'logical_filename', None) or item.filename
+            root, ext = posixpath.splitext(logical)
+            item.filename = '%s.%s%s' % (root,
+                                         item.data.digest()[:self.length],
+                                         ext)
+            item.logical_filename = logical
+            mapping[logical] = item.filename
+        manifest = FileMeta(self.manifest, os.curdir)
+        manifest.data = FileDataBlob(json.dumps(mapping, indent=2)
+                                     .encode('utf-8'))
+        return {
+            'default': items,
+            'manifest': [manifest],
+        }
+
+
 class SplitExtNode(Node):
 
     """
@@ -147,24 +432,335 @@ class WriteNode(Node):
         The base directory to write into (default '.')
     debug : bool, optional
         If True, only print filenames, don't actually write (default False)
+    immutable : bool, optional
+        If True, files on disk will never be modified in place, so outputs may
+        be hard links to their source files when possible (default False)
+    copy_methods : list, optional
+        The methods to try, in order, when copying files that are already on
+        disk. See :meth:`~pike.util.copy_file`. By default this will try to
+        copy inside the kernel, and will try hard links first if
+        ``immutable`` is True.
+    skip_unchanged : bool, optional
+        If True, keep a manifest of the digests of all written files and don't
+        rewrite an output if its contents have not changed. This preserves the
+        modification time of unchanged outputs. (default False)
+    cache : str, optional
+        Name of the file to store the manifest in. By default will store the
+        manifest in memory.
+    key : str, optional
+        Table name to use inside the ``cache`` file. Must be present if
+        ``cache`` is non-None.
+
+    threads : int, optional
+        Number of threads to use when writing files (default 1)
+    fsync : bool, optional
+        If True, flush each directory that was written to once all files have
+        been written (default False)
+
+    Attributes
+    ----------
+    written : int
+        The number of files written during the last run
+    skipped : int
+        The number of unchanged files skipped during the last run
 
     """
 
     name = 'write'
 
-    def __init__(self, base_dir=os.curdir, debug=False):
+    def __init__(self, base_dir=os.curdir, debug=False, immutable=False,
+                 copy_methods=None, skip_unchanged=False, cache=None,
+                 key=None, threads=1, fsync=False):
         super(WriteNode, self).__init__()
         self.base_dir = resource_spec(base_dir)
         self.name = 'write(%r)' % self.base_dir
         self.debug = debug
+        if copy_methods is None:
+            copy_methods = DEFAULT_COPY_METHODS
+            if immutable:
+                copy_methods = ('link',) + copy_methods
+        self.copy_methods = tuple(copy_methods)
+        self.skip_unchanged = skip_unchanged
+        if cache is not None and key is None:
+            raise ValueError("If cache is provided, must provide a key")
+        self.cache = cache
+        self.key = key
+        self._manifest = None
+        self.threads = threads
+        self.fsync = fsync
+        self.written = 0
+        self.skipped = 0
+
+    @property
+    def manifest(self):
+        """
+        Mapping of output file paths to (digest, size, mtime).
+
+        This is opened lazily so the node can be copied before it is run.
+
+        """
+        if self._manifest is None:
+            if self.cache is None:
+                self._manifest = {}
+            else:
+                self._manifest = SqliteDict(self.cache, self.key,
+                                            autocommit=False, synchronous=0)
+        return self._manifest
 
-    def process_one(self, item):
-        item.path = self.base_dir
+    def process(self, stream):
+        items = list(stream)
+        for item in items:
+            item.path = self.base_dir
         if self.debug:
-            six.print_("Output file: %s" % item.fullpath)
+            for item in items:
+                six.print_("Output file: %s" % item.fullpath)
+            return items
+
+        # Open the manifest before the threads start, so they share it
+        manifest = self.manifest if self.skip_unchanged else None
+
+        # Create all the output directories up front
+        dirnames = set(os.path.dirname(item.fullpath) for item in items)
+        for dirname in sorted(dirnames):
+            makedirs(dirname)
+
+        if self.threads > 1 and len(items) > 1:
+            pool = ThreadPool(min(self.threads, len(items)))
+            try:
+                results = pool.map(self._write, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._write(item) for item in items]
+
+        if self.fsync:
+            for dirname in dirnames:
+                fsync_dir(dirname)
+
+        self.written = self.skipped = 0
+        for item, entry in zip(items, results):
+            if entry is None:
+                self.skipped += 1
+            else:
+                self.written += 1
+                if self.skip_unchanged:
+                    manifest[item.fullpath] = entry
+        if self.skip_unchanged:
+            if isinstance(manifest, SqliteDict):
+                manifest.commit()
+            LOG.info("%s wrote %d files, skipped %d unchanged", self,
+                     self.written, self.skipped)
+        return items
+
+    def _write(self, item):
+        """
+        Write a single item to disk.
+
+        Returns
+        -------
+        entry : tuple or None
+            None if the write was skipped, otherwise the manifest entry for
+            the written file.
+
+        """
+        if self.skip_unchanged:
+            digest = item.data.digest()
+            if self._is_unchanged(item.fullpath, digest):
+                return None
+        if isinstance(item.data, FileDataFile):
+            item.data.as_file(item.fullpath, self.copy_methods)
         else:
             item.data.as_file(item.fullpath)
-        return item
+        if self.skip_unchanged:
+            stat = os.stat(item.fullpath)
+            return (digest, stat.st_size, stat.st_mtime)
+        return ()
+
+    def _is_unchanged(self, fullpath, digest):
+        """ Check if an output file already exists with this digest """
+        entry = self.manifest.get(fullpath)
+        if entry is None or entry[0] != digest:
+            return False
+        try:
+            stat = os.stat(fullpath)
+        except os.error:
+            return False
+        # If the output was modified by something else, rewrite it
+        return (stat.st_size, stat.st_mtime) == tuple(entry[1:])
+
+
+def _gzip(data):
+    """ Compress data with gzip """
+    buf = BytesIO()
+    # Use a fixed mtime so the output only depends on the data
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as ofile:
+        ofile.write(data)
+    return buf.getvalue()
+
+
+def _bz2(data):
+    """ Compress data with bzip2 """
+    return bz2.compress(data, 9)
+
+
+def _xz(data):
+    """ Compress data with xz """
+    return lzma.compress(data, preset=9)
+
+
+COMPRESSORS = {
+    'gz': _gzip,
+    'bz2': _bz2,
+    'xz': _xz,
+}
+
+
+class CompressNode(Node):
+
+    """
+    Add precompressed copies of text files.
+
+    For each file whose extension is in ``extensions`` and is at least
+    ``min_size`` bytes, a sibling file will be added to the output for each
+    format (e.g. ``app.js.gz``). The original files are passed through
+    unchanged.
+
+    Parameters
+    ----------
+    formats : list, optional
+        The compression formats to generate. May contain 'gz', 'bz2', and
+        'xz' ('xz' requires python 3). (default ('gz',))
+    min_size : int, optional
+        Don't compress files smaller than this many bytes (default 1024)
+    extensions : list, optional
+        Only compress files with these extensions (default
+        :attr:`~.TEXT_EXTENSIONS`)
+    threads : int, optional
+        Number of threads to compress files with (default 4)
+    cache : str, optional
+        Name of the file to store compressed data in. Files whose digest has
+        not changed since the last run will not be compressed again. By
+        default this will be stored in memory.
+    key : str, optional
+        Table name to use inside the ``cache`` file. Must be present if
+        ``cache`` is non-None.
+
+    Attributes
+    ----------
+    compressed : int
+        The number of files compressed during the last run
+    reused : int
+        The number of unchanged files that were not compressed again during
+        the last run
+
+    """
+    name = 'compress'
+    TEXT_EXTENSIONS = ('.js', '.css', '.html', '.htm', '.json', '.map',
+                       '.svg', '.txt', '.xml')
+
+    def __init__(self, formats=('gz',), min_size=1024, extensions=None,
+                 threads=4, cache=None, key=None):
+        super(CompressNode, self).__init__()
+        for fmt in formats:
+            if fmt not in COMPRESSORS:
+                raise ValueError("Unknown compression format %r" % fmt)
+            if fmt == 'xz' and lzma is None:
+                raise ValueError("xz compression requires the lzma module")
+        self.formats = tuple(formats)
+        self.min_size = min_size
+        if extensions is None:
+            extensions = self.TEXT_EXTENSIONS
+        self.extensions = tuple(extensions)
+        self.threads = threads
+        if cache is not None and key is None:
+            raise ValueError("If cache is provided, must provide a key")
+        self.cache = cache
+        self.key = key
+        self._outputs = None
+        self.compressed = 0
+        self.reused = 0
+
+    @property
+    def outputs_cache(self):
+        """
+        Mapping of compressed file paths to (digest, data).
+
+        This is opened lazily so the node can be copied before it is run.
+
+        """
+        if self._outputs is None:
+            if self.cache is None:
+                self._outputs = {}
+            else:
+                self._outputs = SqliteDict(self.cache, self.key,
+                                           autocommit=False, synchronous=0)
+        return self._outputs
+
+    def process(self, stream):
+        items = list(stream)
+        tasks = []
+        for item in items:
+            ext = os.path.splitext(item.filename)[1].lower()
+            if ext not in self.extensions:
+                continue
+            if item.data.size() < self.min_size:
+                continue
+            for fmt in self.formats:
+                tasks.append((item, fmt))
+
+        if self.threads > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(self.threads, len(tasks)))
+            try:
+                results = pool.map(self._compress, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._compress(task) for task in tasks]
+
+        self.compressed = self.reused = 0
+        siblings = []
+        for (item, fmt), (digest, data, reused) in zip(tasks, results):
+            sibling = FileMeta(item.filename + '.' + fmt, item.path,
+                               FileDataBlob(data),
+                               sources=getattr(item, 'sources', None))
+            siblings.append(sibling)
+            if reused:
+                self.reused += 1
+            else:
+                self.compressed += 1
+                self.outputs_cache[sibling.fullpath] = (digest, data)
+        if self.compressed and isinstance(self.outputs_cache, SqliteDict):
+            self.outputs_cache.commit()
+        LOG.debug("%s compressed %d files, reused %d", self, self.compressed,
+                  self.reused)
+        return items + siblings
+
+    def _compress(self, task):
+        """
+        Compress a file into one format.
+
+        Returns
+        -------
+        digest : str
+            Digest of the uncompressed data
+        data : str
+            The compressed data
+        reused : bool
+            True if the data was reused from the last run
+
+        """
+        item, fmt = task
+        digest = item.data.digest()
+        fullpath = item.fullpath + '.' + fmt
+        previous = self.outputs_cache.get(fullpath)
+        if previous is not None and previous[0] == digest:
+            return digest, previous[1], True
+        with item.data.open() as ifile:
+            data = ifile.read()
+        return digest, COMPRESSORS[fmt](data), False
 
 
 class FilterNode(Node):
@@ -1,6 +1,8 @@
 """ Nodes that read files. """
+import os
+
 from .base import Node
-from pike.items import FileMeta
+from pike.items import FileMeta, FileDataMmap
 from pike.util import recursive_glob, resource_spec
 
 
@@ -12,16 +14,34 @@ class SourceNode(Node):
     Source nodes are nodes that read files from disk and inject them into a
     graph.
 
+    Parameters
+    ----------
+    root : str
+        The root directory of the source files
+    mmap_threshold : int, optional
+        Files at least this many bytes large will be memory-mapped instead of
+        read into memory (see :class:`~pike.items.FileDataMmap`). If None,
+        never memory-map files. (default 1MB)
+
     """
 
     name = 'source'
 
-    def __init__(self, root):
+    def __init__(self, root, mmap_threshold=1024 * 1024):
         super(SourceNode, self).__init__()
         self.root = resource_spec(root)
+        self.mmap_threshold = mmap_threshold
 
     def process(self):
-        return [FileMeta(filename, self.root) for filename in self.files()]
+        return [self.make_item(filename) for filename in self.files()]
+
+    def make_item(self, filename):
+        """ Construct a :class:`~pike.items.FileMeta` for a source file """
+        if self.mmap_threshold is not None:
+            fullpath = os.path.join(self.root, filename)
+            if os.path.getsize(fullpath) >= self.mmap_threshold:
+                return FileMeta(filename, self.root, FileDataMmap(fullpath))
+        return FileMeta(filename, self.root)
 
     def files(self):
         """
@@ -37,14 +57,15 @@ class GlobNode(SourceNode):
     """
     Source node that creates a stream of files via glob matching.
 
-    The parameters are the same as :meth:`~pike.util.recursive_glob`
+    The parameters are the same as :meth:`~pike.util.recursive_glob`, plus
+    the ``mmap_threshold`` from :class:`~.SourceNode`.
 
     """
 
     name = 'glob_source'
 
-    def __init__(self, root, patterns, prefix=''):
-        super(GlobNode, self).__init__(root)
+    def __init__(self, root, patterns, prefix='', mmap_threshold=1024 * 1024):
+        super(GlobNode, self).__init__(root, mmap_threshold)
         self.patterns = patterns
         self.prefix = prefix
         prefix_arg = ', %r' % prefix if prefix else ''
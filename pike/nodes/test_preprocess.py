@@ -0,0 +1,306 @@
+""" Tests for pike.nodes.preprocess """
+import json
+import os
+import subprocess
+import sys
+
+from mock import patch
+
+import pike
+from pike.cmdcache import CommandCache
+from pike.items import FileMeta, FileDataBlob, FileDataLazy
+from pike.nodes import CompilerNode
+from pike.nodes.preprocess import coffee_with_maps, find_imports
+from pike.test import BaseFileTest, unittest
+
+
+class UpperNode(CompilerNode):
+
+    """ Compiler node that upper-cases files with a python subprocess """
+
+    name = 'upper'
+    ext = '.txt'
+
+    def get_command(self, item):
+        return [sys.executable, '-c', 'import sys; '
+                'sys.stdout.write(sys.stdin.read().upper())'], None
+
+
+class UpperImportNode(UpperNode):
+
+    """ Compiler node that depends on LESS imports """
+
+    def get_dependencies(self, item):
+        return find_imports(item.fullpath, item.data.read(), '.less')
+
+
+class UpperDaemonNode(UpperNode):
+
+    """ Compiler node that upper-cases files with a python worker """
+
+    def __init__(self, script, **kwargs):
+        super(UpperDaemonNode, self).__init__(daemon=True, **kwargs)
+        self.script = script
+
+    def get_worker_command(self):
+        return [sys.executable, self.script]
+
+
+UPPER_WORKER = r'''
+import json
+import sys
+
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    sys.stdout.write(json.dumps({'output': request['source'].upper()}))
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+'''
+
+
+FAKE_COFFEE = r'''
+exports.compile = function (source, options) {
+  return {js: 'JS', v3SourceMap: JSON.stringify(options)};
+};
+'''
+
+
+def has_command(name):
+    """ Check if a command can be run """
+    with open(os.devnull, 'w') as devnull:
+        try:
+            subprocess.call([name, '--version'], stdout=devnull,
+                            stderr=devnull)
+        except OSError:
+            return False
+    return True
+
+
+class TestCompilerNode(BaseFileTest):
+
+    """ Tests for the CompilerNode base class """
+
+    def test_compile(self):
+        """ Compiler nodes pipe the file data through the command """
+        self.make_files(foo='abc')
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'foo') | UpperNode()
+        item = graph.run()['default'][0]
+        self.assertEqual(item.filename, 'foo.txt')
+        self.assertEqual(item.data.read(), b'ABC')
+
+    def test_lazy(self):
+        """ Lazy compiler nodes only run the command when data is read """
+        self.make_files(foo='abc')
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'foo') | UpperNode(lazy=True)
+        with patch('pike.nodes.preprocess.run_cmd') as run_cmd:
+            run_cmd.return_value = b'ABC'
+            item = graph.run()['default'][0]
+            self.assertIsInstance(item.data, FileDataLazy)
+            self.assertFalse(run_cmd.called)
+            self.assertEqual(item.data.read(), b'ABC')
+            self.assertEqual(item.data.read(), b'ABC')
+            self.assertEqual(run_cmd.call_count, 1)
+
+    def test_command_cache(self):
+        """ Compiler outputs are reused from the command cache """
+        self.make_files(foo='abc')
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'foo') | UpperNode()
+        cache = CommandCache(os.path.join(self.tempdir, 'cmds'))
+        with patch.object(CommandCache, 'tool_version') as tool_version:
+            tool_version.return_value = '1.0'
+            with cache:
+                graph.run()
+                with patch('pike.nodes.preprocess.run_cmd') as run_cmd:
+                    item = graph.run()['default'][0]
+                    self.assertEqual(item.data.read(), b'ABC')
+                    self.assertFalse(run_cmd.called)
+
+    def test_dependencies(self):
+        """ Changing an import recompiles the files that import it """
+        self.make_files(**{
+            'a.less': '@import "lib";',
+            'b.less': 'b',
+            'lib.less': 'x',
+        })
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'a.less:b.less') | pike.listen() | \
+                UpperImportNode()
+        graph.run()
+        with self.assertRaises(pike.StopProcessing):
+            graph.run()
+        self.make_files(**{'lib.less': 'y'})
+        items = graph.run()['default']
+        self.assertEqual([item.filename for item in items], ['a.txt'])
+
+    def test_daemon(self):
+        """ Daemon compiler nodes send files to a worker process """
+        self.make_files(foo='abc', bar='def', **{'worker.py': UPPER_WORKER})
+        script = os.path.join(self.tempdir, 'worker.py')
+        with pike.Graph('g') as graph:
+            node = pike.glob('.', 'foo:bar') | UpperDaemonNode(script)
+        with patch('pike.nodes.preprocess.run_cmd') as run_cmd:
+            items = graph.run()['default']
+            self.assertFalse(run_cmd.called)
+        node.get_pool().close()
+        self.assertEqual(sorted(item.data.read() for item in items),
+                         [b'ABC', b'DEF'])
+
+
+class TestCoffeeNode(BaseFileTest):
+
+    """ Tests for the CoffeeNode """
+
+    def test_lazy_maps(self):
+        """ Lazy coffee compiles once when either output is read """
+        self.make_files(**{'app.coffee': 'x = 1'})
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*.coffee') | pike.coffee(lazy=True)
+        with patch('pike.nodes.preprocess.coffee_with_map') as compile_map:
+            compile_map.return_value = (b'js', b'map')
+            ret = graph.run()
+            self.assertFalse(compile_map.called)
+            self.assertEqual(ret['default'][0].filename, 'app.js')
+            self.assertEqual(ret['map'][0].data.read(), b'map')
+            self.assertEqual(ret['default'][0].data.read(), b'js')
+            self.assertEqual(compile_map.call_count, 1)
+
+    def test_batch(self):
+        """ Coffee files are compiled in batches per directory """
+        def fake_coffee(cmd, cwd):
+            """ Write a js file and map for each coffee file """
+            for filename in cmd[3:]:
+                base = os.path.join(cwd, os.path.splitext(filename)[0])
+                for ext in ('.js', '.map'):
+                    with open(base + ext, 'w') as ofile:
+                        ofile.write(filename + ext)
+
+        items = [
+            FileMeta('a.coffee', 'src', FileDataBlob(b'a')),
+            FileMeta('b.coffee', 'src', FileDataBlob(b'b')),
+            FileMeta('lib/c.coffee', 'src', FileDataBlob(b'c')),
+            FileMeta('a.coffee', 'other', FileDataBlob(b'a')),
+        ]
+        with patch('pike.nodes.preprocess.run_cmd') as run_cmd:
+            run_cmd.side_effect = fake_coffee
+            compiled = coffee_with_maps(items, self.tempdir, batch_size=1)
+            self.assertEqual(run_cmd.call_count, 4)
+            compiled = coffee_with_maps(items, self.tempdir)
+            self.assertEqual(run_cmd.call_count, 7)
+        self.assertEqual(compiled[0], (b'a.coffee.js', b'a.coffee.map'))
+        self.assertEqual(compiled[2], (b'c.coffee.js', b'c.coffee.map'))
+        self.assertEqual(compiled[3], (b'a.coffee.js', b'a.coffee.map'))
+
+    def compile_daemon(self, item):
+        """ Compile an item with a coffee daemon """
+        node = pike.coffee(daemon=True)
+        try:
+            return node.process([item])
+        finally:
+            node.get_pool().close()
+
+    @unittest.skipUnless(has_command('node'), "node is not installed")
+    def test_daemon_cli_options(self):
+        """ The coffee daemon uses the map options of the coffee CLI """
+        self.make_files(**{'node_modules/coffeescript/index.js': FAKE_COFFEE})
+        node_path = os.path.join(self.tempdir, 'node_modules')
+        with patch.dict(os.environ, NODE_PATH=node_path):
+            ret = self.compile_daemon(
+                FileMeta('lib/app.coffee', 'src', FileDataBlob(b'x = 1')))
+        self.assertEqual(ret['default'][0].data.read(),
+                         b'JS\n//# sourceMappingURL=app.map\n')
+        options = json.loads(ret['map'][0].data.read().decode('utf-8'))
+        self.assertEqual(options['generatedFile'], 'app.js')
+        self.assertEqual(options['sourceFiles'], ['app.coffee'])
+        self.assertEqual(options['sourceRoot'], '')
+        self.assertTrue(options['header'])
+
+    @unittest.skipUnless(has_command('coffee'), "coffee is not installed")
+    def test_daemon_matches_batch(self):
+        """ The coffee daemon produces the same output as the coffee CLI """
+        self.make_files(**{'lib/app.coffee': 'square = (x) -> x * x\n'})
+        batch = pike.coffee().process([FileMeta('lib/app.coffee', '.')])
+        daemon = self.compile_daemon(FileMeta('lib/app.coffee', '.'))
+        for name in ('default', 'map'):
+            self.assertEqual(daemon[name][0].data.read(),
+                             batch[name][0].data.read())
+
+
+class TestImports(BaseFileTest):
+
+    """ Tests for finding LESS and CSS imports """
+
+    def test_find_imports(self):
+        """ Imports are found recursively and resolved to files """
+        self.make_files(**{
+            'app.less': '@import "lib/base";\n@import (reference) "x.less";',
+            'lib/base.less': "@import 'vars';\n@import 'plain.css';",
+            'lib/vars.less': '@import "http://example.com/a.less";',
+            'x.less': '',
+        })
+        with open(os.path.join(self.tempdir, 'app.less'), 'rb') as ifile:
+            data = ifile.read()
+        imports = find_imports(os.path.join(self.tempdir, 'app.less'), data,
+                               '.less')
+        self.assertItemsEqual(imports, [
+            os.path.join(self.tempdir, 'lib', 'base.less'),
+            os.path.join(self.tempdir, 'lib', 'vars.less'),
+            os.path.join(self.tempdir, 'x.less'),
+        ])
+
+    def test_include_paths(self):
+        """ Imports are also searched for in the include paths """
+        self.make_files(**{'inc/vars.less': ''})
+        imports = find_imports(os.path.join(self.tempdir, 'a.less'),
+                               b'@import url("vars");', '.less',
+                               [os.path.join(self.tempdir, 'inc')])
+        self.assertEqual(imports,
+                         [os.path.join(self.tempdir, 'inc', 'vars.less')])
+
+
+class TestCssNode(BaseFileTest):
+
+    """ Tests for the in-process CSS node """
+
+    def css(self, data, filename='css/app.css', **kwargs):
+        """ Run css data through a CssNode """
+        node = pike.css(**kwargs)
+        item = FileMeta(filename, 'src', FileDataBlob(data))
+        return node.process_one(item).data.read()
+
+    def test_minify(self):
+        """ Comments and unneeded whitespace are removed """
+        data = (b'/* header */\na  :hover ,\tb > c {\n  color: red ;\n'
+                b'  margin: 0 auto;\n}\n/*! license */\n'
+                b'@media screen and (max-width: 10px) { p { x: y } }')
+        self.assertEqual(self.css(data),
+                         b'a :hover,b>c{color:red;margin:0 auto}'
+                         b'/*! license */ @media screen and (max-width:10px)'
+                         b'{p{x:y}}')
+
+    def test_strings_untouched(self):
+        """ Strings are not minified """
+        data = b'a { content: "  /* x */ ;}" ; }'
+        self.assertEqual(self.css(data), b'a{content:"  /* x */ ;}"}')
+
+    def test_no_minify(self):
+        """ Minification can be disabled """
+        data = b'a {\n  b: c; /* x */\n}'
+        self.assertEqual(self.css(data, minify=False), data)
+
+    def test_rewrite_absolute(self):
+        """ Relative urls are rewritten relative to the asset root """
+        data = (b'a { b: url(../img/x.png); c: url("y.png"); '
+                b'd: url(data:image/png;base64,AA==); e: url(/z.png) }')
+        self.assertEqual(self.css(data),
+                         b"a{b:url('img/x.png');c:url('css/y.png');"
+                         b"d:url('data:image/png;base64,AA==');"
+                         b"e:url('/z.png')}")
+
+    def test_rewrite_prefix(self):
+        """ Urls can be rewritten to use a prefix """
+        data = b"a { b: url('../img/x.png') }"
+        self.assertEqual(self.css(data, prefix='static', absolute=False),
+                         b"a{b:url('static/x.png')}")
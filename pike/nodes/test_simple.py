@@ -0,0 +1,286 @@
+""" Tests for pike.nodes.simple """
+import bz2
+import gzip
+import json
+import os
+import time
+
+from mock import Mock, patch
+from six import BytesIO
+
+import pike
+from pike.items import FileMeta, FileDataBlob, FileDataMmap
+from pike.nodes import ConcatNode, CompressNode, FingerprintNode
+from pike.nodes.simple import COMPRESSORS
+from pike.sqlitedict import SqliteDict
+from pike.test import BaseFileTest
+
+
+def blob_item(filename, data):
+    """ Create a FileMeta with in-memory data """
+    return FileMeta(filename, 'src', data=FileDataBlob(data))
+
+
+class TestConcat(BaseFileTest):
+
+    """ Tests for the ConcatNode """
+
+    def test_concat(self):
+        """ Concatenating files joins their contents in order """
+        self.make_files(foo='a', bar='b')
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'foo:bar') | pike.concat('out.js')
+        ret = graph.run()
+        self.assertEqual(len(ret['default']), 1)
+        ball = ret['default'][0]
+        self.assertEqual(ball.filename, 'out.js')
+        self.assertEqual(ball.data.read(), b'a\nb')
+
+    def test_incremental(self):
+        """ Incremental concat splices unchanged parts from the last output """
+        node = ConcatNode('out.js', incremental=True)
+        node.process([blob_item('a', b'a'), blob_item('b', b'b')])
+        ball = node.process([blob_item('a', b'a'), blob_item('b', b'bb'),
+                             blob_item('c', b'c')])[0]
+        self.assertEqual(ball.data.read(), b'a\nbb\nc')
+        self.assertEqual(node.reused, 1)
+
+    def test_incremental_old_results(self):
+        """ Results of earlier runs don't change when the output is rebuilt """
+        node = ConcatNode('out.js', incremental=True)
+        first = node.process([blob_item('a', b'a'), blob_item('b', b'b')])[0]
+        node.process([blob_item('a', b'aa'), blob_item('b', b'b')])
+        self.assertEqual(first.data.read(), b'a\nb')
+
+    def test_incremental_removed(self):
+        """ Incremental concat drops parts that are no longer present """
+        node = ConcatNode('out.js', incremental=True)
+        node.process([blob_item('a', b'a'), blob_item('b', b'b')])
+        ball = node.process([blob_item('b', b'b')])[0]
+        self.assertEqual(ball.data.read(), b'b')
+
+    def test_incremental_cache(self):
+        """ The concat index and output can be persisted next to a cache """
+        cache = os.path.join('out', 'cache.db')
+        node = ConcatNode('out.js', partial=True, cache=cache, key='concat')
+        node.process([blob_item('a', b'a'), blob_item('b', b'b')])
+        self.assertNotIn('data', node.index)
+        node = ConcatNode('out.js', partial=True, cache=cache, key='concat')
+        ball = node.process([blob_item('a', b'aa'), blob_item('b', b'b')])[0]
+        self.assertEqual(ball.data.read(), b'aa\nb')
+        self.assertEqual(node.reused, 1)
+
+    def test_incremental_lost_output(self):
+        """ If the previous output is gone, all parts are read again """
+        node = ConcatNode('out.js', incremental=True)
+        node.process([blob_item('a', b'a'), blob_item('b', b'b')])
+        os.remove(node.output)
+        ball = node.process([blob_item('a', b'a'), blob_item('b', b'b')])[0]
+        self.assertEqual(ball.data.read(), b'a\nb')
+        self.assertEqual(node.reused, 0)
+
+    def test_maps(self):
+        """ Concat combines source maps shifted to each file's position """
+        node = ConcatNode('out.js', maps=True)
+        maps = [
+            blob_item('a.map', b'{"version": 3, "sources": ["a.coffee"], '
+                      b'"names": [], "mappings": "AAAA;AACA"}'),
+            blob_item('b.map', b'{"version": 3, "sources": ["b.coffee"], '
+                      b'"names": [], "mappings": "AAAA"}'),
+        ]
+        ret = node.process([blob_item('a.js', b'x\ny'),
+                            blob_item('b.js', b'z')], maps)
+        self.assertEqual(ret['default'][0].data.read(),
+                         b'x\ny\nz\n//# sourceMappingURL=out.map\n')
+        mapfile = ret['map'][0]
+        self.assertEqual(mapfile.filename, 'out.map')
+        combined = json.loads(mapfile.data.read().decode('utf-8'))
+        self.assertEqual(combined['sources'], ['a.coffee', 'b.coffee'])
+        self.assertEqual(combined['mappings'], 'AAAA;AACA;ACDA')
+
+    def test_maps_url_comments(self):
+        """ Concat replaces the map comment of each file with its own """
+        maps = [
+            blob_item('a.map', b'{"version": 3, "sources": ["a.coffee"], '
+                      b'"names": [], "mappings": "AAAA"}'),
+            blob_item('b.map', b'{"version": 3, "sources": ["b.coffee"], '
+                      b'"names": [], "mappings": "AAAA"}'),
+        ]
+        for incremental in (False, True, True):
+            node = ConcatNode('out.js', maps=True, incremental=incremental)
+            ret = node.process(
+                [blob_item('a.js', b'x\n//# sourceMappingURL=a.map\n'),
+                 blob_item('b.js', b'z\n//# sourceMappingURL=b.map')], maps)
+            self.assertEqual(ret['default'][0].data.read(),
+                             b'x\n\nz\n\n//# sourceMappingURL=out.map\n')
+            combined = json.loads(ret['map'][0].data.read().decode('utf-8'))
+            self.assertEqual(combined['mappings'], 'AAAA;;ACAA')
+
+    def test_mmap_maps(self):
+        """ Memory-mapped source maps can be combined """
+        self.make_files(**{
+            'a.js': 'x',
+            'a.map': '{"version": 3, "sources": ["a.coffee"], "names": [], '
+                     '"mappings": "AAAA"}',
+        })
+        node = ConcatNode('out.js', maps=True)
+        items = pike.glob('.', '*.js', mmap_threshold=1).process()
+        maps = pike.glob('.', '*.map', mmap_threshold=1).process()
+        self.assertIsInstance(maps[0].data, FileDataMmap)
+        ret = node.process(items, maps)
+        combined = json.loads(ret['map'][0].data.read().decode('utf-8'))
+        self.assertEqual(combined['sources'], ['a.coffee'])
+
+
+class TestWrite(BaseFileTest):
+
+    """ Tests for the WriteNode """
+
+    def test_write(self):
+        """ Files are written into the base directory """
+        self.make_files(foo='a')
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'foo') | pike.write('out')
+        ret = graph.run()
+        self.assert_files_equal(ret['default'], [os.path.join('out', 'foo')])
+        with open(os.path.join('out', 'foo'), 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'a')
+
+    def test_write_immutable(self):
+        """ Immutable source files are hard linked into the output """
+        self.make_files(foo='a')
+        with pike.Graph('g') as graph:
+            pike.glob('.', 'foo') | pike.write('out', immutable=True)
+        graph.run()
+        self.assertTrue(os.path.samefile('foo', os.path.join('out', 'foo')))
+
+    def test_skip_unchanged(self):
+        """ Unchanged outputs are not rewritten """
+        self.make_files(**{'src/foo': 'a', 'src/bar': 'b'})
+        with pike.Graph('g') as graph:
+            write = pike.write('out', skip_unchanged=True)
+            pike.glob('src', 'foo:bar') | write
+        graph.run()
+        self.assertEqual((write.written, write.skipped), (2, 0))
+        self.make_files(**{'src/foo': 'c'})
+        graph.run()
+        self.assertEqual((write.written, write.skipped), (1, 1))
+        with open(os.path.join('out', 'foo'), 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'c')
+
+    def test_rewrite_modified_output(self):
+        """ Outputs modified by something else are rewritten """
+        self.make_files(**{'src/foo': 'a'})
+        with pike.Graph('g') as graph:
+            write = pike.write('out', skip_unchanged=True)
+            pike.glob('src', 'foo') | write
+        graph.run()
+        self.make_files(**{os.path.join('out', 'foo'): 'garbage'})
+        graph.run()
+        self.assertEqual((write.written, write.skipped), (1, 0))
+
+    def test_threaded_write(self):
+        """ Files can be written from a thread pool """
+        files = dict(('src/%s/f%d' % (i % 3, i), str(i)) for i in range(20))
+        self.make_files(**files)
+        with pike.Graph('g') as graph:
+            write = pike.write('out', threads=4, fsync=True)
+            pike.glob('src', '*') | write
+        graph.run()
+        self.assertEqual(write.written, 20)
+        for i in range(20):
+            path = os.path.join('out', str(i % 3), 'f%d' % i)
+            with open(path, 'rb') as ifile:
+                self.assertEqual(ifile.read(), str(i).encode('utf-8'))
+
+    def test_threaded_manifest(self):
+        """ Threaded writes share one manifest connection """
+        self.make_files(**dict(('src/f%d' % i, str(i)) for i in range(20)))
+        write = pike.write('out', skip_unchanged=True, threads=4,
+                           cache='cache.db', key='write')
+        original = SqliteDict.__init__
+
+        def slow_init(*args, **kwargs):
+            """ Give other threads a chance to race the initialization """
+            time.sleep(0.05)
+            return original(*args, **kwargs)
+        with patch.object(SqliteDict, '__init__', autospec=True,
+                          side_effect=slow_init) as init:
+            write.process(pike.glob('src', '*').process())
+        self.assertEqual(init.call_count, 1)
+        self.assertEqual(write.written, 20)
+
+
+class TestFingerprint(BaseFileTest):
+
+    """ Tests for the FingerprintNode """
+
+    def test_fingerprint(self):
+        """ Digest is inserted before the extension """
+        item = blob_item('js/app.js', b'foo')
+        digest = item.data.digest()
+        ret = FingerprintNode().process([item])
+        renamed = ret['default'][0]
+        self.assertEqual(renamed.filename, 'js/app.%s.js' % digest[:8])
+        self.assertEqual(renamed.logical_filename, 'js/app.js')
+
+    def test_manifest(self):
+        """ Manifest maps the original names to the renamed files """
+        items = [blob_item('a.js', b'a'), blob_item('b.css', b'b')]
+        ret = FingerprintNode(length=4, manifest='assets.json').process(items)
+        manifest = ret['manifest'][0]
+        self.assertEqual(manifest.filename, 'assets.json')
+        mapping = json.loads(manifest.data.read().decode('utf-8'))
+        self.assertEqual(mapping, {
+            'a.js': ret['default'][0].filename,
+            'b.css': ret['default'][1].filename,
+        })
+
+    def test_rerun(self):
+        """ Fingerprinting twice uses the original name """
+        item = blob_item('a.js', b'a')
+        node = FingerprintNode()
+        node.process([item])
+        ret = node.process([item])
+        self.assertEqual(ret['default'][0].filename.count('.'), 2)
+
+
+class TestCompress(BaseFileTest):
+
+    """ Tests for the CompressNode """
+
+    def test_compress(self):
+        """ Compressed siblings are added for large text files """
+        data = b'x' * 2000
+        node = CompressNode(formats=('gz', 'bz2'))
+        items = node.process([blob_item('a.js', data),
+                              blob_item('b.png', data),
+                              blob_item('c.css', b'small')])
+        names = [item.filename for item in items]
+        self.assertEqual(names, ['a.js', 'b.png', 'c.css', 'a.js.gz',
+                                 'a.js.bz2'])
+        gz = gzip.GzipFile(fileobj=BytesIO(items[3].data.read()))
+        self.assertEqual(gz.read(), data)
+        self.assertEqual(bz2.decompress(items[4].data.read()), data)
+        self.assertEqual(node.compressed, 2)
+
+    def test_reuse(self):
+        """ Unchanged files are not compressed again """
+        node = CompressNode(cache=os.path.join('out', 'cache.db'),
+                            key='compress')
+        node.process([blob_item('a.js', b'x' * 2000)])
+        node = CompressNode(cache=os.path.join('out', 'cache.db'),
+                            key='compress')
+        compress = Mock()
+        with patch.dict(COMPRESSORS, {'gz': compress}):
+            items = node.process([blob_item('a.js', b'x' * 2000)])
+        self.assertFalse(compress.called)
+        self.assertEqual(node.reused, 1)
+        self.assertEqual(len(items), 2)
+        node.process([blob_item('a.js', b'y' * 2000)])
+        self.assertEqual(node.compressed, 1)
+
+    def test_unknown_format(self):
+        """ Unknown compression formats are rejected """
+        with self.assertRaises(ValueError):
+            CompressNode(formats=('zip',))
@@ -3,10 +3,24 @@ import time
 import os
 import subprocess
 
+from mock import patch
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict  # pylint: disable=F0401
+
 import pike
+from pike.items import FileMeta, FileDataBlob
+from pike.sqlitedict import SqliteDict
 from pike.test import BaseFileTest
 
 
+def filenames(items):
+    """ Get the filenames of a list of items """
+    return [item.filename for item in items]
+
+
 class TestChangeListener(BaseFileTest):
 
     """ Tests for the ChangeListenerNode """
@@ -43,3 +57,181 @@ class TestChangeListener(BaseFileTest):
         os.utime('foo', (new_mtime, new_mtime))
         ret = graph.run()
         self.assert_files_equal(ret['default'], ['foo'])
+
+    def test_change_dependency(self):
+        """ If a recorded dependency changes, the file is passed on """
+        with pike.Graph('g') as graph:
+            listener = pike.glob('.', 'foo:bar') | \
+                pike.ChangeListenerNode(stop=False)
+        self.make_files(foo='a', bar='b', dep='c')
+        foo = [item for item in graph.run()['default']
+               if item.filename == 'foo'][0]
+        listener.set_dependencies({
+            foo.fullpath: [os.path.abspath('dep')],
+            'missing': [os.path.abspath('dep')],
+        })
+        self.assertNotIn('missing', listener.dependencies)
+        ret = graph.run()
+        self.assert_files_equal(ret['default'], [])
+        self.make_files(dep='changed')
+        ret = graph.run()
+        self.assert_files_equal(ret['default'], ['foo'])
+        ret = graph.run()
+        self.assert_files_equal(ret['default'], [])
+
+    def test_removed(self):
+        """ Files that disappear are sent to the 'removed' output """
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*') | pike.ChangeListenerNode()
+        self.make_files(foo='a', bar='b')
+        graph.run()
+        os.remove('bar')
+        ret = graph.run()
+        self.assert_files_equal(ret['default'], [])
+        self.assert_files_equal(ret['removed'], ['bar'])
+        self.assertNotIn(ret['removed'][0].fullpath,
+                         graph.sink.checksums)
+        self.make_files(bar='b')
+        ret = graph.run()
+        self.assert_files_equal(ret['default'], ['bar'])
+        self.assert_files_equal(ret['removed'], [])
+
+
+class TestCache(BaseFileTest):
+
+    """ Tests for the CacheNode """
+
+    def test_merge_changes(self):
+        """ Output contains the cached items updated with the new ones """
+        node = pike.CacheNode()
+        node.process([FileMeta('foo', 'a'), FileMeta('bar', 'a')])
+        ret = node.process([FileMeta('foo', 'a', data=FileDataBlob(b'x'))])
+        self.assertEqual(filenames(ret['default']), ['foo', 'bar'])
+        self.assertEqual(ret['default'][0].data.read(), b'x')
+
+    def test_persist(self):
+        """ Cached items are loaded from the cache file in order """
+        node = pike.CacheNode('cache.db', 'cache')
+        node.process([FileMeta('foo', 'a'), FileMeta('bar', 'a')],
+                     other=[FileMeta('baz', 'a')])
+        node.process([FileMeta('qux', 'a'), FileMeta('foo', 'a')])
+        node = pike.CacheNode('cache.db', 'cache')
+        ret = node.process([])
+        self.assertEqual(filenames(ret['default']), ['foo', 'bar', 'qux'])
+        ret = node.process(other=[])
+        self.assertEqual(filenames(ret['other']), ['baz'])
+
+    def test_migrate_legacy_rows(self):
+        """ Caches that stored a row per stream are converted """
+        legacy = SqliteDict('cache.db', 'cache', autocommit=False)
+        legacy['default'] = OrderedDict([
+            (os.path.join('a', 'foo'), FileMeta('foo', 'a')),
+            (os.path.join('a', 'bar'), FileMeta('bar', 'a')),
+        ])
+        legacy.commit()
+        legacy.close()
+        node = pike.CacheNode('cache.db', 'cache')
+        ret = node.process([FileMeta('baz', 'a')])
+        self.assertEqual(filenames(ret['default']), ['foo', 'bar', 'baz'])
+        self.assertNotIn('default', node.cache)
+        node = pike.CacheNode('cache.db', 'cache')
+        ret = node.process([])
+        self.assertEqual(filenames(ret['default']), ['foo', 'bar', 'baz'])
+
+    def test_migrate_unindexed_rows(self):
+        """ Item rows with no position and sources row are converted """
+        rows = SqliteDict('cache.db', 'cache', autocommit=False)
+        rows['default:' + os.path.join('a', 'foo')] = (1, FileMeta('foo', 'a'))
+        rows['default:' + os.path.join('a', 'bar')] = (0, FileMeta('bar', 'a'))
+        rows.commit()
+        rows.close()
+        node = pike.CacheNode('cache.db', 'cache')
+        ret = node.process([FileMeta('baz', 'a')])
+        self.assertEqual(filenames(ret['default']), ['bar', 'foo', 'baz'])
+        self.assertIsNone(node.related([os.path.join('a', 'foo')]))
+
+    def test_write_changed_rows(self):
+        """ Only the rows of the new items are written """
+        node = pike.CacheNode('cache.db', 'cache')
+        node.process([FileMeta('foo', 'a'), FileMeta('bar', 'a')])
+        with patch.object(node.cache, 'commit') as commit:
+            with patch.object(SqliteDict, '__setitem__') as setitem:
+                node.process([])
+                self.assertFalse(commit.called)
+                node.process([FileMeta('bar', 'a')])
+                # The item and its position and sources
+                self.assertEqual(setitem.call_count, 2)
+
+    def test_lazy_streams(self):
+        """ Items are only read from the cache when their stream is used """
+        node = pike.CacheNode('cache.db', 'cache')
+        node.process([FileMeta('foo', 'a', sources=frozenset(['foo']))],
+                     other=[FileMeta('bar', 'a', sources=frozenset(['bar']))])
+        node = pike.CacheNode('cache.db', 'cache')
+        real_getitem = SqliteDict.__getitem__
+        read = []
+
+        def getitem(cache, key):
+            """ Record the keys that are read """
+            read.append(key)
+            return real_getitem(cache, key)
+        with patch.object(SqliteDict, '__getitem__', getitem):
+            self.assertEqual(node.related(['foo']), set(['foo']))
+            self.assertTrue(all(key.startswith('#') for key in read))
+            ret = node.process(other=[])
+        self.assertEqual(filenames(ret['other']), ['bar'])
+        items = [key for key in read if not key.startswith('#')]
+        self.assertEqual(items, ['other:' + os.path.join('a', 'bar')])
+
+    def test_output_views(self):
+        """ Modifying the output does not modify the cache """
+        node = pike.CacheNode()
+        node.process([FileMeta('foo', 'a')])
+        ret = node.process([])
+        ret['default'][0].filename = 'bar'
+        ret = node.process([])
+        self.assertEqual(filenames(ret['default']), ['foo'])
+
+    def test_evict(self):
+        """ Removed files are evicted from all streams """
+        node = pike.CacheNode('cache.db', 'cache')
+        node.process([FileMeta('foo', 'a'), FileMeta('bar', 'a')],
+                     other=[FileMeta('foo', 'a')])
+        ret = node.process([], _removed=[FileMeta('foo', 'a')])
+        self.assertEqual(filenames(ret['default']), ['bar'])
+        node = pike.CacheNode('cache.db', 'cache')
+        ret = node.process(other=[])
+        self.assertEqual(filenames(ret['other']), [])
+
+    def test_replace_outputs(self):
+        """ Outputs made from a changed source are replaced """
+        node = pike.CacheNode('cache.db', 'cache')
+        node.process([FileMeta('foo.css', 'a', sources=frozenset(['foo'])),
+                      FileMeta('bar.css', 'a', sources=frozenset(['bar']))])
+        # foo now produces a file with a different name
+        ret = node.process([FileMeta('foo2.css', 'a',
+                                     sources=frozenset(['foo']))])
+        self.assertEqual(filenames(ret['default']), ['bar.css', 'foo2.css'])
+        node = pike.CacheNode('cache.db', 'cache')
+        ret = node.process([], _removed=[FileMeta('foo', '')])
+        self.assertEqual(filenames(ret['default']), ['bar.css'])
+
+    def test_related(self):
+        """ Sources that share an output are related """
+        node = pike.CacheNode()
+        node.process([FileMeta('all.js', 'a', sources=frozenset(['a', 'b'])),
+                      FileMeta('c.js', 'a', sources=frozenset(['c']))])
+        self.assertEqual(node.related(['a']), set(['a', 'b']))
+        self.assertEqual(node.related(['c']), set(['c']))
+
+    def test_related_unknown(self):
+        """ Sources that aren't in the cache have unknown relations """
+        node = pike.CacheNode()
+        node.process([FileMeta('all.js', 'a', sources=frozenset(['a', 'b']))])
+        self.assertIsNone(node.related(['a', 'c']))
+
+    def test_related_no_sources(self):
+        """ Items that didn't record their sources have unknown relations """
+        node = pike.CacheNode()
+        node.process([FileMeta('all.js', 'a')])
+        self.assertIsNone(node.related([os.path.join('a', 'all.js')]))
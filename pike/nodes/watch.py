@@ -1,14 +1,12 @@
 """ Nodes for watching files for changes. """
 import os
 
-import copy
 import six
 
 from .base import Node
 from pike.exceptions import StopProcessing
-from pike.items import FileDataBlob
+from pike.items import FileMeta
 from pike.sqlitedict import SqliteDict
-from pike.util import md5stream
 try:
     from collections import OrderedDict
 except ImportError:  # pragma: no cover
@@ -20,8 +18,11 @@ class ChangeListenerNode(Node):
     """
     Filter source files and detect changes.
 
-    It has two outputs, the default and 'all'. The default output contains only
-    the changed files. The 'all' edge will contain all files from the source.
+    It has three outputs: the default, 'all', and 'removed'. The default output
+    contains only the changed files. The 'all' edge will contain all files
+    from the source. The 'removed' edge will contain a placeholder
+    :class:`~pike.items.FileMeta` for each file that was seen on a previous
+    run but is no longer in the source. Removed files count as a change.
 
     Parameters
     ----------
@@ -39,20 +40,29 @@ class ChangeListenerNode(Node):
         strings 'md5' or 'mtime', which will md5sum the file or check the
         modification time respectively. (default 'md5')
 
+    Notes
+    -----
+    Downstream nodes may report files that a source file depends on (such as
+    LESS imports) with :meth:`~.set_dependencies`. A source file will then
+    be considered changed if any of its dependencies change.
+
     """
     name = 'change_listener'
-    outputs = ('default', 'all')
+    outputs = ('default', 'all', 'removed')
 
     def __init__(self, stop=True, cache=None, key=None, fingerprint='md5'):
         super(ChangeListenerNode, self).__init__()
         self.stop = stop
         if cache is None:
             self.checksums = {}
+            self.dependencies = {}
         elif key is None:
             raise ValueError("If cache is provided, must provide a key")
         else:
             self.checksums = SqliteDict(cache, key, autocommit=False,
                                         synchronous=0)
+            self.dependencies = SqliteDict(cache, key + '_deps',
+                                           autocommit=False, synchronous=0)
         if fingerprint == 'md5':
             self.fingerprint = self._md5
         elif fingerprint == 'mtime':
@@ -62,29 +72,84 @@ class ChangeListenerNode(Node):
 
     def _md5(self, item):
         """ md5sum a file """
-        with item.data.open() as filestream:
-            return md5stream(filestream)
+        return item.data.digest()
 
     def _mtime(self, item):
         """ Get the modification time of a file """
         return os.path.getmtime(item.fullpath)
 
+    def _file_fingerprint(self, path):
+        """ Fingerprint a file that is not in the stream """
+        if not os.path.exists(path):
+            return None
+        return self.fingerprint(FileMeta(os.path.basename(path),
+                                         os.path.dirname(path)))
+
+    def set_dependencies(self, dependencies):
+        """
+        Record the files that source files depend on.
+
+        Parameters
+        ----------
+        dependencies : dict
+            Mapping of the full path of a source file to a list of the paths
+            of files it depends on. Source files that did not come through
+            this node are ignored.
+
+        """
+        for path, deps in six.iteritems(dependencies):
+            if path not in self.checksums:
+                continue
+            self.dependencies[path] = dict((dep, self._file_fingerprint(dep))
+                                           for dep in deps)
+        if isinstance(self.dependencies, SqliteDict):
+            self.dependencies.commit()
+
+    def _dependencies_changed(self, path):
+        """ Check if any of the dependencies of a file have changed """
+        deps = self.dependencies.get(path)
+        if not deps:
+            return False
+        current = dict((dep, self._file_fingerprint(dep)) for dep in deps)
+        if current == deps:
+            return False
+        self.dependencies[path] = current
+        return True
+
     def process(self, stream):
         changed = []
         all_items = []
+        seen = set()
         for item in stream:
             fingerprint = self.fingerprint(item)
+            is_changed = self._dependencies_changed(item.fullpath)
             if fingerprint != self.checksums.get(item.fullpath):
                 self.checksums[item.fullpath] = fingerprint
+                is_changed = True
+            if is_changed:
                 changed.append(item)
             all_items.append(item)
-        if not changed and self.stop:
+            seen.add(item.fullpath)
+        removed = []
+        if len(seen) != len(self.checksums):
+            for fullpath in list(self.checksums):
+                if fullpath in seen:
+                    continue
+                del self.checksums[fullpath]
+                if fullpath in self.dependencies:
+                    del self.dependencies[fullpath]
+                removed.append(FileMeta(os.path.basename(fullpath),
+                                        os.path.dirname(fullpath),
+                                        sources=frozenset([fullpath])))
+        if not changed and not removed and self.stop:
             raise StopProcessing
         if isinstance(self.checksums, SqliteDict):
             self.checksums.commit()
+            self.dependencies.commit()
         return {
             'default': changed,
             'all': all_items,
+            'removed': removed,
         }
 
 
@@ -95,30 +160,94 @@ class ChangeEnforcerNode(Node):
     :class:`~pike.StopProcessing` if none of the listeners have detected any
     changes.
 
+    Inputs that end in '_all' replace the stream of the same name. Inputs that
+    end in '_removed' count as changes, and are merged into the 'removed'
+    output.
+
+    Parameters
+    ----------
+    provenance : :class:`~.CacheNode`, optional
+        If provided, the '_all' inputs are only used to add the files that
+        share an output with a changed or removed file (see
+        :meth:`~.CacheNode.related`). Only those files and the changed files
+        are passed on. If the cache doesn't know which outputs a changed file
+        went into, the whole '_all' stream is passed on.
+
     """
 
     name = 'change_enforcer'
     outputs = ('*')
 
-    def __init__(self):
+    def __init__(self, provenance=None):
         super(ChangeEnforcerNode, self).__init__()
+        self.provenance = provenance
 
     def process(self, **kwargs):
         ret = {}
+        removed = []
         has_changes = False
         for name, stream in six.iteritems(kwargs):
             if name.endswith('_all'):
                 continue
+            if name.endswith('_removed'):
+                removed.extend(stream)
+                continue
             if stream:
                 has_changes = True
-            if name + '_all' in kwargs:
+            if name + '_all' in kwargs and self.provenance is None:
                 ret[name] = kwargs[name + '_all']
             else:
                 ret[name] = stream
-        if not has_changes:
+        if not has_changes and not removed:
             raise StopProcessing
+        if self.provenance is not None:
+            self._add_related(ret, removed, kwargs)
+        ret['removed'] = removed
         return ret
 
+    def _add_related(self, ret, removed, kwargs):
+        """ Add the files that share an output with the changed files """
+        changed = set(item.fullpath for item in removed)
+        for stream in six.itervalues(ret):
+            changed.update(item.fullpath for item in stream)
+        related = self.provenance.related(changed)
+        if related is None:
+            for name in ret:
+                if name + '_all' in kwargs:
+                    ret[name] = kwargs[name + '_all']
+            return
+        related.update(changed)
+        for name in ret:
+            if name + '_all' in kwargs:
+                ret[name] = [item for item in kwargs[name + '_all'] if
+                             item.fullpath in related]
+
+
+class CachedStreams(dict):
+
+    """
+    Mapping of stream names to the items in a :class:`~.CacheNode`.
+
+    The items of a stream are only read from the cache the first time that
+    stream is looked up. Containment checks and iteration only see the
+    streams that have been loaded.
+
+    Parameters
+    ----------
+    load : callable
+        Function that takes a stream name and returns an OrderedDict of the
+        fullpath of each item to the (position, item) stored in its row
+
+    """
+
+    def __init__(self, load):
+        super(CachedStreams, self).__init__()
+        self._load = load
+
+    def __missing__(self, stream):
+        items = self[stream] = self._load(stream)
+        return items
+
 
 class CacheNode(Node):
 
@@ -129,9 +258,11 @@ class CacheNode(Node):
     process the updated files. You can put a CacheNode after the processing,
     and all of the results will be passed on.
 
-    ..note::
-        The CacheNode handles new and changed files, but if you remove a file
-        it will still appear in the output of the CacheNode.
+    When a file comes in, every cached item that was made from the same
+    source files (see :meth:`~pike.items.record_sources`) is replaced or
+    evicted. Source files that are passed in to the ``_removed`` input, which
+    is usually connected to the 'removed' output of a
+    :class:`~.ChangeEnforcerNode`, evict everything that was made from them.
 
     Parameters
     ----------
@@ -142,6 +273,15 @@ class CacheNode(Node):
         Table name to use inside the ``cache`` file. Must be present if
         ``cache`` is non-None.
 
+    Notes
+    -----
+    Each item is stored in its own row, next to a small row with its position
+    and sources, so a run that changes one file only writes two rows. Only
+    the small rows are loaded to find the items that a change affects, and
+    the items of a stream are loaded the first time the stream is used (see
+    :attr:`~.streams`). The output contains copy-on-write views of the cached
+    items (see :meth:`~pike.items.FileMeta.view`).
+
     """
 
     name = 'cache'
@@ -156,21 +296,235 @@ class CacheNode(Node):
         else:
             self.cache = SqliteDict(cache, key, autocommit=False,
                                     synchronous=0)
+        self._streams = None
+        # Mapping of stream -> fullpath -> (position, sources) for every item
+        self._meta = None
+        self._position = 0
+        # Provenance index of source fullpath -> set of (stream, fullpath)
+        self._consumers = {}
 
-    def process(self, default=None, **kwargs):
+    @staticmethod
+    def _row_key(stream, fullpath):
+        """ Get the key of the row that stores an item """
+        return '%s:%s' % (stream, fullpath)
+
+    @staticmethod
+    def _meta_key(stream, fullpath):
+        """ Get the key of the row that stores the position and sources """
+        return '#%s:%s' % (stream, fullpath)
+
+    @property
+    def streams(self):
+        """
+        Lazy mirror of the cached items
+
+        A :class:`~.CachedStreams` that maps the stream name to an
+        OrderedDict of the fullpath of each item to the (position, item)
+        stored in its row.
+
+        """
+        if self._streams is None:
+            self._streams = CachedStreams(self._load_stream)
+        return self._streams
+
+    @property
+    def meta(self):
+        """
+        The position and sources of every cached item
+
+        Maps the stream name to a dict of the fullpath of each item to its
+        (position, sources). Items that did not record their sources have
+        empty sources.
+
+        """
+        if self._meta is None:
+            self._meta = {}
+            keys = set(self.cache)
+            legacy = []
+            unindexed = []
+            for row_key in keys:
+                if row_key.startswith('#'):
+                    stream, fullpath = row_key[1:].split(':', 1)
+                    position, sources = self.cache[row_key]
+                    self._add_meta((stream, fullpath), position, sources)
+                elif ':' not in row_key:
+                    legacy.append(row_key)
+                elif '#' + row_key not in keys:
+                    unindexed.append(row_key)
+            self._migrate(legacy, unindexed)
+        return self._meta
+
+    def _migrate(self, legacy, unindexed):
+        """
+        Convert rows from older versions
+
+        The first versions stored each stream as a single row that held an
+        OrderedDict of all the items, keyed by the stream name. Later
+        versions stored each item in its own row, but had no row for the
+        position and sources.
+
+        """
+        for stream in legacy:
+            items = self.cache.pop(stream)
+            for fullpath, item in six.iteritems(items):
+                self._store((stream, fullpath), self._position, item)
+        for row_key in unindexed:
+            stream, fullpath = row_key.split(':', 1)
+            position, item = self.cache[row_key]
+            self._store((stream, fullpath), position, item, False)
+        if (legacy or unindexed) and isinstance(self.cache, SqliteDict):
+            self.cache.commit()
+
+    def _load_stream(self, stream):
+        """ Read the items of a stream from the cache """
+        rows = sorted((position, fullpath) for fullpath, (position, _) in
+                      six.iteritems(self.meta.get(stream, {})))
+        items = OrderedDict()
+        for _, fullpath in rows:
+            items[fullpath] = self.cache[self._row_key(stream, fullpath)]
+        return items
+
+    def _add_meta(self, key, position, sources):
+        """ Track the position and sources of a cached item """
+        stream, fullpath = key
+        self._meta.setdefault(stream, {})[fullpath] = (position, sources)
+        self._position = max(self._position, position + 1)
+        for source in sources or (fullpath,):
+            self._consumers.setdefault(source, set()).add(key)
+
+    def _remove_meta(self, key):
+        """ Stop tracking a cached item """
+        stream, fullpath = key
+        _, sources = self._meta[stream].pop(fullpath)
+        for source in sources or (fullpath,):
+            consumers = self._consumers.get(source)
+            if consumers is not None:
+                consumers.discard(key)
+                if not consumers:
+                    del self._consumers[source]
+
+    def _store(self, key, position, item, write_item=True):
+        """ Write an item and its position and sources to the cache """
+        stream, fullpath = key
+        sources = tuple(getattr(item, 'sources', None) or ())
+        if fullpath in self._meta.get(stream, {}):
+            self._remove_meta(key)
+        self._add_meta(key, position, sources)
+        if write_item:
+            self.cache[self._row_key(stream, fullpath)] = (position, item)
+        self.cache[self._meta_key(stream, fullpath)] = (position, sources)
+        if stream in self.streams:
+            self.streams[stream][fullpath] = (position, item)
+
+    def _evict(self, key):
+        """ Remove a (stream, fullpath) from the cache """
+        stream, fullpath = key
+        self._remove_meta(key)
+        del self.cache[self._row_key(stream, fullpath)]
+        del self.cache[self._meta_key(stream, fullpath)]
+        if stream in self.streams:
+            self.streams[stream].pop(fullpath, None)
+
+    def evict(self, fullpath):
+        """
+        Remove a file from all streams of the cache
+
+        Parameters
+        ----------
+        fullpath : str
+
+        Returns
+        -------
+        evicted : bool
+            True if the file was in the cache
+
+        """
+        evicted = False
+        for stream, items in list(six.iteritems(self.meta)):
+            if fullpath in items:
+                self._evict((stream, fullpath))
+                evicted = True
+        return evicted
+
+    def related(self, paths):
+        """
+        Find all source files that share a cached output with some files.
+
+        If one input of a :class:`~pike.ConcatNode` changes, all of its other
+        inputs need to run through the graph again to rebuild the output.
+        This only reads the positions and sources of the cached items, not
+        the items themselves.
+
+        Parameters
+        ----------
+        paths : iterable
+            Full paths of source files
+
+        Returns
+        -------
+        related : set or None
+            Full paths of the sources of every cached output that was made
+            from any of the ``paths``. None if one of the ``paths`` is not the
+            source of any cached output (e.g. it was just added), or if one of
+            the outputs didn't record its sources (e.g. it was cached by an
+            older version). In either case all of the files need to run again.
+
+        """
+        meta = self.meta
+        related = set()
+        for path in paths:
+            consumers = self._consumers.get(path)
+            if not consumers:
+                return None
+            for stream, fullpath in consumers:
+                sources = meta[stream][fullpath][1]
+                if not sources:
+                    return None
+                related.update(sources)
+        return related
+
+    def process(self, default=None, _removed=None, **kwargs):
         if default is not None:
             kwargs['default'] = default
+        for stream, items in list(six.iteritems(kwargs)):
+            kwargs[stream] = list(items)
+        meta = self.meta
+        # Every cached output made from a changed or removed source is stale.
+        # The new items replace them, and the rest are evicted.
+        affected = set(item.fullpath for item in _removed or ())
+        for items in six.itervalues(kwargs):
+            for item in items:
+                affected.update(getattr(item, 'sources', None) or
+                                (item.fullpath,))
+        stale = {}
+        for source in affected:
+            for key in self._consumers.get(source, ()):
+                stale[key] = meta[key[0]][key[1]][0]
+        changed = bool(stale)
+
         ret = {}
         for stream, items in six.iteritems(kwargs):
-            stream_cache = self.cache.setdefault(stream, OrderedDict())
+            stream_meta = meta.get(stream, {})
+            # Load the stream first so the new items are added after the
+            # cached ones
+            self.streams[stream]  # pylint: disable=W0104
             for item in items:
-                stream_cache[item.fullpath] = item
-            ret[stream] = []
-            for item in six.itervalues(stream_cache):
-                clone = copy.copy(item)
-                clone.data = FileDataBlob(clone.data.read())
-                ret[stream].append(clone)
-            if isinstance(self.cache, SqliteDict):
-                self.cache[stream] = stream_cache
-                self.cache.commit()
+                key = (stream, item.fullpath)
+                old = stream_meta.get(item.fullpath)
+                if key in stale:
+                    position = stale.pop(key)
+                elif old is not None:
+                    position = old[0]
+                else:
+                    position = self._position
+                    self._position += 1
+                self._store(key, position, item)
+                changed = True
+        for key in stale:
+            self._evict(key)
+        for stream in kwargs:
+            ret[stream] = [item.view() for _, item in
+                           six.itervalues(self.streams[stream])]
+        if changed and isinstance(self.cache, SqliteDict):
+            self.cache.commit()
         return ret
@@ -1,14 +1,19 @@
 """ Adapters for web frameworks """
 import os
 
-from pike import Environment, Graph, WriteNode, UrlNode, XargsNode
+from pike import (Environment, Graph, WriteNode, UrlNode, XargsNode,
+                  CompressNode)
 from pike.util import resource_spec
 
 
-def get_environment(watch, cache_file, url_prefix, output_dir):
+def get_environment(watch, cache_file, url_prefix, output_dir,
+                    compress=False):
     """ Construct a pike environment for a webserver """
     with Graph('write-and-gen-url') as write_and_url:
-        WriteNode(output_dir).connect(UrlNode(url_prefix))
+        write = WriteNode(output_dir)
+        if compress:
+            CompressNode().connect(write)
+        write.connect(UrlNode(url_prefix))
 
     with Graph('gen-file-and-url') as default_output:
         XargsNode(write_and_url)
@@ -28,3 +33,50 @@ def cache_file_setting(output_dir, cache_file):
             return None
         else:
             return resource_spec(cache_file)
+
+
+def accepts_gzip(accept_encoding):
+    """ Check if an Accept-Encoding header allows gzip responses """
+    qualities = {}
+    for coding in (accept_encoding or '').split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    # An explicit gzip takes precedence over the wildcard
+    if 'gzip' in qualities:
+        return qualities['gzip'] > 0
+    return qualities.get('*', 0) > 0
+
+
+def find_asset(env, path, accept_encoding=None):
+    """
+    Find the file to serve for a generated asset.
+
+    If the client accepts gzip and a precompressed ``.gz`` sibling was
+    generated (see :class:`~pike.nodes.simple.CompressNode`), that file will
+    be returned instead.
+
+    Returns
+    -------
+    fullpath : str or None
+        Path of the file to serve, or None if there is no such asset
+    encoding : str or None
+        'gzip' if the file is compressed
+
+    """
+    if accepts_gzip(accept_encoding):
+        fullpath = env.lookup(path + '.gz')
+        if fullpath and os.path.exists(fullpath):
+            return fullpath, 'gzip'
+    fullpath = env.lookup(path)
+    if fullpath and os.path.exists(fullpath):
+        return fullpath, None
+    return None, None
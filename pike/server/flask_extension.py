@@ -4,9 +4,10 @@ app.jinja_env.add_extension("pike.ext.JinjaExtension")
 """
 import os
 
-from flask import abort, send_from_directory
+import mimetypes
+from flask import abort, request, send_from_directory
 
-from . import get_environment, cache_file_setting
+from . import get_environment, cache_file_setting, find_asset
 from pike.env import Environment
 from pike.util import resource_spec
 
@@ -17,12 +18,14 @@ def configure(app):
     watch = app.config.get('PIKE_WATCH', True)
     url_prefix = app.config.get('PIKE_URL_PREFIX', 'gen')
     serve_files = app.config.get('PIKE_SERVE_FILES', True)
+    compress = app.config.get('PIKE_COMPRESS', False)
     cache_file = cache_file_setting(output_dir,
                                     app.config.get('PIKE_CACHE_FILE'))
     load_file = app.config.get('PIKE_LOAD_FILE')
 
     if load_file is None:
-        env = get_environment(watch, cache_file, url_prefix, output_dir)
+        env = get_environment(watch, cache_file, url_prefix, output_dir,
+                              compress)
     else:
         env = Environment()
         env.load(resource_spec(load_file))
@@ -33,13 +36,19 @@ def configure(app):
         @app.route('/%s/<path:filename>' % url_prefix)
         def serve_asset(filename):
             """ A view that will serve generated assets """
-            fullpath = env.lookup(filename)
-            if fullpath and os.path.exists(fullpath):
-                if os.path.isabs(fullpath):
-                    directory, fullpath = os.path.split(fullpath)
-                else:
-                    directory = os.getcwd()
-                return send_from_directory(directory, fullpath)
-            else:
+            fullpath, encoding = find_asset(
+                env, filename, request.headers.get('Accept-Encoding'))
+            if fullpath is None:
                 return abort(404)
+            if os.path.isabs(fullpath):
+                directory, fullpath = os.path.split(fullpath)
+            else:
+                directory = os.getcwd()
+            mimetype = mimetypes.guess_type(filename, strict=False)[0]
+            response = send_from_directory(directory, fullpath,
+                                           mimetype=mimetype)
+            response.vary.add('Accept-Encoding')
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+            return response
     return env
@@ -4,11 +4,12 @@ Pike extension for Pyramid.
 """
 import os
 
+import mimetypes
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.response import FileResponse
 from pyramid.settings import asbool
 
-from . import get_environment, cache_file_setting
+from . import get_environment, cache_file_setting, find_asset
 from pike.env import Environment
 from pike.util import resource_spec
 
@@ -16,11 +17,18 @@ from pike.util import resource_spec
 def serve_asset(request):
     """ A view that will serve generated assets """
     path = '/'.join(request.matchdict['path'])
-    fullpath = request.registry.pike_env.lookup(path)
-    if fullpath and os.path.exists(fullpath):
-        return FileResponse(fullpath, request=request, cache_max_age=31556926)
-    else:
+    fullpath, encoding = find_asset(request.registry.pike_env, path,
+                                    request.headers.get('Accept-Encoding'))
+    if fullpath is None:
         return HTTPNotFound()
+    content_type = mimetypes.guess_type(path, strict=False)[0]
+    response = FileResponse(fullpath, request=request,
+                            cache_max_age=31556926,
+                            content_type=content_type)
+    response.vary = ('Accept-Encoding',)
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
 
 
 def includeme(config):
@@ -32,6 +40,7 @@ def includeme(config):
     path = settings.get('pike.url_prefix', 'gen')
     serve_files = asbool(settings.get('pike.serve_files', True))
     static_view = asbool(settings.get('pike.static_view', False))
+    compress = asbool(settings.get('pike.compress', False))
     cache_file = cache_file_setting(output_dir,
                                     settings.get('pike.cache_file'))
     load_file = settings.get('pike.load_file')
@@ -46,7 +55,7 @@ def includeme(config):
             config.add_view(serve_asset, route_name='pike_assets')
 
     if load_file is None:
-        env = get_environment(watch, cache_file, path, output_dir)
+        env = get_environment(watch, cache_file, path, output_dir, compress)
     else:
         env = Environment()
         env.load(resource_spec(load_file))
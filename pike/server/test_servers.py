@@ -1,12 +1,15 @@
 """ Integration tests for server extensions """
 import os
 import sys
+import zlib
 
 import six
 import webtest
 from pyramid.config import Configurator
+from webob import Request
 
 import pike
+from pike.server import accepts_gzip
 from pike.test import BaseFileTest
 
 
@@ -55,6 +58,30 @@ class TestPyramid(BaseFileTest):
         }
         self._run_test(settings)
 
+    def test_serve_compressed(self):
+        """ Pyramid serves precompressed files if the client accepts them """
+        config = Configurator(settings={'pike.compress': 'true'})
+        config.include('pike')
+        data = b"alert('hello world');" * 100
+        self.make_files({'foo.js': data})
+        env = config.get_pike_env()
+        with pike.Graph('assets') as graph:
+            pike.glob('.', '*')
+        env.add(graph)
+        env.run_all()
+
+        # Use a raw request because webtest decodes the response
+        app = config.make_wsgi_app()
+        request = Request.blank('/gen/foo.js',
+                                headers={'Accept-Encoding': 'gzip, deflate'})
+        response = request.get_response(app)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS),
+                         data)
+        response = Request.blank('/gen/foo.js').get_response(app)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, data)
+
     def test_jinja2(self):
         """ Auto-configure jinja2 if it's present """
         settings = {}
@@ -100,8 +127,50 @@ class TestFlask(BaseFileTest):
         """ Flask will serve processed files """
         self._run_test({})
 
+    def test_serve_compressed(self):
+        """ Flask serves precompressed files if the client accepts them """
+        import flask
+        app = flask.Flask(__name__)
+        app.config.update({'PIKE_COMPRESS': True})
+        data = b"alert('hello world');" * 100
+        self.make_files({'foo.js': data})
+        env = pike.flaskme(app)
+        with pike.Graph('assets') as graph:
+            pike.glob('.', '*')
+        env.add(graph)
+        env.run_all()
+
+        client = app.test_client()
+        response = client.get('/gen/foo.js',
+                              headers={'Accept-Encoding': 'gzip;q=0.5'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.get_data(),
+                                         16 + zlib.MAX_WBITS), data)
+        response = client.get('/gen/foo.js',
+                              headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(), data)
+
     def test_serve_files_abs_dir(self):
         """ Flask will serve processed files from an absolute path """
         self._run_test({
             'PIKE_OUTPUT_DIR': os.path.join(os.getcwd(), 'gen'),
         })
+
+
+class TestAcceptsGzip(unittest.TestCase):
+
+    """ Tests for parsing the Accept-Encoding header """
+
+    def test_accepts(self):
+        """ gzip is accepted if it or the wildcard has a nonzero quality """
+        self.assertTrue(accepts_gzip('gzip, deflate'))
+        self.assertTrue(accepts_gzip('deflate, *;q=0.5'))
+        self.assertFalse(accepts_gzip(None))
+        self.assertFalse(accepts_gzip('deflate'))
+        self.assertFalse(accepts_gzip('gzip;q=0'))
+
+    def test_explicit_over_wildcard(self):
+        """ An explicit gzip quality takes precedence over the wildcard """
+        self.assertFalse(accepts_gzip('gzip;q=0, *'))
+        self.assertTrue(accepts_gzip('gzip, *;q=0'))
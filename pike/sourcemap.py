@@ -0,0 +1,303 @@
+""" Utilities for combining source maps. """
+import posixpath
+import re
+
+import six
+
+from .util import to_bytes
+
+BASE64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+BASE64_VALUES = dict((c, i) for i, c in enumerate(BASE64))
+VLQ_SHIFT = 5
+VLQ_CONTINUATION = 1 << VLQ_SHIFT
+VLQ_MASK = VLQ_CONTINUATION - 1
+# Matches a sourceMappingURL comment on the last line of a file
+URL_COMMENT_RE = re.compile(br'^(//|/\*)[#@] sourceMappingURL=[^\n]*\s*\Z',
+                            re.M)
+
+
+def vlq_encode(values):
+    """
+    Encode a list of integers as a base64 VLQ string.
+
+    Parameters
+    ----------
+    values : list
+        List of integers
+
+    Returns
+    -------
+    segment : str
+
+    """
+    output = []
+    for value in values:
+        if value < 0:
+            value = ((-value) << 1) | 1
+        else:
+            value <<= 1
+        while True:
+            digit = value & VLQ_MASK
+            value >>= VLQ_SHIFT
+            if value:
+                digit |= VLQ_CONTINUATION
+            output.append(BASE64[digit])
+            if not value:
+                break
+    return ''.join(output)
+
+
+def vlq_decode(segment):
+    """
+    Decode a base64 VLQ string into a list of integers.
+
+    Parameters
+    ----------
+    segment : str
+
+    Returns
+    -------
+    values : list
+
+    """
+    values = []
+    value = shift = 0
+    for char in segment:
+        digit = BASE64_VALUES[char]
+        value += (digit & VLQ_MASK) << shift
+        if digit & VLQ_CONTINUATION:
+            shift += VLQ_SHIFT
+        else:
+            if value & 1:
+                values.append(-(value >> 1))
+            else:
+                values.append(value >> 1)
+            value = shift = 0
+    return values
+
+
+def decode_mappings(mappings):
+    """
+    Decode the 'mappings' field of a source map.
+
+    Parameters
+    ----------
+    mappings : str
+
+    Returns
+    -------
+    lines : list
+        One list of segments for each generated line. Each segment is a tuple
+        of absolute values: (column,), (column, source, line, column), or
+        (column, source, line, column, name).
+
+    """
+    lines = []
+    source = orig_line = orig_col = name = 0
+    for text in mappings.split(';'):
+        segments = []
+        column = 0
+        for segment in text.split(','):
+            if not segment:
+                continue
+            values = vlq_decode(segment)
+            column += values[0]
+            if len(values) == 1:
+                segments.append((column,))
+                continue
+            source += values[1]
+            orig_line += values[2]
+            orig_col += values[3]
+            if len(values) > 4:
+                name += values[4]
+                segments.append((column, source, orig_line, orig_col, name))
+            else:
+                segments.append((column, source, orig_line, orig_col))
+        lines.append(segments)
+    return lines
+
+
+def encode_mappings(lines):
+    """
+    Encode segments into the 'mappings' field of a source map.
+
+    This is the inverse of :meth:`~.decode_mappings`.
+
+    Parameters
+    ----------
+    lines : list
+
+    Returns
+    -------
+    mappings : str
+
+    """
+    output = []
+    # source, original line, original column, name
+    previous = [0, 0, 0, 0]
+    for segments in lines:
+        encoded = []
+        column = 0
+        for segment in segments:
+            values = [segment[0] - column]
+            column = segment[0]
+            for i, value in enumerate(segment[1:]):
+                values.append(value - previous[i])
+                previous[i] = value
+            encoded.append(vlq_encode(values))
+        output.append(','.join(encoded))
+    return ';'.join(output)
+
+
+def advance(line, column, data):
+    """
+    Find the position after some generated text.
+
+    Parameters
+    ----------
+    line : int
+        The line that ``data`` starts on
+    column : int
+        The column that ``data`` starts on
+    data : str
+
+    Returns
+    -------
+    line : int
+    column : int
+
+    """
+    if not isinstance(data, six.text_type):
+        data = to_bytes(data)
+    newline = b'\n' if isinstance(data, six.binary_type) else six.u('\n')
+    count = data.count(newline)
+    if count:
+        return line + count, len(data) - data.rindex(newline) - 1
+    return line, column + len(data)
+
+
+def concat_maps(sections, filename=None):
+    """
+    Combine the source maps of several concatenated files into one.
+
+    The mappings of each file are shifted to the position of the file in the
+    output. This only needs the source maps and the positions; the generated
+    code itself is never parsed.
+
+    Parameters
+    ----------
+    sections : list
+        List of (line, column, sourcemap) tuples, where line and column are
+        the position in the output where the file begins and sourcemap is
+        the decoded JSON of the file's source map.
+    filename : str, optional
+        The name of the generated file
+
+    Returns
+    -------
+    sourcemap : dict
+
+    """
+    sources = []
+    contents = []
+    names = []
+    lines = []
+    for line, column, sourcemap in sections:
+        source_offset = len(sources)
+        name_offset = len(names)
+        root = sourcemap.get('sourceRoot') or ''
+        for source in sourcemap.get('sources', []):
+            sources.append(posixpath.join(root, source) if root else source)
+        part_contents = sourcemap.get('sourcesContent') or []
+        part_contents = list(part_contents)
+        part_contents.extend([None] * (len(sources) - source_offset -
+                                       len(part_contents)))
+        contents.extend(part_contents)
+        names.extend(sourcemap.get('names', []))
+
+        for i, segments in enumerate(decode_mappings(sourcemap['mappings'])):
+            target = line + i
+            while len(lines) <= target:
+                lines.append([])
+            col_offset = column if i == 0 else 0
+            for segment in segments:
+                shifted = (segment[0] + col_offset,)
+                if len(segment) > 1:
+                    shifted += (segment[1] + source_offset,) + segment[2:4]
+                if len(segment) > 4:
+                    shifted += (segment[4] + name_offset,)
+                lines[target].append(shifted)
+
+    combined = {
+        'version': 3,
+        'sources': sources,
+        'names': names,
+        'mappings': encode_mappings(lines),
+    }
+    if filename is not None:
+        combined['file'] = filename
+    if any(content is not None for content in contents):
+        combined['sourcesContent'] = contents
+    return combined
+
+
+def url_comment(filename, url):
+    """
+    Create the comment that links a generated file to its source map.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the generated file. CSS files get a block comment.
+    url : str
+        The url of the source map
+
+    Returns
+    -------
+    comment : bytes
+
+    """
+    if filename.endswith('.css'):
+        comment = '/*# sourceMappingURL=%s */' % url
+    else:
+        comment = '//# sourceMappingURL=%s' % url
+    return comment.encode('utf-8')
+
+
+def strip_url(chunks):
+    """
+    Remove the sourceMappingURL comment from the end of some data.
+
+    Only the last line that isn't blank is held back to search for the
+    comment, so the rest of the data is still streamed.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Strings or buffers of the data (see
+        :meth:`~pike.items.IFileData.iter_chunks`)
+
+    Returns
+    -------
+    chunks : generator
+
+    """
+    held = []
+    for chunk in chunks:
+        chunk = to_bytes(chunk)
+        # The last line that isn't blank starts after the last newline that is
+        # followed by more than whitespace
+        start = chunk.rstrip().rfind(b'\n') + 1
+        if start > 0:
+            held.append(chunk[:start])
+            for piece in held:
+                yield piece
+            held = []
+            chunk = chunk[start:]
+        held.append(chunk)
+    tail = b''.join(held)
+    match = URL_COMMENT_RE.search(tail)
+    if match is not None:
+        tail = tail[:match.start()]
+    if tail:
+        yield tail
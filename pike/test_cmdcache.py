@@ -0,0 +1,81 @@
+""" Tests for pike.cmdcache """
+import os
+
+from mock import patch
+
+from .test import BaseFileTest
+from pike.cmdcache import CommandCache
+
+
+class TestCommandCache(BaseFileTest):
+
+    """ Tests for the CommandCache """
+
+    def setUp(self):
+        super(TestCommandCache, self).setUp()
+        self.directory = os.path.join(self.tempdir, 'cmds')
+        patcher = patch.object(CommandCache, 'tool_version')
+        self.tool_version = patcher.start()
+        self.tool_version.return_value = '1.0'
+        self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        """ Outputs are stored and retrieved by key """
+        cache = CommandCache(self.directory)
+        key = cache.key(['lessc', '-'], '/src', 'abc')
+        self.assertIsNone(cache.get(key))
+        cache.put(key, b'output')
+        self.assertEqual(cache.get(key), b'output')
+
+    def test_persistent(self):
+        """ Outputs survive across cache instances """
+        cache = CommandCache(self.directory)
+        key = cache.key(['lessc', '-'], '/src', 'abc')
+        cache.put(key, b'output')
+        self.assertEqual(CommandCache(self.directory).get(key), b'output')
+
+    def test_key(self):
+        """ Keys depend on the command, version, input, and context """
+        cache = CommandCache(self.directory)
+        key = cache.key(['lessc', '-'], '/src', 'abc')
+        self.assertEqual(key, cache.key(['lessc', '-'], '/src', 'abc'))
+        self.assertNotEqual(key, cache.key(['lessc', '-x'], '/src', 'abc'))
+        self.assertNotEqual(key, cache.key(['lessc', '-'], '/lib', 'abc'))
+        self.assertNotEqual(key, cache.key(['lessc', '-'], '/src', 'abd'))
+        self.assertNotEqual(key, cache.key(['lessc', '-'], '/src', 'abc',
+                                           [('a.less', '123')]))
+        self.tool_version.return_value = '2.0'
+        self.assertNotEqual(key, cache.key(['lessc', '-'], '/src', 'abc'))
+
+    def test_relative_key(self):
+        """ Keys don't depend on where the project is checked out """
+        keys = []
+        for root in ('/work/a', '/work/b/'):
+            cache = CommandCache(self.directory, root=root)
+            src = os.path.join(root, 'src')
+            keys.append(cache.key(['cleancss', '--root', src], src, 'abc',
+                                  [(os.path.join(src, 'a.css'), '123')]))
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], cache.key(['cleancss'], '/src', 'abc'))
+
+    def test_lru(self):
+        """ The least recently used outputs are removed when over size """
+        cache = CommandCache(self.directory, max_size=10)
+        cache.put('aa1', b'1234')
+        cache.put('aa2', b'1234')
+        old = os.path.join(self.directory, 'aa', 'aa1')
+        os.utime(old, (0, 0))
+        cache.get('aa2')
+        cache.put('aa3', b'1234')
+        self.assertIsNone(cache.get('aa1'))
+        self.assertEqual(cache.get('aa2'), b'1234')
+        self.assertEqual(cache.get('aa3'), b'1234')
+        self.assertEqual(cache.size, 8)
+
+    def test_context(self):
+        """ The cache is active inside its context """
+        cache = CommandCache(self.directory)
+        self.assertIsNone(CommandCache.current())
+        with cache:
+            self.assertIs(CommandCache.current(), cache)
+        self.assertIsNone(CommandCache.current())
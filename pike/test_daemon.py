@@ -0,0 +1,87 @@
+""" Tests for pike.daemon """
+import os
+import subprocess
+import sys
+
+from .test import BaseFileTest
+from pike.daemon import Worker, WorkerPool, get_pool
+
+
+# Fake worker that upper-cases the source. It exits when asked to compile
+# 'crash' and returns an error for 'error'.
+FAKE_WORKER = r'''
+import json
+import os
+import sys
+
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    request = json.loads(line)
+    if request['source'] == 'crash':
+        sys.exit(1)
+    elif request['source'] == 'error':
+        response = {'error': 'bad source'}
+    else:
+        response = {'output': request['source'].upper(), 'pid': os.getpid()}
+    sys.stdout.write(json.dumps(response) + '\n')
+    sys.stdout.flush()
+'''
+
+
+class TestWorker(BaseFileTest):
+
+    """ Tests for the worker processes """
+
+    def setUp(self):
+        super(TestWorker, self).setUp()
+        self.make_files(**{'worker.py': FAKE_WORKER})
+        self.cmd = [sys.executable, os.path.join(self.tempdir, 'worker.py')]
+        self.worker = Worker(self.cmd)
+
+    def tearDown(self):
+        self.worker.close()
+        super(TestWorker, self).tearDown()
+
+    def test_reuse(self):
+        """ The worker process is reused across requests """
+        first = self.worker.request({'source': 'abc'})
+        second = self.worker.request({'source': 'def'})
+        self.assertEqual(first['output'], 'ABC')
+        self.assertEqual(second['output'], 'DEF')
+        self.assertEqual(first['pid'], second['pid'])
+
+    def test_error(self):
+        """ Error responses raise an exception """
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.worker.request({'source': 'error'})
+        self.assertTrue(self.worker.alive)
+
+    def test_restart(self):
+        """ A worker that has exited is restarted """
+        first = self.worker.request({'source': 'abc'})
+        self.worker.proc.kill()
+        self.worker.proc.wait()
+        second = self.worker.request({'source': 'abc'})
+        self.assertEqual(second['output'], 'ABC')
+        self.assertNotEqual(first['pid'], second['pid'])
+
+    def test_crash(self):
+        """ A request that keeps crashing the worker raises an exception """
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.worker.request({'source': 'crash'})
+        self.assertEqual(self.worker.request({'source': 'a'})['output'], 'A')
+
+    def test_pool(self):
+        """ Pools hand requests to their workers """
+        pool = WorkerPool(self.cmd, 2)
+        try:
+            self.assertEqual(pool.request({'source': 'a'})['output'], 'A')
+        finally:
+            pool.close()
+
+    def test_shared_pool(self):
+        """ Pools are shared between callers with the same command """
+        self.assertIs(get_pool(self.cmd), get_pool(self.cmd))
+        get_pool(self.cmd).close()
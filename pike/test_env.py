@@ -3,10 +3,27 @@ import os
 
 from mock import patch
 
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict  # pylint: disable=F0401
+
 import pike
+from pike.items import FileMeta, FileDataBlob
+from pike.sqlitedict import SqliteDict
 from .test import ParrotNode, BaseFileTest
 
 
+class GeneratorNode(pike.Node):
+
+    """ Node that passes its items through as a generator """
+
+    name = 'generator'
+
+    def process(self, stream):
+        return (item for item in stream)
+
+
 class TestEnvironment(BaseFileTest):
 
     """ Tests for the environment """
@@ -29,6 +46,32 @@ class TestEnvironment(BaseFileTest):
         ret = env.run('g', True)
         self.assertEqual(ret, {'default': [1, 2]})
 
+    def test_get_memoized(self):
+        """ Cached results are only unpacked again after a run or load """
+        env = pike.Environment()
+        self.make_files('foo')
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*')
+        env.add(graph)
+        env.run_all()
+        ret = env.get('g')
+        self.assertIs(env.get('g'), ret)
+        self.assertIsNot(env.run('g', True), ret)
+        ret = env.get('g')
+        env.save('env.pkl')
+        env.load('env.pkl')
+        self.assertIsNot(env.get('g'), ret)
+
+    def test_cache_without_sources(self):
+        """ Cached results do not store the provenance of each file """
+        env = pike.Environment()
+        self.make_files('foo')
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*')
+        env.add(graph)
+        ret = env.run('g')
+        self.assertFalse(hasattr(ret['default'][0], 'sources'))
+
     def test_watch_graph_caches(self):
         """ Watching a graph will raise StopProcessing if no file changes """
         self.make_files(foo='foo', bar='bar')
@@ -68,6 +111,105 @@ class TestEnvironment(BaseFileTest):
         self.assertItemsEqual([f.data.read() for f in ret['default']],
                               [b'foo', b'foo'])
 
+    def test_watch_graph_partial_removed(self):
+        """ Watching a graph with partial runs will drop removed files """
+        self.make_files(foo='foo', bar='bar')
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*')
+        watcher = pike.watch_graph(graph, partial=True)
+        watcher.run()
+        os.remove('bar')
+        ret = watcher.run()
+        self.assertEqual([f.data.read() for f in ret['default']], [b'foo'])
+
+    def test_watch_graph_partial_related(self):
+        """ Partial runs also rerun the files that share an output """
+        self.make_files(foo='foo', bar='bar', baz='baz')
+        with pike.Graph('g') as graph:
+            merge = pike.glob('.', 'foo:bar') | pike.concat('all') | \
+                pike.merge()
+            pike.glob('.', 'baz') | merge
+        watcher = pike.watch_graph(graph, partial=True)
+        ret = watcher.run()
+        self.assertItemsEqual([f.data.read() for f in ret['default']],
+                              [b'foo\nbar', b'baz'])
+        self.make_files(foo='foo2')
+        ret = watcher.run()
+        self.assertItemsEqual([f.data.read() for f in ret['default']],
+                              [b'foo2\nbar', b'baz'])
+        os.remove('foo')
+        ret = watcher.run()
+        self.assertItemsEqual([f.data.read() for f in ret['default']],
+                              [b'bar', b'baz'])
+
+    def test_watch_graph_partial_concat_removed(self):
+        """ Removed files are dropped from a partial concat """
+        self.make_files(**{'src/a.js': 'aaa', 'src/b.js': 'bbb',
+                           'src/c.js': 'ccc'})
+        with pike.Graph('g') as graph:
+            pike.glob('src', '*.js') | pike.concat('all.js', partial=True)
+        watcher = pike.watch_graph(graph, partial=True)
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'aaa\nbbb\nccc')
+        self.make_files(**{'src/b.js': 'BBB'})
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'aaa\nBBB\nccc')
+        os.remove(os.path.join('src', 'b.js'))
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'aaa\nccc')
+
+    def test_watch_graph_partial_iterators(self):
+        """ Provenance survives nodes that return one-shot iterators """
+        self.make_files(**{'src/a.js': 'aaa', 'src/b.js': 'bbb',
+                           'src/c.js': 'ccc'})
+        with pike.Graph('g') as graph:
+            pike.glob('src', '*.js') | GeneratorNode() | \
+                pike.filter(lambda item: True) | pike.concat('all.js')
+        watcher = pike.watch_graph(graph, partial=True)
+        watcher.run()
+        self.make_files(**{'src/b.js': 'BBB'})
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'aaa\nBBB\nccc')
+
+    def test_watch_graph_partial_added(self):
+        """ Added files rerun every file that goes into the same output """
+        self.make_files(**{'src/a.js': 'A', 'src/b.js': 'B'})
+        with pike.Graph('g') as graph:
+            pike.glob('src', '*.js') | pike.concat('all.js')
+        watcher = pike.watch_graph(graph, partial=True)
+        watcher.run()
+        self.make_files(**{'src/c.js': 'C'})
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'A\nB\nC')
+        self.make_files(**{'src/a.js': 'A2'})
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'A2\nB\nC')
+
+    def test_watch_graph_partial_migrated(self):
+        """ Cached outputs with no recorded sources rerun every file """
+        self.make_files(**{'src/a.js': 'A', 'src/b.js': 'B'})
+        with pike.Graph('g') as graph:
+            pike.glob('src', '*.js') | pike.concat('all.js')
+        watcher = pike.watch_graph(graph, partial=True, cache='cache.db')
+        watcher.run()
+        # Rewrite the cache the way older versions stored it
+        cache = SqliteDict('cache.db', 'g_cache', autocommit=False)
+        items = OrderedDict()
+        for key in list(cache.keys()):
+            item = cache.pop(key)
+            if key.startswith('#'):
+                continue
+            item = item[1]
+            del item.sources
+            items[item.fullpath] = item
+        cache['default'] = items
+        cache.commit()
+        cache.close()
+        watcher = pike.watch_graph(graph, partial=True, cache='cache.db')
+        self.make_files(**{'src/a.js': 'A2'})
+        ret = watcher.run()
+        self.assertEqual(ret['default'][0].data.read(), b'A2\nB')
+
     def test_unique(self):
         """ Graphs must have unique names in an Environment """
         env = pike.Environment()
@@ -88,6 +230,18 @@ class TestEnvironment(BaseFileTest):
         ret = env.lookup('foo')
         self.assertEqual(ret, os.path.join('.', 'foo'))
 
+    def test_lookup_fingerprint(self):
+        """ Lookup resolves the original name of a fingerprinted file """
+        env = pike.Environment()
+        self.make_files('foo.js')
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*') | pike.fingerprint()
+        env.add(graph)
+        env.run_all()
+        ret = env.lookup('foo.js')
+        self.assertIsNotNone(ret)
+        self.assertRegexpMatches(ret, r'foo\.[0-9a-f]{8}\.js$')
+
     def test_lookup_missing(self):
         """ Lookup if missing returns None """
         env = pike.Environment()
@@ -142,3 +296,17 @@ class TestEnvironment(BaseFileTest):
         self.assertEqual(removed, [os.path.abspath('bar.js')])
         self.assertTrue(os.path.exists('foo.py'))
         self.assertTrue(os.path.exists('bar.js'))
+
+    def test_max_memory(self):
+        """ Graphs still produce their output when blobs are spilled """
+        self.make_files(foo='foo')
+        env = pike.Environment(max_memory=0)
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*') | pike.map(
+                lambda item: FileMeta(item.filename, 'out',
+                                      FileDataBlob(b'bar'))) | \
+                pike.write('out')
+        env.add(graph)
+        env.run_all()
+        with open(os.path.join('out', 'foo'), 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'bar')
@@ -1,8 +1,11 @@
 """ Tests for graph constructs """
+import os
+
 import pike
 from .test import ParrotNode
 from pike import Node, Edge, Graph
 from pike.graph import ValidationError, topo_sort
+from pike.items import FileMeta, FileDataBlob
 
 
 try:
@@ -172,3 +175,30 @@ class TestGraph(unittest.TestCase):
             graph.nodes.insert(graph.nodes.index(a), b)
         ret = graph.run()
         self.assertEqual(list(ret['default']), ['a', 'b'])
+
+    def test_fan_out_copy_on_write(self):
+        """ Mutating an item on one branch does not affect other branches """
+        item = FileMeta('foo.less', '.', FileDataBlob(b'a'))
+        with Graph('g') as graph:
+            p = ParrotNode({'default': [item], 'other': [item]})
+            p.outputs = ('default', 'other')
+            p | pike.map(lambda x: x.setext('.css') or x) | graph.sink
+            p * 'other' | 'other' * graph.sink
+        ret = graph.run()
+        self.assertEqual(ret['default'][0].filename, 'foo.css')
+        self.assertEqual(ret['other'][0].filename, 'foo.less')
+        self.assertEqual(item.filename, 'foo.less')
+
+    def test_record_sources(self):
+        """ Items remember the source files they were made from """
+        a = FileMeta('a.js', 'src', FileDataBlob(b'a'))
+        b = FileMeta('b.js', 'src', FileDataBlob(b'b'))
+        with Graph('g') as graph:
+            ParrotNode([a, b]) | pike.map(lambda x: x.setext('.min.js') or x) \
+                | pike.concat('all.js')
+        ret = graph.run()
+        paths = [os.path.join('src', 'a.js'), os.path.join('src', 'b.js')]
+        # Renamed items keep their source
+        self.assertEqual(a.sources, frozenset(paths[:1]))
+        # New items are made from all of the inputs
+        self.assertEqual(ret['default'][0].sources, frozenset(paths))
@@ -0,0 +1,311 @@
+""" Tests for pike.items """
+import contextlib
+import os
+import threading
+from hashlib import md5  # pylint: disable=E0611
+
+from mock import patch
+
+import pike
+from .test import BaseFileTest, unittest
+from pike.items import (FileDataFile, FileDataMmap, FileDataBlob,
+                        FileDataStream, FileDataConcat, FileMeta,
+                        PackedResults, BlobStore, spool_chunks)
+import six
+from six import BytesIO
+from six.moves import cPickle as pickle  # pylint: disable=F0401
+
+
+class TestFileData(BaseFileTest):
+
+    """ Tests for the IFileData implementations """
+
+    def test_mmap_read(self):
+        """ Memory-mapped file data reads the file contents """
+        self.make_files(foo='abcdef')
+        data = FileDataMmap('foo')
+        self.assertEqual(data.read(), b'abcdef')
+        with data.buffer() as buf:
+            self.assertEqual(bytearray(buf[2:4]), b'cd')
+
+    @unittest.skipIf(not os.path.isdir('/proc/self/fd'),
+                     "Needs /proc to count file descriptors")
+    def test_mmap_unmapped(self):
+        """ Memory-mapped file data does not hold on to file descriptors """
+        self.make_files(foo='abcdef')
+        before = len(os.listdir('/proc/self/fd'))
+        datas = [FileDataMmap('foo') for _ in range(10)]
+        for data in datas:
+            self.assertEqual(b''.join(bytes(c) for c in data.iter_chunks(2)),
+                             b'abcdef')
+            data.digest()
+        self.assertEqual(len(os.listdir('/proc/self/fd')), before)
+
+    def test_mmap_empty(self):
+        """ Memory-mapping an empty file returns empty data """
+        self.make_files(foo='')
+        self.assertEqual(FileDataMmap('foo').read(), b'')
+
+    def test_mmap_as_file(self):
+        """ Memory-mapped file data can be written to another file """
+        self.make_files(foo='abcdef')
+        FileDataMmap('foo').as_file(os.path.join('out', 'bar'))
+        with open(os.path.join('out', 'bar'), 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'abcdef')
+
+    def test_iter_chunks(self):
+        """ All file data implementations can be read in chunks """
+        self.make_files(foo='abcdefg')
+        datas = [
+            FileDataFile('foo'),
+            FileDataMmap('foo'),
+            FileDataBlob(b'abcdefg'),
+            FileDataStream(BytesIO(b'abcdefg')),
+        ]
+        for data in datas:
+            chunks = [bytearray(chunk) for chunk in data.iter_chunks(3)]
+            self.assertEqual(chunks, [b'abc', b'def', b'g'])
+
+    def test_default_iter_chunks(self):
+        """ Data that only implements open() can be read in chunks """
+        class OpenOnly(pike.items.IFileData):
+
+            """ File data that only implements open() """
+
+            def open(self):
+                return contextlib.closing(BytesIO(b'abcdefg'))
+        data = OpenOnly()
+        chunks = list(data.iter_chunks(3))
+        self.assertEqual(chunks, [b'abc', b'def', b'g'])
+        self.assertEqual(data.size(), 7)
+
+    def test_spool_chunks(self):
+        """ Spooling chunks produces a stream that can be read repeatedly """
+        data = spool_chunks([b'abc', b'def'], max_size=4)
+        self.assertEqual(data.read(), b'abcdef')
+        self.assertEqual(data.read(), b'abcdef')
+
+    def test_concat(self):
+        """ Concatenated data streams each part with the join string """
+        self.make_files(foo='abc')
+        data = FileDataConcat([FileDataMmap('foo'), FileDataBlob(b'de')],
+                              six.u('\n'))
+        self.assertEqual(data.read(), b'abc\nde')
+        self.assertEqual(data.size(), 6)
+        with data.open() as stream:
+            self.assertEqual(stream.read(2), b'ab')
+            self.assertEqual(stream.read(3), b'c\nd')
+            self.assertEqual(stream.read(), b'e')
+
+    def test_concat_as_file(self):
+        """ Writing concatenated data to a file also computes the digest """
+        data = FileDataConcat([FileDataBlob(b'abc'), FileDataBlob(b'de')])
+        with patch.object(data, 'read') as read:
+            data.as_file(os.path.join('out', 'bar'))
+            self.assertEqual(data.digest(), md5(b'abcde').hexdigest())
+            self.assertFalse(read.called)
+        with open(os.path.join('out', 'bar'), 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'abcde')
+
+    def test_pickle_concat(self):
+        """ Pickling concatenated data stores the joined contents """
+        data = FileDataConcat([FileDataBlob(b'abc'), FileDataBlob(b'de')],
+                              b'-')
+        loaded = pickle.loads(pickle.dumps(data))
+        self.assertEqual(loaded.read(), b'abc-de')
+
+    def test_blob_digest(self):
+        """ Blob digests are memoized and reset when the data is replaced """
+        data = FileDataBlob(b'abc')
+        self.assertEqual(data.digest(), md5(b'abc').hexdigest())
+        with patch('pike.items.md5chunks') as md5chunks:
+            data.digest()
+            self.assertFalse(md5chunks.called)
+        data.data = b'def'
+        self.assertEqual(data.digest(), md5(b'def').hexdigest())
+
+    def test_file_digest(self):
+        """ File digests are memoized until the file changes """
+        self.make_files(foo='abc')
+        self.assertEqual(FileDataFile('foo').digest(),
+                         md5(b'abc').hexdigest())
+        with patch('pike.items.md5chunks') as md5chunks:
+            FileDataFile('foo').digest()
+            self.assertFalse(md5chunks.called)
+        self.make_files(foo='abcd')
+        self.assertEqual(FileDataFile('foo').digest(),
+                         md5(b'abcd').hexdigest())
+
+    def test_source_mmap_threshold(self):
+        """ Source nodes memory-map files above the size threshold """
+        self.make_files(small='a', large='a' * 100)
+        with pike.Graph('g') as graph:
+            pike.glob('.', '*', mmap_threshold=50)
+        ret = graph.run()
+        datas = dict((item.filename, item.data) for item in ret['default'])
+        self.assertIsInstance(datas['large'], FileDataMmap)
+        self.assertNotIsInstance(datas['small'], FileDataMmap)
+        self.assertIsInstance(datas['small'], FileDataFile)
+
+
+class TestBlobStore(BaseFileTest):
+
+    """ Tests for spilling blobs to disk """
+
+    def test_spill(self):
+        """ Blobs over the memory limit are spilled to disk """
+        store = BlobStore(5, self.tempdir)
+        with store:
+            first = FileDataBlob(b'abc')
+            second = FileDataBlob(b'def')
+        self.assertEqual(store.size, 3)
+        self.assertIsNone(first._data)  # pylint: disable=W0212
+        self.assertEqual(first.read(), b'abc')
+        with first.open() as stream:
+            self.assertEqual(stream.read(), b'abc')
+        self.assertEqual([bytes(c) for c in first.iter_chunks(2)],
+                         [b'ab', b'c'])
+        first.as_file('out')
+        with open('out', 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'abc')
+        self.assertEqual(second.read(), b'def')
+        store.close()
+
+    def test_other_threads(self):
+        """ Blobs created by other threads are tracked by the store """
+        store = BlobStore(0, self.tempdir)
+        blobs = []
+        with store:
+            thread = threading.Thread(
+                target=lambda: blobs.append(FileDataBlob(b'abc')))
+            thread.start()
+            thread.join()
+        spilled = blobs[0]._spill_path  # pylint: disable=W0212
+        self.assertTrue(os.path.exists(spilled))
+        del blobs[:]
+        self.assertFalse(os.path.exists(spilled))
+        store.close()
+
+    def test_collect_spilled(self):
+        """ Spilled data is deleted when the blob is garbage collected """
+        store = BlobStore(0, self.tempdir)
+        with store:
+            blob = FileDataBlob(b'abc')
+        spilled = blob._spill_path  # pylint: disable=W0212
+        self.assertTrue(os.path.exists(spilled))
+        del blob
+        self.assertFalse(os.path.exists(spilled))
+        store.close()
+
+    def test_pickle_spilled(self):
+        """ Pickling a spilled blob includes its data """
+        store = BlobStore(0, self.tempdir)
+        with store:
+            blob = FileDataBlob(b'abc')
+        clone = pickle.loads(pickle.dumps(blob, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(clone.read(), b'abc')
+        store.close()
+
+
+class TestFileMeta(BaseFileTest):
+
+    """ Tests for FileMeta """
+
+    def test_extra_attributes(self):
+        """ FileMeta can store arbitrary attributes """
+        item = FileMeta('foo', '.', FileDataBlob(b'a'), mode='b')
+        item.other = 1
+        self.assertEqual(item.mode, 'b')
+        self.assertEqual(item.other, 1)
+        with self.assertRaises(AttributeError):
+            item.url  # pylint: disable=W0104
+
+    def test_pickle(self):
+        """ FileMeta can be pickled with all of its attributes """
+        item = FileMeta('foo', '.', FileDataBlob(b'a'), url='/foo', other=1)
+        clone = pickle.loads(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(clone, item)
+        self.assertEqual(clone.url, '/foo')
+        self.assertEqual(clone.other, 1)
+        self.assertEqual(clone.data.read(), b'a')
+
+    def test_sources_slot(self):
+        """ The sources of a FileMeta are stored in a slot """
+        item = FileMeta('foo', '.', FileDataBlob(b'a'),
+                        sources=frozenset(['src/foo']))
+        self.assertNotIn('sources', item.__dict__)
+        clone = pickle.loads(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(clone.sources, frozenset(['src/foo']))
+
+    def test_unpickle_dict_state(self):
+        """ FileMeta can load the state of pickles with no slots """
+        item = FileMeta.__new__(FileMeta)
+        item.__setstate__({'filename': 'foo', 'path': '.', 'url': '/foo',
+                           'data': FileDataBlob(b'a'), 'other': 1})
+        self.assertEqual(item.fullpath, os.path.join('.', 'foo'))
+        self.assertEqual(item.url, '/foo')
+        self.assertEqual(item.other, 1)
+
+    def test_view(self):
+        """ Views read from the base item until an attribute is set """
+        item = FileMeta('foo.less', '.', FileDataBlob(b'a'), extra=1)
+        view = item.view()
+        self.assertEqual(view, item)
+        self.assertEqual(view.extra, 1)
+        self.assertIs(view.data, item.data)
+        view.setext('.css')
+        view.data = FileDataBlob(b'b')
+        view.extra = 2
+        self.assertEqual(view.filename, 'foo.css')
+        self.assertEqual(item.filename, 'foo.less')
+        self.assertEqual(item.data.read(), b'a')
+        self.assertEqual(item.extra, 1)
+
+    def test_pickle_view(self):
+        """ Pickling a view includes the attributes of the base item """
+        item = FileMeta('foo', '.', FileDataBlob(b'a'), extra=1)
+        view = item.view()
+        view.url = '/foo'
+        clone = pickle.loads(pickle.dumps(view, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(clone, item)
+        self.assertEqual(clone.url, '/foo')
+        self.assertEqual(clone.extra, 1)
+        self.assertEqual(clone.data.read(), b'a')
+
+
+class TestPackedResults(BaseFileTest):
+
+    """ Tests for the compact result encoding """
+
+    def test_round_trip(self):
+        """ Packing and unpacking results preserves the FileMeta values """
+        results = {
+            'default': [
+                FileMeta('js/app.js', 'gen/out', FileDataBlob(b'a'),
+                         url='/gen/js/app.js'),
+                FileMeta('js/lib.js', 'gen/out', FileDataBlob(b'b'), x=1),
+                'other',
+            ],
+            'count': 2,
+        }
+        packed = pickle.loads(pickle.dumps(PackedResults(results)))
+        unpacked = packed.unpack()
+        self.assertEqual(unpacked['count'], 2)
+        app, lib, other = unpacked['default']
+        self.assertEqual(app, results['default'][0])
+        self.assertEqual(app.url, '/gen/js/app.js')
+        self.assertEqual(lib, results['default'][1])
+        self.assertEqual(lib.x, 1)
+        self.assertEqual(other, 'other')
+        self.assertFalse(hasattr(app, 'data'))
+        # The shared path prefix is only created once
+        self.assertIs(app.path, lib.path)
+
+    def test_exclude(self):
+        """ Excluded attributes are not packed """
+        item = FileMeta('app.js', 'gen', sources=frozenset(['src/app.js']),
+                        x=1)
+        unpacked = PackedResults({'default': [item]},
+                                 exclude=('sources',)).unpack()
+        self.assertFalse(hasattr(unpacked['default'][0], 'sources'))
+        self.assertEqual(unpacked['default'][0].x, 1)
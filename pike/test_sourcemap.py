@@ -0,0 +1,91 @@
+""" Tests for pike.sourcemap """
+import six
+
+from pike import sourcemap
+
+
+try:
+    import unittest2 as unittest  # pylint: disable=F0401
+except ImportError:
+    import unittest
+
+
+class TestSourceMap(unittest.TestCase):
+
+    """ Tests for encoding and combining source maps """
+
+    def test_vlq_round_trip(self):
+        """ VLQ encoding can be decoded """
+        values = [0, 1, -1, 15, 16, -17, 123456]
+        encoded = sourcemap.vlq_encode(values)
+        self.assertEqual(sourcemap.vlq_decode(encoded), values)
+
+    def test_vlq_known_values(self):
+        """ VLQ encoding matches the source map spec """
+        self.assertEqual(sourcemap.vlq_encode([0, 0, 0, 0]), 'AAAA')
+        self.assertEqual(sourcemap.vlq_encode([16]), 'gB')
+        self.assertEqual(sourcemap.vlq_decode('D'), [-1])
+
+    def test_mappings_round_trip(self):
+        """ Decoding and encoding mappings preserves them """
+        mappings = 'AAAA,EAAE;;AACA,IAAIA;C'
+        lines = sourcemap.decode_mappings(mappings)
+        self.assertEqual(lines[0], [(0, 0, 0, 0), (2, 0, 0, 2)])
+        self.assertEqual(lines[1], [])
+        self.assertEqual(lines[2], [(0, 0, 1, 2), (4, 0, 1, 6, 0)])
+        self.assertEqual(lines[3], [(1,)])
+        self.assertEqual(sourcemap.encode_mappings(lines), mappings)
+
+    def test_advance(self):
+        """ Advancing over text tracks the line and column """
+        self.assertEqual(sourcemap.advance(0, 3, b'abc'), (0, 6))
+        self.assertEqual(sourcemap.advance(0, 3, b'a\nbc\nd'), (2, 1))
+        self.assertEqual(sourcemap.advance(1, 0, six.u('\n')), (2, 0))
+
+    def test_concat(self):
+        """ Concatenated maps shift mappings and source indexes """
+        first = {
+            'version': 3,
+            'sources': ['a.coffee'],
+            'names': ['foo'],
+            'mappings': 'AAAAA;AACA',
+        }
+        second = {
+            'version': 3,
+            'sourceRoot': 'lib',
+            'sources': ['b.coffee'],
+            'names': ['bar'],
+            'sourcesContent': ['x = 1'],
+            'mappings': 'AAAAA',
+        }
+        combined = sourcemap.concat_maps([(0, 0, first), (3, 2, second)],
+                                         'out.js')
+        self.assertEqual(combined['file'], 'out.js')
+        self.assertEqual(combined['sources'], ['a.coffee', 'lib/b.coffee'])
+        self.assertEqual(combined['names'], ['foo', 'bar'])
+        self.assertEqual(combined['sourcesContent'], [None, 'x = 1'])
+        lines = sourcemap.decode_mappings(combined['mappings'])
+        self.assertEqual(lines, [
+            [(0, 0, 0, 0, 0)],
+            [(0, 0, 1, 0)],
+            [],
+            [(2, 1, 0, 0, 1)],
+        ])
+
+    def test_strip_url(self):
+        """ The sourceMappingURL comment is removed from the last line """
+        chunks = [b'a\n// sourceMappingURL=x\n', b'b\n//# source',
+                  b'MappingURL=', b'a.map\n']
+        self.assertEqual(b''.join(sourcemap.strip_url(chunks)),
+                         b'a\n// sourceMappingURL=x\nb\n')
+        chunks = [b'a {}\n/*# sourceMappingURL=a.map */']
+        self.assertEqual(b''.join(sourcemap.strip_url(chunks)), b'a {}\n')
+        chunks = [b'a = "//# sourceMappingURL=a.map"']
+        self.assertEqual(b''.join(sourcemap.strip_url(chunks)), chunks[0])
+
+    def test_url_comment(self):
+        """ CSS files link to their map with a block comment """
+        self.assertEqual(sourcemap.url_comment('a.js', 'a.map'),
+                         b'//# sourceMappingURL=a.map')
+        self.assertEqual(sourcemap.url_comment('a.css', 'a.map'),
+                         b'/*# sourceMappingURL=a.map */')
@@ -1,9 +1,15 @@
 """ Tests for pike.util """
 import six
 import os
+import sys
+import threading
+import time
+
+from mock import patch
 
 from .test import BaseFileTest
 from pike import util, sqlitedict
+from pike.items import FileDataMmap
 
 
 class TestFileMatch(BaseFileTest):
@@ -62,6 +68,97 @@ class TestFileMatch(BaseFileTest):
         self.assertEquals(results, ['app.js'])
 
 
+class TestCopyFile(BaseFileTest):
+
+    """ Tests for copying files """
+
+    def test_copy_methods(self):
+        """ All copy methods produce an identical file """
+        self.make_files(foo='abc' * 1000)
+        for method in util.COPY_METHODS:
+            dest = os.path.join('out', method)
+            used = util.copy_file('foo', dest, (method, 'copy'))
+            self.assertIn(used, (method, 'copy'))
+            with open(dest, 'rb') as ifile:
+                self.assertEqual(ifile.read(), b'abc' * 1000)
+
+    def test_link(self):
+        """ The 'link' copy method creates a hard link """
+        self.make_files(foo='abc')
+        used = util.copy_file('foo', 'bar', ('link', 'copy'))
+        self.assertEqual(used, 'link')
+        self.assertTrue(os.path.samefile('foo', 'bar'))
+
+    def test_fallback(self):
+        """ If a copy method fails, fall back to the next one """
+        self.make_files(foo='abc')
+        with patch.object(util, '_sendfile') as sendfile:
+            sendfile.side_effect = OSError
+            used = util.copy_file('foo', 'bar', ('sendfile', 'copy'))
+        self.assertEqual(used, 'copy')
+        with open('bar', 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'abc')
+
+
+class TestToText(BaseFileTest):
+
+    """ Tests for to_text """
+
+    def test_convert(self):
+        """ Strings, bytes, and memory-mapped buffers become text """
+        self.make_files(foo=six.u('\u00e9').encode('utf-8'))
+        datas = [six.u('\u00e9'), six.u('\u00e9').encode('utf-8'),
+                 next(FileDataMmap('foo').iter_chunks())]
+        for data in datas:
+            self.assertEqual(util.to_text(data), six.u('\u00e9'))
+
+    def test_to_bytes(self):
+        """ Buffers become bytes """
+        self.make_files(foo='abc')
+        datas = [b'abc', bytearray(b'abc'),
+                 next(FileDataMmap('foo').iter_chunks())]
+        for data in datas:
+            self.assertEqual(util.to_bytes(data), b'abc')
+
+
+class TestCommandPool(BaseFileTest):
+
+    """ Tests for running commands concurrently """
+
+    def tearDown(self):
+        super(TestCommandPool, self).tearDown()
+        util.CommandPool.limit = util.CommandPool._slots = None
+
+    def test_run_ordered(self):
+        """ Command outputs are returned in the order of the inputs """
+        cmd = [sys.executable, '-c', 'import sys; '
+               'sys.stdout.write(sys.stdin.read().upper())']
+        outputs = util.CommandPool(4).run(cmd, [b'a', b'b', b'c', b'd'])
+        self.assertEqual(outputs, [b'A', b'B', b'C', b'D'])
+
+    def test_limit(self):
+        """ The number of running commands is limited globally """
+        util.CommandPool.set_limit(2)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def fake_communicate(_):
+            """ Track the number of commands running at once """
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return b'', b''
+
+        with patch('subprocess.Popen') as popen:
+            popen.return_value.communicate.side_effect = fake_communicate
+            popen.return_value.returncode = 0
+            util.CommandPool(8).run(['cmd'], [b'x'] * 8)
+        self.assertEqual(running[1], 2)
+
+
 class TestSqliteDict(BaseFileTest):
 
     """ Tests for sqlitedict """
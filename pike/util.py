@@ -1,4 +1,5 @@
 """ Utilities for pike. """
+import errno
 import fnmatch
 import locale
 import os
@@ -12,7 +13,10 @@ import shutil
 import six
 import subprocess
 import tempfile
+import threading
 from hashlib import md5  # pylint: disable=E0611
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from uuid import uuid1
 
 
@@ -77,10 +81,114 @@ def tempd():
         shutil.rmtree(dirname)
 
 
+class CommandPool(object):
+
+    """
+    Run many commands concurrently.
+
+    All commands started by :meth:`~.run_cmd` share a global limit on the
+    number of processes running at once, which defaults to the number of
+    CPUs. A pool runs commands from multiple threads so that a single node
+    can use all of that limit.
+
+    Parameters
+    ----------
+    threads : int, optional
+        Number of threads to run commands from (defaults to the global limit)
+
+    Examples
+    --------
+    ::
+
+        outputs = CommandPool().run(['uglifyjs', '-'], [data1, data2])
+
+    """
+    limit = None
+    _slots = None
+    _slots_lock = threading.Lock()
+
+    def __init__(self, threads=None):
+        self.threads = threads or self.get_limit()
+
+    @classmethod
+    def get_limit(cls):
+        """ Get the maximum number of commands that may run at once """
+        if cls.limit is None:
+            try:
+                cls.limit = cpu_count()
+            except NotImplementedError:
+                cls.limit = 1
+        return cls.limit
+
+    @classmethod
+    def set_limit(cls, limit):
+        """ Set the maximum number of commands that may run at once """
+        with cls._slots_lock:
+            cls.limit = limit
+            cls._slots = threading.BoundedSemaphore(limit)
+
+    @classmethod
+    def slots(cls):
+        """ Get the semaphore that limits the number of running commands """
+        with cls._slots_lock:
+            if cls._slots is None:
+                cls._slots = threading.BoundedSemaphore(cls.get_limit())
+            return cls._slots
+
+    def map(self, func, args):
+        """
+        Call a function on each argument from multiple threads.
+
+        Parameters
+        ----------
+        func : callable
+        args : list
+
+        Returns
+        -------
+        results : list
+            The results of each call, in the same order as ``args``
+
+        """
+        args = list(args)
+        if self.threads <= 1 or len(args) <= 1:
+            return [func(arg) for arg in args]
+        pool = ThreadPool(min(self.threads, len(args)))
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run(self, cmd, stdins, cwd=None):
+        """
+        Run a command once for each stdin payload.
+
+        Parameters
+        ----------
+        cmd : list or str
+            The command to be run in the shell
+        stdins : list
+            The data to pass to each run of the command
+        cwd : str, optional
+            Before running the command, cd into this directory
+
+        Returns
+        -------
+        outputs : list
+            The stdout of each process, in the same order as ``stdins``
+
+        """
+        return self.map(lambda stdin: run_cmd(cmd, stdin, cwd), stdins)
+
+
 def run_cmd(cmd, stdin=None, cwd=None):
     """
     Shortcut for running a shell command.
 
+    The number of commands running at once is limited by
+    :class:`~.CommandPool`.
+
     Parameters
     ----------
     cmd : list or str
@@ -106,14 +214,18 @@ def run_cmd(cmd, stdin=None, cwd=None):
 
     encoding = locale.getdefaultlocale()[1] or 'utf-8'
     if stdin is not None:
-        if not isinstance(stdin, six.binary_type):
+        if isinstance(stdin, six.text_type):
             stdin = stdin.encode(encoding)
+        elif not isinstance(stdin, six.binary_type):
+            # Buffers, such as memory-mapped file data
+            stdin = bytes(stdin)
         inpipe = subprocess.PIPE
     else:
         inpipe = None
-    proc = subprocess.Popen(cmd, stdin=inpipe, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, cwd=cwd)
-    stdout, stderr = proc.communicate(stdin)
+    with CommandPool.slots():
+        proc = subprocess.Popen(cmd, stdin=inpipe, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=cwd)
+        stdout, stderr = proc.communicate(stdin)
     if proc.returncode != 0:
         raise subprocess.CalledProcessError(proc.returncode, cmd,
                                             stdout + stderr)
@@ -122,39 +234,225 @@ def run_cmd(cmd, stdin=None, cwd=None):
     return stdout
 
 
+def to_text(data):
+    """
+    Convert file data into text.
+
+    Parameters
+    ----------
+    data : str, bytes, or buffer
+        File data, or a chunk from
+        :meth:`~pike.items.IFileData.iter_chunks`
+
+    Returns
+    -------
+    text : unicode
+
+    """
+    if isinstance(data, six.text_type):
+        return data
+    return to_bytes(data).decode('utf-8')
+
+
+def to_bytes(data):
+    """
+    Convert file data to a byte string.
+
+    Parameters
+    ----------
+    data : bytes or buffer
+        A chunk from :meth:`~pike.items.IFileData.iter_chunks`, which may be
+        a ``memoryview`` or a ``buffer``
+
+    Returns
+    -------
+    data : bytes
+
+    """
+    if isinstance(data, six.binary_type):
+        return data
+    # memoryview doesn't exist on Python 2.6, and bytes() of a memoryview on
+    # Python 2 is its repr
+    if hasattr(data, 'tobytes'):
+        return data.tobytes()
+    return bytes(data)
+
+
 @contextlib.contextmanager
 def atomic_open(filename, mode):
     """ Open a tmpfile and rename it to dest file after """
     dirname = os.path.dirname(filename)
     basename = os.path.basename(filename)
-    if not os.path.exists(dirname):
+    tmp = os.path.join(dirname, '.' + basename + '.tmp.' + uuid1().hex)
+    # Only check for the directory if the open fails. Writers that create
+    # many files will usually have created the directories already.
+    try:
+        ofile = open(tmp, mode)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        makedirs(dirname)
+        ofile = open(tmp, mode)
+    renamed = False
+    try:
+        with ofile:
+            yield ofile
+        os.rename(tmp, filename)
+        renamed = True
+    finally:
+        if not renamed:
+            try:
+                os.remove(tmp)
+            except os.error:
+                pass
+
+
+def makedirs(dirname):
+    """ Create a directory and any parents if it does not exist """
+    if dirname and not os.path.isdir(dirname):
         try:
             os.makedirs(dirname)
         except os.error:
             # can happen if there's a race condition and two threads try to
             # make it at the same time
-            pass
-    tmp = os.path.join(dirname, '.' + basename + '.tmp.' + uuid1().hex)
+            if not os.path.isdir(dirname):
+                raise
+
+
+def fsync_dir(dirname):
+    """ Flush the entries of a directory to disk """
     try:
-        yield open(tmp, mode)
-        os.rename(tmp, filename)
+        fd = os.open(dirname or os.curdir, os.O_RDONLY)
+    except os.error:
+        # Some platforms (Windows) can't open directories
+        return
+    try:
+        os.fsync(fd)
+    except os.error:
+        pass
+    finally:
+        os.close(fd)
+
+
+# All the methods that :meth:`~.copy_file` knows how to use
+COPY_METHODS = ('link', 'copy_file_range', 'sendfile', 'copy')
+# Methods to use when the source file may be modified after the copy
+DEFAULT_COPY_METHODS = ('copy_file_range', 'sendfile', 'copy')
+
+
+def _link(src, dst):
+    """ Atomically replace ``dst`` with a hard link to ``src`` """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    dirname = os.path.dirname(dst)
+    makedirs(dirname)
+    tmp = os.path.join(dirname, '.' + os.path.basename(dst) + '.tmp.' +
+                       uuid1().hex)
+    os.link(src, tmp)
+    try:
+        os.rename(tmp, dst)
     finally:
         if os.path.exists(tmp):
             os.remove(tmp)
 
 
+def _copy_file_range(ifile, ofile):
+    """ Copy file data inside the kernel with copy_file_range(2) """
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is None:
+        raise OSError("copy_file_range is not supported")
+    while copy_range(ifile.fileno(), ofile.fileno(), 1024 * 1024 * 1024):
+        pass
+
+
+def _sendfile(ifile, ofile):
+    """ Copy file data inside the kernel with sendfile(2) """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None:
+        raise OSError("sendfile is not supported")
+    offset = 0
+    while True:
+        sent = sendfile(ofile.fileno(), ifile.fileno(), offset,
+                        1024 * 1024 * 1024)
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _copy(ifile, ofile):
+    """ Copy file data through userspace """
+    shutil.copyfileobj(ifile, ofile, 64 * 1024)
+
+
+def copy_file(src, dst, methods=DEFAULT_COPY_METHODS):
+    """
+    Copy a file using the fastest available method.
+
+    Each method is tried in order until one succeeds. Unlike
+    :meth:`shutil.copy`, this does not copy the permission bits, and the
+    destination file is replaced atomically.
+
+    Parameters
+    ----------
+    src : str
+        Path to the source file
+    dst : str
+        Path to the destination file
+    methods : list, optional
+        The copy methods to try, chosen from :data:`~.COPY_METHODS`. 'link'
+        will make ``dst`` a hard link to ``src``, which is only safe if
+        ``src`` is never modified in place. (default
+        :data:`~.DEFAULT_COPY_METHODS`)
+
+    Returns
+    -------
+    method : str
+        The method that was used to copy the file
+
+    """
+    copiers = {
+        'copy_file_range': _copy_file_range,
+        'sendfile': _sendfile,
+        'copy': _copy,
+    }
+    for method in methods:
+        if method == 'link':
+            try:
+                _link(src, dst)
+                return method
+            except os.error:
+                # Most likely the files are on different filesystems
+                continue
+        copier = copiers[method]
+        try:
+            with open(src, 'rb') as ifile:
+                with atomic_open(dst, 'wb') as ofile:
+                    copier(ifile, ofile)
+            return method
+        except os.error as e:
+            if method == methods[-1]:
+                raise
+            LOG.debug("Copy method %r failed: %s", method, e)
+    raise ValueError("No copy method succeeded for %s" % src)
+
+
 def md5sum(filename):
     """ Calculate the md5 checksum of a file. """
     if not os.path.exists(filename):
         raise os.error("md5(%s) failure, file not found" % filename)
-    with open(filename, 'r') as ifile:
+    with open(filename, 'rb') as ifile:
         return md5stream(ifile)
 
 
 def md5stream(stream):
     """ Calulate the md5 checksum of a stream of data. """
+    return md5chunks(iter(lambda: stream.read(8192), b''))
+
+
+def md5chunks(chunks):
+    """ Calculate the md5 checksum of an iterable of data chunks. """
     digest = md5()
-    for chunk in iter(lambda: stream.read(8192), b''):
+    for chunk in chunks:
         digest.update(chunk)
     return digest.hexdigest()
 